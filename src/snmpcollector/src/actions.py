@@ -8,7 +8,8 @@ BaseRunInformation = collections.namedtuple('RunInformation',
 AnnotatedResultEntry = collections.namedtuple('AnnotatedResultEntry',
     ('data', 'mib', 'obj', 'index', 'labels'))
 
-Statistics = collections.namedtuple('Statistics', ('timeouts', 'errors'))
+BaseStatistics = collections.namedtuple('Statistics',
+    ('timeouts', 'errors', 'contexts', 'partial'))
 
 
 class RunInformation(BaseRunInformation):
@@ -21,6 +22,20 @@ class RunInformation(BaseRunInformation):
     return self
 
 
+class Statistics(BaseStatistics):
+  """Statistics of a poll.
+
+  contexts maps the polled SNMP contexts (the VLAN, None for the global
+  context) to the seconds it took to poll them. partial is set when the
+  poll ran out of its time budget and the results may be incomplete.
+  """
+  def __new__(cls, timeouts=0, errors=0, contexts=None, partial=False):
+    if contexts is None:
+      contexts = {}
+    return super(Statistics, cls).__new__(
+        cls, timeouts, errors, contexts, partial)
+
+
 class Action(object):
   """Base class that represents an Action that moves between stages."""
   __metadata__ = abc.ABCMeta
@@ -60,6 +75,21 @@ class SnmpWalk(Action):
     return self.target == other.target
 
 
+class SnmpWalkBatch(Action):
+  """Walk over several devices, results are returned per device."""
+
+  def __init__(self, targets):
+    self.targets = targets
+
+  def do(self, stage, run):
+    return stage.do_snmp_walk_batch(run, self.targets)
+
+  def __eq__(self, other):
+    if not isinstance(other, self.__class__):
+      return False
+    return self.targets == other.targets
+
+
 class Summary(Action):
   """Summary for this poll round.
 
@@ -106,3 +136,34 @@ class Result(Action):
 class AnnotatedResult(Result):
   """Same as Result but now the data is annotated."""
   pass
+
+
+class ResultChunk(Result):
+  """Part of one target's results, used when the worker streams results.
+
+  Chunks are numbered from 0 and the last one sent is marked as final, the
+  statistics only cover the chunk itself. References are results from
+  earlier chunks that the annotations of this chunk need to join with.
+  """
+
+  def __init__(self, target, results, stats, sequence, final,
+      references=None):
+    super(ResultChunk, self).__init__(target, results, stats)
+    self.sequence = sequence
+    self.final = final
+    self.references = references or {}
+
+  def do(self, stage, run):
+    return stage.do_result_chunk(run, self.target, self.results, self.stats,
+        self.sequence, self.final, self.references)
+
+  def __eq__(self, other):
+    return (
+        super(ResultChunk, self).__eq__(other) and
+        self.sequence == other.sequence and self.final == other.final and
+        self.references == other.references)
+
+
+class AnnotatedResultChunk(ResultChunk):
+  """Same as ResultChunk but now the data is annotated."""
+  pass
@@ -0,0 +1,105 @@
+"""asyncio runtime for pipeline stages."""
+import asyncio
+import inspect
+import logging
+import threading
+import time
+
+import profiling
+import stage
+
+
+class AsyncStage(stage.Stage):
+  """Stage that executes the Actions on an asyncio event loop.
+
+  The logic may implement the do_* methods as plain functions, generators,
+  coroutines or async generators. The transport keeps running on its own
+  thread since pika is not asyncio aware. Messages are handed over to the
+  loop and the results are passed back through the same completion queue
+  the threaded stages use, so publishing never blocks the loop.
+
+  Consumption is flow controlled by the prefetch count: at most
+  --concurrency actions are in flight at the same time.
+
+  The Actions are interleaved on the loop, so the profiler attributes
+  everything that runs on it to the loop rather than to an Action type.
+  """
+
+  def __init__(self, logic, transport=None, args=None):
+    super(AsyncStage, self).__init__(logic, transport, args)
+    self.loop = asyncio.new_event_loop()
+
+  def _task_wrapper_callback(self, delivery_tag, properties, body):
+    # Called on the transport thread
+    self.loop.call_soon_threadsafe(
+        self._spawn, delivery_tag, properties, body)
+
+  def _spawn(self, delivery_tag, properties, body):
+    self.loop.create_task(self._async_task(delivery_tag, properties, body))
+
+  async def _async_task(self, delivery_tag, properties, body):
+    try:
+      async for action, run in self._execute_async(properties, body):
+        self.completed.put((None, self._message(action, run)))
+    except Exception as e:
+      logging.exception('Unhandled exception in task loop:')
+    finally:
+      self.completed.put((delivery_tag, None))
+
+  async def _execute_async(self, properties, body):
+    start = time.time()
+    action, run = self._receive(properties, body)
+    if action is None:
+      return
+
+    output = action.do(self.logic, run)
+    if inspect.isawaitable(output):
+      output = await output
+    if not output:
+      return
+
+    if hasattr(output, '__aiter__'):
+      async for action in output:
+        # Mark the time we spent in this pipeline
+        run.trace[self.name] = (start, time.time())
+        yield action, run
+    else:
+      for action in output:
+        run.trace[self.name] = (start, time.time())
+        yield action, run
+
+  def _install_profiler(self):
+    # Signal handlers can only be installed from the main thread, see run()
+    pass
+
+  def _start_executor(self):
+    logging.info('Running up to %d tasks on the event loop',
+        self.args.concurrency)
+
+  def _consume(self):
+    while True:
+      self.transport.process_events(stage.COMPLETION_POLL_INTERVAL)
+      self._drain_completed()
+
+  def _run_consumer(self):
+    try:
+      super(AsyncStage, self).run()
+    finally:
+      # Nothing is consumed anymore, do not leave the loop running idle
+      self.loop.call_soon_threadsafe(self.loop.stop)
+
+  def run(self):
+    asyncio.set_event_loop(self.loop)
+    super(AsyncStage, self)._install_profiler()
+    profiling.PROFILER.register_thread(self.name, 'EventLoop')
+    consumer = threading.Thread(
+        target=self._run_consumer, name='%s-transport' % self.name)
+    consumer.daemon = True
+    consumer.start()
+    try:
+      self.loop.run_forever()
+    except KeyboardInterrupt:
+      logging.error('Keyboard interrupt, shutting down..')
+      return
+    logging.error('Transport thread stopped, exiting')
+    raise SystemExit(1)
@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import mock
+import unittest
+
+import actions
+import aiostage
+import transport
+
+
+class AsyncLogic(object):
+
+  async def do_trigger(self, run):
+    await asyncio.sleep(0)
+    yield actions.Summary(1234, 1)
+    yield actions.Summary(1234, 2)
+
+  async def do_summary(self, run, timestamp, targets):
+    await asyncio.sleep(0)
+    if targets == 0:
+      raise ValueError('Broken summary')
+    return [actions.Summary(timestamp, targets + 1)]
+
+
+class TestAsyncStage(unittest.TestCase):
+
+  def setUp(self):
+    self.transport = transport.MemoryTransport(transport.MemoryBroker())
+    self.stage = aiostage.AsyncStage(AsyncLogic(), transport=self.transport,
+        args=argparse.Namespace(instance='test', concurrency=1,
+            profile_dir=None))
+    self.transport.ack = mock.Mock()
+
+  def tearDown(self):
+    self.stage.loop.close()
+
+  def execute(self, action, delivery_tag=1):
+    self.stage._task_wrapper_callback(
+        delivery_tag, None, (action, actions.RunInformation()))
+    # Let the callback and the task it spawns run to completion
+    self.stage.loop.run_until_complete(asyncio.sleep(0.01))
+    self.stage._drain_completed()
+    return [x[1][0] for x in self.transport.broker.queues[
+      'dhmon:snmp:test:Summary']]
+
+  def testAsyncGenerator(self):
+    self.assertEqual(self.execute(actions.Trigger()), [
+      actions.Summary(1234, 1), actions.Summary(1234, 2)])
+    self.transport.ack.assert_called_once_with(1)
+
+  def testCoroutine(self):
+    self.assertEqual(self.execute(actions.Summary(1234, 1)), [
+      actions.Summary(1234, 2)])
+    self.transport.ack.assert_called_once_with(1)
+
+  def testException(self):
+    self.assertEqual(self.execute(actions.Summary(1234, 0), 5), [])
+    self.transport.ack.assert_called_once_with(5)
+
+  def testConsumerStopped(self):
+    def consume():
+      raise RuntimeError('Connection lost')
+    with mock.patch('stage.Stage.run', side_effect=consume):
+      with self.assertRaises(SystemExit) as raised:
+        self.stage.run()
+    self.assertEqual(raised.exception.code, 1)
+    self.assertFalse(self.stage.loop.is_running())
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
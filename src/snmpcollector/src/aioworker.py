@@ -0,0 +1,146 @@
+"""Worker polling the devices with the asyncio SNMP engine."""
+import asyncio
+import logging
+import time
+
+import actions
+import asyncsnmp
+import columnar
+import config
+import oidplan
+import snmp
+import worker
+
+
+class AsyncWorker(worker.Worker):
+  """Worker polling any number of devices from one event loop.
+
+  Run it with worker.py --asyncio on an AsyncStage, --concurrency is then
+  the number of devices in flight. All the requests share one UDP socket,
+  see asyncsnmp.py.
+
+  The contexts of a device are polled at the same time up to
+  worker.contexts.per_device, there is no other limit than --concurrency
+  on the total. Streaming is not supported.
+  """
+
+  def _create_pool(self):
+    return None
+
+  async def do_snmp_walk(self, run, target):
+    starttime = time.time()
+    self._start_budget(target)
+    results, errors, timeouts, contexts = await self._walk_async(target)
+    results = results if results else columnar.Results()
+    logging.info('Done SNMP poll (%d objects) for "%s" lat:%s',
+        len(results.keys()), target.host, (time.time() - starttime))
+    return [actions.Result(target, results, actions.Statistics(
+      timeouts, errors, contexts, self._check_overrun(target)))]
+
+  async def do_snmp_walk_batch(self, run, targets):
+    # All the requests share one socket already, just poll them together
+    output = []
+    for results in await asyncio.gather(
+        *[self.do_snmp_walk(run, x) for x in targets]):
+      output.extend(results)
+    return output
+
+  async def _plan_async(self, target):
+    """Like Worker._plan."""
+    try:
+      model = await asyncsnmp.model(target)
+    except snmp.TimeoutError as e:
+      logging.exception('Could not determine model of %s:', target.host)
+      return None, 0, 1
+    except snmp.Error as e:
+      logging.exception('Could not determine model of %s:', target.host)
+      return None, 1, 0
+
+    logging.info('Object %s is model %s', target.host, model)
+    global_oids, vlan_oids = self.gather_oids(target, model)
+
+    errors = 0
+    vlans = set([None])
+    try:
+      if vlan_oids:
+        vlans.update(await asyncsnmp.vlans(target))
+    except snmp.Error as e:
+      errors += 1
+      logging.warning('Could not list VLANs: %s', str(e))
+    return self._to_poll(target, vlans, global_oids, vlan_oids), errors, 0
+
+  async def _poll_async(self, target, vlan, oids):
+    """Like worker._poll."""
+    errors = 0
+    timeouts = 0
+    results = columnar.Results()
+    if target._check_deadline(oids):
+      return results, errors, timeouts
+    scalars = [x for x in oids if oidplan.is_scalar(x)]
+    if scalars:
+      try:
+        for k, v in (await asyncsnmp.get_many(target, scalars, vlan)).items():
+          if v.type not in ('NOSUCHOBJECT', 'NOSUCHINSTANCE'):
+            results[(k, vlan)] = v
+      except snmp.TimeoutError as e:
+        timeouts += 1
+        logging.debug('Timeout getting %s @ %s: %s', scalars, vlan, e)
+      except snmp.Error as e:
+        errors += 1
+        logging.warning(
+            'SNMP error for OIDs %s@%s: %s', scalars, vlan, str(e))
+    columns = []
+    for oid in oids:
+      if oidplan.is_scalar(oid):
+        continue
+      if not oid.startswith('.1'):
+        logging.warning(
+            'OID %s does not start with .1, please verify configuration', oid)
+        continue
+      columns.append(oid)
+    walked, failed = await asyncsnmp.walk_table(target, columns, vlan)
+    results.add_all(walked, vlan, columns)
+    for oid, e in failed.items():
+      if isinstance(e, snmp.BudgetExceeded):
+        logging.debug('Stopped walking %s@%s: %s', oid, vlan, e)
+      elif isinstance(e, snmp.TimeoutError):
+        timeouts += 1
+        if vlan:
+          logging.debug(
+              'Timeout, is switch configured for VLAN SNMP context? %s', e)
+        else:
+          logging.debug('Timeout, slow switch? %s', e)
+      else:
+        errors += 1
+        logging.warning('SNMP error for OID %s@%s: %s', oid, vlan, str(e))
+    return results, errors, timeouts
+
+  async def _walk_async(self, target):
+    to_poll, errors, timeouts = await self._plan_async(target)
+    if to_poll is None:
+      return None, errors, timeouts, {}
+    to_poll, results = self._due(target, to_poll)
+
+    # Waiters are woken up in order, so the global context starts first
+    limit = asyncio.Semaphore(config.get('worker', 'contexts', 'per_device')
+                              or worker.CONTEXTS_PER_DEVICE)
+
+    async def poll(target, vlan, oids):
+      async with limit:
+        start = time.time()
+        output = await self._poll_async(target, vlan, oids)
+        return vlan, output, time.time() - start
+
+    oids = dict((vlan, x) for _, vlan, x in to_poll)
+    contexts = {}
+    for vlan, output, seconds in await asyncio.gather(
+        *[poll(*x) for x in to_poll]):
+      part_results, part_errors, part_timeouts = output
+      part_results = self.process_overrides(part_results)
+      if not part_errors and not part_timeouts:
+        self._remember(target, vlan, oids[vlan], part_results)
+      results.update(part_results)
+      errors += part_errors
+      timeouts += part_timeouts
+      contexts[vlan] = seconds
+    return results, errors, timeouts, contexts
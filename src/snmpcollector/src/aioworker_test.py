@@ -0,0 +1,77 @@
+import asyncio
+import mock
+import unittest
+import yaml
+
+import actions
+import aioworker
+import config
+import snmp
+
+
+CONFIG = """
+collection:
+  test:
+    models:
+      - .*
+    oids:
+      - .1.2
+  vlans:
+    models:
+      - .*
+    vlan_aware: yes
+    oids:
+      - .1.3
+"""
+
+
+class TestAsyncWorker(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch('config.Config.load')
+    self.addCleanup(patcher.stop)
+    patcher.start().return_value = yaml.load(CONFIG)
+    config.refresh()
+    self.logic = aioworker.AsyncWorker()
+    self.loop = asyncio.new_event_loop()
+    self.addCleanup(self.loop.close)
+    self.target = snmp.SnmpTarget(
+        'test1', '1.2.3.4', 1234, 'access',
+        version=2, community='REMOVED', port=161)
+
+  @mock.patch('asyncsnmp.walk_table')
+  @mock.patch('asyncsnmp.vlans')
+  @mock.patch('asyncsnmp.model')
+  def testSnmpWalk(self, mock_model, mock_vlans, mock_walk):
+    async def model(target):
+      return 'Test switch'
+    async def vlans(target):
+      return set([10])
+    async def walk(target, oids, vlan=None):
+      if vlan == 10 and '.1.2' in oids:
+        raise snmp.TimeoutError('Should not be polled')
+      return dict((oid + '.1', snmp.ResultTuple('1', 'INTEGER'))
+                  for oid in oids), {}
+    mock_model.side_effect = model
+    mock_vlans.side_effect = vlans
+    mock_walk.side_effect = walk
+
+    output = self.loop.run_until_complete(
+        actions.SnmpWalk(self.target).do(self.logic, actions.RunInformation()))
+
+    self.assertEqual(len(output), 1)
+    self.assertEqual(output[0].results, {
+      ('.1.2.1', None): snmp.ResultTuple('1', 'INTEGER'),
+      ('.1.3.1', 10): snmp.ResultTuple('1', 'INTEGER')})
+    self.assertEqual(output[0].stats.errors, 0)
+    self.assertEqual(output[0].stats.timeouts, 0)
+    self.assertEqual(set(output[0].stats.contexts), set([None, 10]))
+    self.assertIsNone(self.logic.pool)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
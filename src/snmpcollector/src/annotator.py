@@ -2,13 +2,77 @@
 import binascii
 import collections
 import logging
-import time
 
 import actions
+import columnar
 import config
+import mibcache
 import snmp
 import stage
-import re
+
+
+class Annotation(object):
+  """The labels to give the OIDs below one of the annotated ones."""
+
+  __slots__ = ('offset', 'labels')
+
+  def __init__(self, offset, labels):
+    # Index components to leave out before joining, or None
+    self.offset = offset
+    # [(label, path)], .1 > $.2 is [('.1.', False), ('.2.', True)]
+    self.labels = labels
+
+
+class Annotations(object):
+  """The annotator configuration compiled for looking up OIDs.
+
+  The annotated OIDs are kept in a trie on their components, so finding the
+  annotation of an OID does not depend on the number of annotations, and
+  the join paths are parsed once instead of for every row.
+  """
+
+  def __init__(self, annotations, labelify):
+    # Trie of {component: node}, the annotation of a node is under None
+    self.trie = {}
+    for annotation in annotations or []:
+      labels = []
+      for label, annotation_path in annotation['with'].items():
+        path = []
+        for key in annotation_path.split('>'):
+          key = key.strip()
+          use_value = key[0] == '$'
+          path.append((key.lstrip('$') + '.', use_value))
+        labels.append((label, path))
+      for annotate in annotation['annotate']:
+        # Support for processing the index (for OIDs that have X.Y where we're
+        # interested in joining on X)
+        if '[' in annotate:
+          annotate, offset = annotate.split('[', 1)
+          offset = int(offset.strip(']'))
+        else:
+          offset = None
+        node = self.trie
+        for part in annotate.strip('.').split('.'):
+          node = node.setdefault(part, {})
+        node[None] = Annotation(offset, labels)
+    # Add '.' to not match .1.2.3 if we want to labelify 1.2.30
+    self.labelification = set([x + '.' for x in labelify or []])
+
+  def lookup(self, oid):
+    """Returns the Annotation of oid, or None.
+
+    The annotation of the longest OID that oid is below is used.
+    """
+    found = None
+    node = self.trie
+    # The last component is never matched, .1.2 does not annotate .1.2
+    for part in oid.strip('.').split('.')[:-1]:
+      node = node.get(part, None)
+      if node is None:
+        break
+      found = node.get(None, found)
+    return found
+
 
 class Annotator(object):
   """Annotation step where results are given meaningful labels."""
@@ -20,8 +84,11 @@ class Annotator(object):
 
   def __init__(self):
     super(Annotator, self).__init__()
-    self.mibcache = {}
+    self.mibcache = mibcache.MibCache(self._resolve)
+    self._mib_cache_config = None
     self._mibresolver = None
+    self._annotations = None
+    self._annotations_incarnation = 0
 
   @property
   def mibresolver(self):
@@ -31,50 +98,69 @@ class Annotator(object):
       self._mibresolver = mibresolver
     return self._mibresolver
 
+  def _resolve(self, oid):
+    return self.mibresolver.resolve(oid)
+
+  def _check_incarnation(self):
+    # Read the configuration first, it is what moves the incarnation
+    annotator_config = config.get('annotator') or {}
+    if (self._annotations is not None and
+        config.incarnation() == self._annotations_incarnation):
+      return
+    self._annotations = Annotations(annotator_config.get('annotations'),
+                                    annotator_config.get('labelify'))
+    self._annotations_incarnation = config.incarnation()
+    mib_cache = annotator_config.get('mib_cache') or {}
+    if mib_cache != self._mib_cache_config:
+      self.mibcache.load(mib_cache.get('filename'), mib_cache.get('size'))
+      self._mib_cache_config = mib_cache
+
+  @property
+  def annotations(self):
+    """Annotations compiled from the current configuration."""
+    self._check_incarnation()
+    return self._annotations
+
   def do_result(self, run, target, results, stats):
-    annotations = config.get('annotator', 'annotations') or []
+    annotated_results = self.annotate_results(target, results)
+    yield actions.AnnotatedResult(target, annotated_results, stats)
+    logging.debug('Annotation completed for %d metrics for %s',
+        len(annotated_results), target.host)
 
-    # Calculate map to skip annotation if we're sure we're not going to annotate
-    # TODO(bluecmd): This could be cached
-    annotation_map = {}
-    for annotation in annotations:
-      for annotate in annotation['annotate']:
-        # Support for processing the index (for OIDs that have X.Y where we're
-        # interested in joining on X)
-        if '[' in annotate:
-          annotate, offset = annotate.split('[', 1)
-          offset = int(offset.strip(']'))
-        else:
-          offset = None
-        # Add '.' to not match .1.2.3 if we want to annotate 1.2.30
-        annotation_map[(annotate + '.', offset)] = annotation['with']
+  def do_result_chunk(self, run, target, results, stats, sequence, final,
+      references):
+    annotated_results = self.annotate_results(target, results, references)
+    yield actions.AnnotatedResultChunk(
+        target, annotated_results, stats, sequence, final)
+    logging.debug('Annotation completed for %d metrics for %s (chunk %d)',
+        len(annotated_results), target.host, sequence)
+
+  def annotate_results(self, target, results, references=None):
+    """Annotate results, joining with references if needed.
 
-    labelification = set(
-        [x + '.' for x in config.get('annotator', 'labelify') or []])
+    Only the results are returned, the references are just used for
+    looking up annotations.
+    """
+    annotations = self.annotations
+
+    joined = results
+    if references or not isinstance(results, columnar.Results):
+      joined = columnar.Results(references or ())
+      joined.update(results)
 
     # Pre-fill the OID/Enum cache to allow annotations to get enum values
-    #for (oid, ctxt), result in results.iteritems():
-    for (oid, ctxt), result in results.items():
-      resolve = self.mibcache.get(oid, None)
-      if resolve is None:
-        resolve = self.mibresolver.resolve(oid)
-        if resolve is not None:
-            m = re.search(r'[.]\d+$', resolve[0])
-            # if the string ends in digits m will be a Match object, or None otherwise.
-            if m is None:
-               lst = list(resolve)
-               lst[0] = "%s.0" % lst[0]
-               resolve = tuple(lst)
-        self.mibcache[oid] = resolve
-      if resolve is None:
-        logging.warning('Failed to look up OID %s, ignoring', oid)
-        continue
+    resolved = {}
+    for (parent, ctxt), column in joined.columns.items():
+      self.resolve_column(parent, column.indexes, resolved)
+    for oid, ctxt in joined.other:
+      self.resolve_oid(oid, resolved)
+    self.mibcache.flush()
 
     # Calculate annotator map
     split_oid_map = collections.defaultdict(dict)
     #for (oid, ctxt), result in results.iteritems():
-    for (oid, ctxt), result in results.items():
-      resolve = self.mibcache.get(oid, None)
+    for (oid, ctxt), result in joined.items():
+      resolve = resolved[oid]
       if resolve is None:
         continue
       name, _ = resolve
@@ -83,16 +169,15 @@ class Annotator(object):
       key = oid[:-(len(index))]
       split_oid_map[(key, ctxt)][index] = result.value
 
-    annotated_results = {}
+    # (Annotation, context) -> labels by index, see join_table
+    join_tables = {}
+    annotated_results = columnar.AnnotatedResults()
     #for (oid, ctxt), result in results.iteritems():
     for (oid, ctxt), result in results.items():
-      resolve = self.mibcache.get(oid, None)
+      resolve = resolved[oid]
       if resolve is None:
         continue
 
-      # Record some stats on how long time it took to get this metric
-      elapsed = (time.time() - target.timestamp) * 1000 * 1000
-      labels = {}
       vlan = None
 
       # TODO(bluecmd): If we support more contexts we need to be smarter here
@@ -111,17 +196,22 @@ class Annotator(object):
       labels = {}
       if not vlan is None:
         labels['vlan'] = vlan
-      labels.update(
-          self.annotate(
-            oid, index, ctxt, annotation_map, split_oid_map, results))
+      annotation = annotations.lookup(oid)
+      if annotation is not None:
+        join_table = join_tables.get((annotation, ctxt), None)
+        if join_table is None:
+          join_table = join_tables[(annotation, ctxt)] = self.join_table(
+              annotation, ctxt, split_oid_map, resolved)
+        labels.update(
+            self.annotate(annotation, index, result.value, join_table))
 
       # Handle labelification
-      if oid[:-len(index)] in labelification:
+      if oid[:-len(index)] in annotations.labelification:
         # Skip empty strings or non-strings that are up for labelification
         if result.value == '' or result.type not in self.LABEL_TYPES:
           continue
         labels['value'] = self.string_to_label_value(result.value)
-        labels['hex'] = binascii.hexlify(result.value)
+        labels['hex'] = self.string_to_hex(result.value)
         result = snmp.ResultTuple('NaN', 'ANNOTATED')
 
       # Do something almost like labelification for enums
@@ -133,48 +223,101 @@ class Annotator(object):
         else:
           labels['enum'] = enum_value
 
-      annotated_results[(oid, vlan)] = actions.AnnotatedResultEntry(
-          result, mib, obj, index, labels)
-
-    yield actions.AnnotatedResult(target, annotated_results, stats)
-    logging.debug('Annotation completed for %d metrics for %s',
-        len(annotated_results), target.host)
-
-  def annotate(self, oid, index, ctxt, annotation_map, split_oid_map, results):
-    for key, offset in annotation_map:
-      if oid.startswith(key):
-        break
-    else:
-      return {}
-
-    if offset is not None:
+      annotated_results.append_entry(
+          oid, vlan, result.value, result.type, mib, obj, index, labels)
+    return annotated_results
+
+  def resolve_oid(self, oid, resolved):
+    if oid in resolved:
+      return
+    resolve = self.mibcache.resolve_instance(oid)
+    if resolve is None:
+      logging.warning('Failed to look up OID %s, ignoring', oid)
+    resolved[oid] = resolve
+
+  def resolve_column(self, parent, indexes, resolved):
+    """Resolve the rows of a column, only the first one is looked up.
+
+    The rest are named after it, unless the column turns out to hold rows
+    of several MIB objects. A table walked as a whole is split into its
+    columns, the MIB index of the first row tells where they end.
+    """
+    first = '%s.%s' % (parent, indexes[0])
+    self.resolve_oid(first, resolved)
+    resolve = resolved[first]
+    if resolve is None:
+      for index in indexes:
+        resolved['%s.%s' % (parent, index)] = None
+      return
+    name, enum = resolve
+    mib_index = name.partition('::')[2].partition('.')[2]
+    if mib_index and indexes[0].endswith('.' + mib_index):
+      depth = indexes[0].count('.') - mib_index.count('.')
+      columns = collections.defaultdict(list)
+      for index in indexes:
+        parts = index.split('.', depth)
+        if len(parts) > depth:
+          columns['.'.join(parts[:depth])].append(parts[depth])
+        else:
+          self.resolve_oid('%s.%s' % (parent, index), resolved)
+      for column, rests in columns.items():
+        self.resolve_column('%s.%s' % (parent, column), rests, resolved)
+      return
+    # Otherwise the MIB index can be longer than the one of the column
+    if mib_index != indexes[0] and not mib_index.endswith('.' + indexes[0]):
+      for index in indexes:
+        self.resolve_oid('%s.%s' % (parent, index), resolved)
+      return
+    prefix = name[:-len(indexes[0])]
+    for index in indexes:
+      resolved['%s.%s' % (parent, index)] = (prefix + index, enum)
+
+  def annotate(self, annotation, index, value, join_table):
+    """Returns the labels of the row at index with value."""
+    by_index, by_value = join_table
+    if annotation.offset is not None:
       index_parts = index.split('.')
-      index = '.'.join(index_parts[:-offset])
-    labels = {}
-    #for label, annotation_path in annotation_map[(key, offset)].iteritems():
-    for label, annotation_path in annotation_map[(key, offset)].items():
-      # Parse the annotation path
-      annotation_keys = [x.strip() + '.' for x in annotation_path.split('>')]
-
-      value = self.jump_to_value(
-          annotation_keys, oid, ctxt, index, split_oid_map, results)
-      if value is None:
+      index = '.'.join(index_parts[:-annotation.offset])
+    labels = dict(by_index.get(index, ()))
+    for label, values in by_value:
+      label_value = values.get(value, None)
+      if label_value is not None:
+        labels[label] = label_value
+    return labels
+
+  def join_table(self, annotation, ctxt, split_oid_map, resolved):
+    """Join the labels of annotation for every index of a device at once.
+
+    Returns:
+      ({index: labels}, [(label, {value: label value})]), the latter for the
+      paths joining on the value of the annotated row ($).
+    """
+    by_index = collections.defaultdict(dict)
+    by_value = []
+    for label, path in annotation.labels:
+      use_value, values = self.join(path, ctxt, split_oid_map, resolved)
+      if use_value:
+        by_value.append((label, values))
         continue
+      for index, value in values.items():
+        by_index[index][label] = value
+    return by_index, by_value
 
-      labels[label] = value.replace('"', '\\"')
-    return labels
+  def join(self, path, ctxt, split_oid_map, resolved):
+    """Follow path from every index of its first OID.
 
-  def jump_to_value(self, keys, oid, ctxt, index, split_oid_map, results):
+    Returns:
+      (use_value, {index: label value}), where the index is the value of the
+      annotated row if use_value is set.
+    """
     # Jump across the path seperated like:
     # OID.idx:value1
     # OID2.value1:value2
     # OID3.value3:final
     # label=final
-    for key in keys:
-      use_value = key[0] == '$'
-      if use_value:
-        key = key[1:]
-
+    hops = []
+    use_value = False
+    for key, key_use_value in path:
       # Try to associate with context first
       part = split_oid_map.get((key, ctxt), None)
       if not part:
@@ -189,21 +332,32 @@ class Annotator(object):
         ctxt = None
         if not part:
           continue
-
-      # We either use the last index or the OID value, deterimed by
-      # use_value above.
-      if use_value:
-        index = results[(oid, ctxt)].value
-
-      oid = ''.join((key, index))
-      index = part.get(index, None)
-      if not index:
-        return None
-
-    value = results[(oid, ctxt)].value
-
+      # Only the first jump can use the OID value, after that the last index
+      # and the OID value are the same thing
+      if not hops:
+        use_value = key_use_value
+      hops.append((key, part))
+    if not hops:
+      return use_value, {}
+
+    values = {}
+    for start in hops[0][1]:
+      index = start
+      for key, part in hops:
+        oid = key + index
+        index = part.get(index, None)
+        if not index:
+          break
+      else:
+        value = self.enum_value(oid, index, resolved[oid])
+        if value is not None:
+          values[start] = value.replace('"', '\\"')
+    return use_value, values
+
+  def enum_value(self, oid, value, resolve):
+    """Returns value as the label value of oid, or None if it is invalid."""
     # Try enum resolution
-    _, enum = self.mibcache[oid]
+    _, enum = resolve
     if enum:
       enum_value = enum.get(value, None)
       if enum_value is None:
@@ -213,6 +367,12 @@ class Annotator(object):
       value = enum_value
     return str(value)
 
+  def string_to_hex(self, value):
+    # The strings are bytes decoded as latin-1, see asyncsnmp._decode_value
+    if not isinstance(value, bytes):
+      value = value.encode('latin-1')
+    return binascii.hexlify(value).decode('ascii')
+
   def string_to_label_value(self, value):
     value = ''.join(x for x in value.strip() if x in self.ALLOWED_CHARACTERS)
     return value.strip()
@@ -221,4 +381,5 @@ class Annotator(object):
 if __name__ == '__main__':
   annotator = stage.Stage(Annotator())
   annotator.listen(actions.Result)
+  annotator.listen(actions.ResultChunk)
   annotator.run()
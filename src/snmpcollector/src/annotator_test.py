@@ -6,6 +6,7 @@ import yaml
 
 import annotator
 import actions
+import columnar
 import config
 import snmp
 
@@ -30,6 +31,10 @@ def snmpResult(x, type=None):
   return snmp.ResultTuple(str(x), type)
 
 
+def hexlify(x):
+  return binascii.hexlify(x.encode('latin-1')).decode('ascii')
+
+
 class MockMibResolver(object):
 
   def resolve_for_testing(self, oid):
@@ -70,13 +75,13 @@ class TestAnnotator(unittest.TestCase):
         result.target, expected_entries, result.stats)]
     output = list(result.do(self.logic, run=self.run))
     if output != expected_output:
-      print 'Output is not as expected!'
-      print 'Output:'
-      for oid, v in output[0].results.iteritems():
-        print oid, v
-      print 'Expected:'
-      for oid, v in expected_output[0].results.iteritems():
-        print oid, v
+      print('Output is not as expected!')
+      print('Output:')
+      for oid, v in output[0].results.items():
+        print(oid, v)
+      print('Expected:')
+      for oid, v in expected_output[0].results.items():
+        print(oid, v)
     self.assertEquals(output, expected_output)
 
   def createResultEntry(self, key, result, labels):
@@ -94,7 +99,7 @@ class TestAnnotator(unittest.TestCase):
     # the basic annotated entries and just operate on the edge cases we are
     # testing.
     expected = {}
-    for (key, ctxt), value in result.results.iteritems():
+    for (key, ctxt), value in result.results.items():
       expected.update(self.createResultEntry((key, ctxt), result, {}))
     return expected
 
@@ -118,6 +123,40 @@ class TestAnnotator(unittest.TestCase):
     }
     self.runTest(expected, result, '')
 
+  def testResolveColumns(self):
+    """Test that one row per column is resolved."""
+    results = columnar.Results()
+    # Indexed by two components, like a MAC address
+    results.add_all({
+        '.1.2.3.1.1': snmpResult(1), '.1.2.3.1.2': snmpResult(2),
+        '.1.2.3.2.3': snmpResult(3)}, None, ['.1.2.3'])
+    results.add_all({
+        '.1.2.4.1': snmpResult(1), '.1.2.4.2': snmpResult(2)}, '100')
+    result = self.createResult(results=results)
+    expected = self.newExpectedFromResult(result)
+    mibcache = self.logic.mibcache
+    with mock.patch.object(mibcache, 'resolve_instance',
+                           wraps=mibcache.resolve_instance) as mock_resolve:
+      self.runTest(expected, result, '')
+    self.assertEqual(sorted(x[0][0] for x in mock_resolve.call_args_list),
+                     ['.1.2.3.1.1', '.1.2.4.1'])
+
+  def testResolveTable(self):
+    """Test that one row per column is resolved of a table walked whole."""
+    results = columnar.Results()
+    results.add_all({
+        '.1.2.3.1.1': snmpResult(1), '.1.2.3.1.2': snmpResult(2),
+        '.1.2.4.1': snmpResult(3), '.1.2.4.2': snmpResult(4)}, None, ['.1.2'])
+    self.assertEqual(list(results.columns), [('.1.2', None)])
+    result = self.createResult(results=results)
+    expected = self.newExpectedFromResult(result)
+    mibcache = self.logic.mibcache
+    with mock.patch.object(mibcache, 'resolve_instance',
+                           wraps=mibcache.resolve_instance) as mock_resolve:
+      self.runTest(expected, result, '')
+    self.assertEqual(sorted(x[0][0] for x in mock_resolve.call_args_list),
+                     ['.1.2.3.1.1', '.1.2.4.1'])
+
   def testSimpleAnnotation(self):
     """Test simple annotation and VLAN support."""
     config = """
@@ -274,6 +313,53 @@ annotator:
       {'interface': 'correct'}))
     self.runTest(expected, result, config)
 
+  def testMultiLevelAnnotationValueContext(self):
+    """Test multi level annotation via value across contexts."""
+    config = """
+annotator:
+  annotations:
+    - annotate:
+        - .1.2.3
+      with:
+        interface: $.1.2.4 > .10.1
+"""
+    result = self.createResult({
+      ('.1.2.3.1337', '100'): snmpResult(1),
+      ('.1.2.3.1338', '100'): snmpResult(2),
+      ('.1.2.4.1', None): snmpResult(5),
+      ('.10.1.5', None): snmpResult('correct'),
+    })
+    expected = self.newExpectedFromResult(result)
+    expected.update(self.createResultEntry(('.1.2.3.1337', '100'), result,
+      {'interface': 'correct'}))
+    self.runTest(expected, result, config)
+
+  def testJoinTable(self):
+    """Test that the labels are joined once for all the indexes."""
+    annotations = annotator.Annotations([
+        {'annotate': ['.1.2.3'],
+         'with': {'interface': '.1.2.4 > .10.1', 'thing': '$.10.3'}},
+    ], None)
+    annotation = annotations.lookup('.1.2.3.1')
+    split_oid_map = {
+        ('.1.2.4.', None): {'1': '5', '2': '6', '3': '7'},
+        ('.10.1.', None): {'5': 'a"b', '6': 'if6'},
+        ('.10.3.', '100'): {'10': '10'},
+    }
+    resolved = {
+        '.10.1.5': ('DUMMY-MIB::interfaceString.5', {}),
+        '.10.1.6': ('DUMMY-MIB::interfaceString.6', {}),
+        '.10.3.10': ('DUMMY-MIB::enumString.10', ENUMS['.10.3']),
+    }
+    by_index, by_value = self.logic.join_table(
+        annotation, '100', split_oid_map, resolved)
+    self.assertEqual(by_index,
+                     {'1': {'interface': 'a\\"b'}, '2': {'interface': 'if6'}})
+    self.assertEqual(by_value, [('thing', {'10': 'enumValue'})])
+    self.assertEqual(
+        self.logic.annotate(annotation, '2', '10', (by_index, by_value)),
+        {'interface': 'if6', 'thing': 'enumValue'})
+
   def testMultiLevelAnnotationBroken(self):
     """Test multi level annotation where we do not have a match."""
     config = """
@@ -331,9 +417,9 @@ annotator:
     })
     expected = self.newExpectedFromResult(result)
     expected.update(self.createResultEntry(('.10.2.1', None), identities,
-      {'value': 'correct', 'hex': binascii.hexlify('correct')}))
+      {'value': 'correct', 'hex': hexlify('correct')}))
     expected.update(self.createResultEntry(('.10.2.2', None), identities,
-      {'value': 'abc', 'hex': binascii.hexlify('\xffabc\xff ')}))
+      {'value': 'abc', 'hex': hexlify('\xffabc\xff ')}))
     # Empty strings should not be included
     del expected[('.10.2.3', None)]
     # Only strings are labelified
@@ -380,6 +466,72 @@ annotator:
       {'enum': 'enumValue'}))
     self.runTest(expected, result, config)
 
+  def testAnnotationsLookup(self):
+    """Test that the most specific annotation is found."""
+    annotations = annotator.Annotations([
+        {'annotate': ['.1.2'], 'with': {'a': '.10.1'}},
+        {'annotate': ['.1.2.3[1]'], 'with': {'b': '$.1.2.4 > .10.1'}},
+    ], ['.10.2'])
+    annotation = annotations.lookup('.1.2.4.1')
+    self.assertIsNone(annotation.offset)
+    self.assertEqual(annotation.labels, [('a', [('.10.1.', False)])])
+    annotation = annotations.lookup('.1.2.3.1.1')
+    self.assertEqual(annotation.offset, 1)
+    self.assertEqual(annotation.labels,
+                     [('b', [('.1.2.4.', True), ('.10.1.', False)])])
+    self.assertIsNone(annotations.lookup('.1.2'))
+    self.assertIsNone(annotations.lookup('.1.20.1'))
+    self.assertIsNone(annotations.lookup('.10.1.1'))
+    self.assertEqual(annotations.labelification, set(['.10.2.']))
+
+  @mock.patch('config.Config.load')
+  def testAnnotationsCached(self, mock_config):
+    """Test that annotations are compiled once per configuration."""
+    mock_config.return_value = yaml.load("""
+annotator:
+  annotations:
+    - annotate:
+        - .1.2
+      with:
+        interface: .10.1
+""")
+    annotations = self.logic.annotations
+    self.assertIs(self.logic.annotations, annotations)
+    mock_config.return_value = yaml.load("""
+annotator:
+  labelify:
+    - .10.2
+""")
+    config.refresh()
+    self.assertIsNot(self.logic.annotations, annotations)
+    self.assertIsNone(self.logic.annotations.lookup('.1.2.3.1'))
+
+  @mock.patch('config.Config.load')
+  def testResultChunkReferences(self, mock_config):
+    """Test that chunks are annotated using the references."""
+    mock_config.return_value = yaml.load("""
+annotator:
+  annotations:
+    - annotate:
+        - .1.2
+      with:
+        interface: .10.1
+""")
+    references = {
+      ('.10.1.1', None): snmpResult('interface1'),
+    }
+    result = self.createResult({
+      ('.1.2.3.1', None): snmpResult(1337),
+    })
+    chunk = actions.ResultChunk(
+        result.target, result.results, result.stats, 3, True, references)
+    expected = self.createResultEntry(('.1.2.3.1', None), result,
+      {'interface': 'interface1'})
+    output = list(chunk.do(self.logic, run=self.run))
+    # The references are not passed on
+    self.assertEquals(output, [actions.AnnotatedResultChunk(
+        result.target, expected, result.stats, 3, True)])
+
 
 def main():
   unittest.main()
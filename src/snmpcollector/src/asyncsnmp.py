@@ -0,0 +1,676 @@
+"""Asynchronous SNMP client.
+
+Implements just enough of SNMP v2c and v3 (USM) to GET and GETBULK from an
+asyncio event loop. All requests of a loop share one UDP socket and the
+responses are matched to the requests on the request id, so a single
+process can have any number of devices in flight.
+
+walk(), walk_table(), get(), get_many(), model() and vlans() are the asynchronous counterparts of
+the snmp.SnmpTarget methods and return the same results, including the
+netsnmp type names the rest of the pipeline depends on.
+
+SNMPv3 privacy needs the cryptography package and only supports AES.
+"""
+import asyncio
+import collections
+import hashlib
+import hmac
+import itertools
+import logging
+import random
+import socket
+import struct
+import time
+
+import snmp
+
+# Default timeout and retries, the same as the netsnmp sessions
+TIMEOUT = 2.0
+RETRIES = 3
+
+# Larger receive buffer for the shared socket, many responses can arrive
+# before the loop gets around to reading them
+RECEIVE_BUFFER = 4 * 1024 * 1024
+
+MAX_MESSAGE_SIZE = 65507
+
+_INTEGER = 0x02
+_OCTET_STRING = 0x04
+_NULL = 0x05
+_OBJECT_ID = 0x06
+_SEQUENCE = 0x30
+_IPADDRESS = 0x40
+_COUNTER32 = 0x41
+_GAUGE32 = 0x42
+_TIMETICKS = 0x43
+_OPAQUE = 0x44
+_COUNTER64 = 0x46
+_NO_SUCH_OBJECT = 0x80
+_NO_SUCH_INSTANCE = 0x81
+_END_OF_MIB_VIEW = 0x82
+
+GET = 0xa0
+GETNEXT = 0xa1
+RESPONSE = 0xa2
+GETBULK = 0xa5
+REPORT = 0xa8
+
+_TYPES = {
+    _INTEGER: 'INTEGER', _OCTET_STRING: 'OCTETSTR', _NULL: 'NULL',
+    _OBJECT_ID: 'OBJECTID', _IPADDRESS: 'IPADDR', _COUNTER32: 'COUNTER',
+    _GAUGE32: 'GAUGE', _TIMETICKS: 'TICKS', _OPAQUE: 'OPAQUE',
+    _COUNTER64: 'COUNTER64', _NO_SUCH_OBJECT: 'NOSUCHOBJECT',
+    _NO_SUCH_INSTANCE: 'NOSUCHINSTANCE', _END_OF_MIB_VIEW: 'ENDOFMIBVIEW'}
+
+_UNSIGNED = frozenset([_COUNTER32, _GAUGE32, _TIMETICKS, _COUNTER64])
+
+_ERRORS = {
+    1: 'tooBig', 2: 'noSuchName', 3: 'badValue', 4: 'readOnly', 5: 'genErr',
+    6: 'noAccess', 16: 'authorizationError'}
+
+_NOT_IN_TIME_WINDOW = '.1.3.6.1.6.3.15.1.1.2.0'
+_UNKNOWN_ENGINE_ID = '.1.3.6.1.6.3.15.1.1.4.0'
+_REPORTS = {
+    '.1.3.6.1.6.3.15.1.1.1.0': 'unsupported security level',
+    _NOT_IN_TIME_WINDOW: 'not in time window',
+    '.1.3.6.1.6.3.15.1.1.3.0': 'unknown user name',
+    _UNKNOWN_ENGINE_ID: 'unknown engine id',
+    '.1.3.6.1.6.3.15.1.1.5.0': 'wrong digest',
+    '.1.3.6.1.6.3.15.1.1.6.0': 'decryption error'}
+
+_HASHES = {'MD5': hashlib.md5, 'SHA': hashlib.sha1}
+
+# Size of the digest in the messages, HMAC-MD5-96 and HMAC-SHA-96
+_DIGEST_SIZE = 12
+
+_SECURITY_FLAGS = {'noAuthNoPriv': 0, 'authNoPriv': 1, 'authPriv': 3}
+_AUTH = 1
+_PRIV = 2
+_REPORTABLE = 4
+
+
+def _length(n):
+  if n < 0x80:
+    return bytes([n])
+  data = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+  return bytes([0x80 | len(data)]) + data
+
+
+def _tlv(tag, value):
+  return bytes([tag]) + _length(len(value)) + value
+
+
+def _integer(n):
+  return _tlv(_INTEGER, n.to_bytes(
+      (n.bit_length() + 8) // 8, 'big', signed=True))
+
+
+def _octets(data):
+  return _tlv(_OCTET_STRING, data)
+
+
+def _sequence(*items):
+  return _tlv(_SEQUENCE, b''.join(items))
+
+
+def _oid(oid):
+  arcs = [int(x) for x in oid.strip('.').split('.')]
+  arcs[:2] = [arcs[0] * 40 + (arcs[1] if len(arcs) > 1 else 0)]
+  data = bytearray()
+  for arc in arcs:
+    chunk = [arc & 0x7f]
+    arc >>= 7
+    while arc:
+      chunk.append(0x80 | (arc & 0x7f))
+      arc >>= 7
+    data.extend(reversed(chunk))
+  return _tlv(_OBJECT_ID, bytes(data))
+
+
+def encode_pdu(tag, request_id, oids, non_repeaters=0, max_repetitions=0):
+  """Encode a PDU asking for oids, the values are left empty."""
+  varbinds = b''.join(_sequence(_oid(x), b'\x05\x00') for x in oids)
+  return _tlv(tag, _integer(request_id) + _integer(non_repeaters) +
+      _integer(max_repetitions) + _sequence(varbinds))
+
+
+def _read(data, offset):
+  """Returns (tag, start, end) of the value of the TLV at offset."""
+  try:
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+      size = length & 0x7f
+      length = int.from_bytes(data[offset:offset + size], 'big')
+      offset += size
+  except IndexError:
+    raise snmp.SnmpError('Truncated SNMP message')
+  end = offset + length
+  if end > len(data):
+    raise snmp.SnmpError('Truncated SNMP message')
+  return tag, offset, end
+
+
+def _children(data, start, end):
+  """Returns (tag, start, end) of every TLV in data[start:end]."""
+  children = []
+  while start < end:
+    child = _read(data, start)
+    children.append(child)
+    start = child[2]
+  return children
+
+
+def _int(data, child):
+  _, start, end = child
+  return int.from_bytes(data[start:end], 'big', signed=True)
+
+
+def _decode_oid(data):
+  arcs = []
+  arc = 0
+  for byte in data:
+    arc = (arc << 7) | (byte & 0x7f)
+    if not byte & 0x80:
+      arcs.append(arc)
+      arc = 0
+  if not arcs:
+    return ''
+  first = arcs[0]
+  head = [first // 40, first % 40] if first < 80 else [2, first - 80]
+  return '.' + '.'.join(str(x) for x in head + arcs[1:])
+
+
+def _decode_value(tag, data):
+  # Everything is a string, like in netsnmp
+  if tag == _INTEGER:
+    return str(int.from_bytes(data, 'big', signed=True))
+  if tag in _UNSIGNED:
+    return str(int.from_bytes(data, 'big'))
+  if tag == _OCTET_STRING or tag == _OPAQUE:
+    return data.decode('latin-1')
+  if tag == _OBJECT_ID:
+    return _decode_oid(data)
+  if tag == _IPADDRESS:
+    return '.'.join(str(x) for x in data)
+  return None
+
+
+_TAGS = dict((v, k) for k, v in _TYPES.items())
+
+
+def encode_value(result):
+  """Encode a snmp.ResultTuple, the opposite of _decode_value."""
+  value, name = result
+  tag = _TAGS.get(name, None)
+  if tag is None:
+    # Types we do not know of, keep the value at least
+    if isinstance(value, int):
+      return _integer(value)
+    tag = _OCTET_STRING
+  if tag == _INTEGER:
+    return _integer(int(value))
+  if tag in _UNSIGNED:
+    value = int(value)
+    return _tlv(tag, value.to_bytes((value.bit_length() + 8) // 8, 'big'))
+  if tag == _OBJECT_ID:
+    return _oid(value)
+  if tag == _IPADDRESS:
+    return _tlv(tag, bytes(int(x) for x in value.split('.')))
+  if tag in (_OCTET_STRING, _OPAQUE):
+    if isinstance(value, str):
+      value = value.encode('latin-1')
+    elif isinstance(value, int):
+      value = str(value).encode('latin-1')
+    return _tlv(tag, value)
+  return _tlv(tag, b'')
+
+
+def encode_response(request_id, varbinds, error_status=0, error_index=0):
+  """Encode a RESPONSE PDU with the (oid, snmp.ResultTuple) varbinds."""
+  data = b''.join(
+      _sequence(_oid(oid), encode_value(x)) for oid, x in varbinds)
+  return _tlv(RESPONSE, _integer(request_id) + _integer(error_status) +
+      _integer(error_index) + _sequence(data))
+
+
+def decode_pdu(data, pdu):
+  """Returns (tag, request_id, error_status, error_index, varbinds).
+
+  pdu is the (tag, start, end) of the PDU in data, the varbinds a list of
+  (oid, snmp.ResultTuple).
+  """
+  tag, start, end = pdu
+  fields = _children(data, start, end)
+  if len(fields) != 4:
+    raise snmp.SnmpError('Malformed SNMP PDU')
+  varbinds = []
+  for _, vstart, vend in _children(data, fields[3][1], fields[3][2]):
+    (_, ostart, oend), (vtag, vstart, vend) = _children(data, vstart, vend)
+    value = bytes(data[vstart:vend])
+    varbinds.append((_decode_oid(data[ostart:oend]), snmp.ResultTuple(
+        _decode_value(vtag, value), _TYPES.get(vtag, 'UNKNOWN'))))
+  return (tag, _int(data, fields[0]), _int(data, fields[1]),
+          _int(data, fields[2]), varbinds)
+
+
+def message_id(data):
+  """Returns the id used to match a message with its request.
+
+  This is the request id for SNMPv2c and msgID for SNMPv3, which are the
+  same for the requests we send.
+  """
+  _, start, end = _read(data, 0)
+  version = _read(data, start)
+  if _int(data, version) == 3:
+    _, start, end = _read(data, version[2])
+    return _int(data, _read(data, start))
+  community = _read(data, version[2])
+  _, start, end = _read(data, community[2])
+  return _int(data, _read(data, start))
+
+
+_LOCALIZED_KEYS = {}
+
+
+def localize_key(proto, password, engine_id):
+  """Returns the key localized to engine_id, as in RFC 3414 A.2."""
+  cache_key = (proto, password, engine_id)
+  key = _LOCALIZED_KEYS.get(cache_key, None)
+  if key is not None:
+    return key
+  digest = _HASHES[proto]
+  password = password.encode('utf-8')
+  expanded = password * (1048576 // len(password) + 1)
+  ku = digest(expanded[:1048576]).digest()
+  key = digest(ku + engine_id + ku).digest()
+  _LOCALIZED_KEYS[cache_key] = key
+  return key
+
+
+def _aes(key, iv, data, encrypt):
+  try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+  except ImportError:
+    raise snmp.SnmpError('SNMPv3 privacy requires the cryptography package')
+  cipher = Cipher(algorithms.AES(key[:16]), modes.CFB(iv))
+  context = cipher.encryptor() if encrypt else cipher.decryptor()
+  return context.update(data) + context.finalize()
+
+
+class Agent(object):
+  """What we know about the SNMPv3 engine of a device."""
+
+  def __init__(self, engine_id=b'', boots=0, engine_time=0):
+    self.update(engine_id, boots, engine_time)
+
+  def update(self, engine_id, boots, engine_time):
+    self.engine_id = engine_id
+    self.boots = boots
+    self.engine_time = engine_time
+    self.synced = time.time()
+
+  def now(self):
+    return self.boots, self.engine_time + int(time.time() - self.synced)
+
+
+class Community(object):
+  """SNMPv1/v2c community based security."""
+
+  def __init__(self, community, version=2):
+    self.community = community.encode('utf-8')
+    self.version = version - 1
+
+  async def agent(self, engine, address, timeout, retries):
+    return None
+
+  def encode(self, request_id, pdu, agent):
+    return _sequence(_integer(self.version), _octets(self.community), pdu)
+
+  def decode(self, data, agent):
+    _, start, end = _read(data, 0)
+    fields = _children(data, start, end)
+    if len(fields) != 3:
+      raise snmp.SnmpError('Malformed SNMP message')
+    return decode_pdu(data, fields[2])
+
+  def report(self, engine, address, varbinds):
+    raise snmp.SnmpError('Unexpected report from %s' % address[0])
+
+
+class Usm(object):
+  """SNMPv3 user based security."""
+
+  def __init__(self, user, sec_level='noAuthNoPriv', auth_proto=None,
+      auth=None, priv_proto=None, priv=None, context=''):
+    self.user = (user or '').encode('utf-8')
+    self.flags = _SECURITY_FLAGS[sec_level]
+    self.auth_proto = auth_proto
+    self.auth = auth
+    self.priv_proto = priv_proto
+    self.priv = priv
+    self.context = context.encode('utf-8')
+    if self.flags & _PRIV and priv_proto != 'AES':
+      raise snmp.SnmpError('Unsupported SNMPv3 privacy %s' % priv_proto)
+    self.salt = itertools.count(random.getrandbits(63))
+
+  async def agent(self, engine, address, timeout, retries):
+    agent = engine.agents.get(address, None)
+    if agent is not None:
+      return agent
+
+    # Discover the engine id, boots and time of the device
+    agent = Agent()
+    discovery = Usm('')
+    request_id = engine.next_id()
+    message = discovery.encode(request_id, encode_pdu(GET, request_id, []), agent)
+    await engine.send(address, request_id, message,
+        lambda data: discovery.decode(data, agent), timeout, retries)
+    if not agent.engine_id:
+      raise snmp.SnmpError('SNMPv3 discovery failed for %s' % address[0])
+    engine.agents[address] = agent
+    return agent
+
+  def _crypt(self, data, engine_id, boots, engine_time, salt, encrypt):
+    key = localize_key(self.auth_proto, self.priv, engine_id)
+    iv = struct.pack('>II', boots, engine_time) + salt
+    return _aes(key, iv, data, encrypt)
+
+  def _digest(self, engine_id, message):
+    key = localize_key(self.auth_proto, self.auth, engine_id)
+    return hmac.new(
+        key, message, _HASHES[self.auth_proto]).digest()[:_DIGEST_SIZE]
+
+  def encode(self, request_id, pdu, agent):
+    boots, engine_time = agent.now()
+    scoped = _sequence(_octets(agent.engine_id), _octets(self.context), pdu)
+    salt = b''
+    if self.flags & _PRIV:
+      salt = struct.pack('>Q', next(self.salt) & 0xffffffffffffffff)
+      scoped = _octets(self._crypt(
+          scoped, agent.engine_id, boots, engine_time, salt, True))
+
+    global_data = _sequence(_integer(request_id), _integer(MAX_MESSAGE_SIZE),
+        _octets(bytes([self.flags | _REPORTABLE])), _integer(3))
+    before_digest = (_octets(agent.engine_id) + _integer(boots) +
+        _integer(engine_time) + _octets(self.user))
+    digest = _octets(b'\x00' * (_DIGEST_SIZE if self.flags & _AUTH else 0))
+    params = _sequence(before_digest, digest, _octets(salt))
+    security = _octets(params)
+    body = _integer(3) + global_data + security + scoped
+    message = _tlv(_SEQUENCE, body)
+    if not self.flags & _AUTH:
+      return message
+
+    # The digest is calculated over the message with the digest zeroed,
+    # then put in place of the zeroes
+    header = len(message) - len(body)
+    security_header = len(security) - len(params)
+    params_header = len(params) - len(before_digest + digest + _octets(salt))
+    offset = (header + len(_integer(3)) + len(global_data) + security_header +
+        params_header + len(before_digest) + len(digest) - _DIGEST_SIZE)
+    return (message[:offset] + self._digest(agent.engine_id, message) +
+        message[offset + _DIGEST_SIZE:])
+
+  def decode(self, data, agent):
+    _, start, end = _read(data, 0)
+    fields = _children(data, start, end)
+    if len(fields) != 4:
+      raise snmp.SnmpError('Malformed SNMPv3 message')
+    global_data = _children(data, fields[1][1], fields[1][2])
+    _, start, end = global_data[2]
+    flags = data[start] if end > start else 0
+    params = _children(data, *_read(data, fields[2][1])[1:])
+    engine_id = bytes(data[params[0][1]:params[0][2]])
+    boots = _int(data, params[1])
+    engine_time = _int(data, params[2])
+
+    if flags & _AUTH:
+      if not self.flags & _AUTH:
+        raise snmp.SnmpError('Unexpected authenticated SNMPv3 message')
+      _, start, end = params[4]
+      zeroed = data[:start] + b'\x00' * (end - start) + data[end:]
+      if not hmac.compare_digest(
+          self._digest(engine_id, zeroed), bytes(data[start:end])):
+        raise snmp.SnmpError('Wrong digest in SNMPv3 message')
+    agent.update(engine_id, boots, engine_time)
+
+    scoped = fields[3]
+    if flags & _PRIV:
+      _, start, end = scoped
+      salt = bytes(data[params[5][1]:params[5][2]])
+      data = self._crypt(
+          bytes(data[start:end]), engine_id, boots, engine_time, salt, False)
+      scoped = _read(data, 0)
+    pdu = _children(data, scoped[1], scoped[2])[2]
+    return decode_pdu(data, pdu)
+
+  def report(self, engine, address, varbinds):
+    oid = varbinds[0][0] if varbinds else None
+    if oid == _NOT_IN_TIME_WINDOW:
+      # The clock was updated from the report, try again
+      return
+    if oid == _UNKNOWN_ENGINE_ID:
+      engine.agents.pop(address, None)
+      return
+    raise snmp.SnmpError('SNMPv3 request rejected by %s: %s' % (
+        address[0], _REPORTS.get(oid, oid)))
+
+
+class Engine(asyncio.DatagramProtocol):
+  """SNMP requests multiplexed over a single UDP socket."""
+
+  def __init__(self):
+    super(Engine, self).__init__()
+    self.transport = None
+    # request id -> (future, address, decode function)
+    self.pending = {}
+    # address -> Agent
+    self.agents = {}
+    self.request_ids = itertools.count(random.randint(1, 1 << 30))
+
+  def connection_made(self, transport):
+    self.transport = transport
+    sock = transport.get_extra_info('socket')
+    try:
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+    except (AttributeError, OSError):
+      pass
+
+  def datagram_received(self, data, address):
+    try:
+      request_id = message_id(data)
+    except (snmp.Error, IndexError) as e:
+      logging.debug('Dropping malformed SNMP message from %s', address[0])
+      return
+    pending = self.pending.get(request_id, None)
+    if pending is None:
+      return
+    future, expected, decode = pending
+    if future.done() or address[:2] != expected:
+      return
+    try:
+      future.set_result(decode(data))
+    except (snmp.Error, IndexError, ValueError) as e:
+      # Could be spoofed, keep waiting for the real response
+      logging.debug('Dropping bad SNMP response from %s: %s', address[0], e)
+
+  def error_received(self, exc):
+    logging.debug('SNMP socket error: %s', exc)
+
+  def next_id(self):
+    return next(self.request_ids) & 0x7fffffff or 1
+
+  async def send(self, address, request_id, message, decode, timeout,
+      retries):
+    """Send message until decode(response) returns, or retries run out."""
+    future = asyncio.get_event_loop().create_future()
+    self.pending[request_id] = (future, address, decode)
+    try:
+      for attempt in range(retries + 1):
+        self.transport.sendto(message, address)
+        try:
+          return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+          continue
+      raise snmp.TimeoutError('Timeout talking to %s' % address[0])
+    finally:
+      del self.pending[request_id]
+
+  async def request(self, address, security, tag, oids, non_repeaters=0,
+      max_repetitions=0, timeout=TIMEOUT, retries=RETRIES):
+    """Returns the varbinds of the response, see decode_pdu."""
+    # An SNMPv3 request may have to be resent once after a report
+    for attempt in range(2):
+      agent = await security.agent(self, address, timeout, retries)
+      request_id = self.next_id()
+      message = security.encode(request_id, encode_pdu(
+          tag, request_id, oids, non_repeaters, max_repetitions), agent)
+      response = await self.send(address, request_id, message,
+          lambda data: security.decode(data, agent), timeout, retries)
+      if response[0] != REPORT:
+        break
+      security.report(self, address, response[4])
+    else:
+      raise snmp.SnmpError('%s keeps rejecting our requests' % address[0])
+
+    _, _, error_status, error_index, varbinds = response
+    if error_status:
+      raise snmp.SnmpError('SNMP error %s from %s at index %d' % (
+          _ERRORS.get(error_status, error_status), address[0], error_index))
+    return varbinds
+
+  async def get(self, address, security, oids, **kwargs):
+    return await self.request(address, security, GET, oids, **kwargs)
+
+  async def getbulk(self, address, security, oids, max_repetitions,
+      non_repeaters=0, **kwargs):
+    return await self.request(address, security, GETBULK, oids,
+        non_repeaters, max_repetitions, **kwargs)
+
+
+_ENGINES = {}
+
+
+async def get_engine():
+  """Returns the Engine of the running loop, started on first use."""
+  loop = asyncio.get_event_loop()
+  engine = _ENGINES.get(loop, None)
+  if engine is None:
+    engine = _ENGINES[loop] = Engine()
+    engine.ready = loop.create_task(loop.create_datagram_endpoint(
+        lambda: engine, local_addr=('0.0.0.0', 0)))
+  await engine.ready
+  return engine
+
+
+def security(target, vlan=None):
+  """Returns the security to use for a snmp.SnmpTarget."""
+  if target.version == 3:
+    context = ('vlan-%s' % vlan) if vlan else ''
+    return Usm(target.user, target.sec_level, target.auth_proto, target.auth,
+        target.priv_proto, target.priv, context)
+  return Community(target._community(vlan), target.version)
+
+
+async def walk(target, oid, vlan=None):
+  """Like snmp.SnmpTarget.walk."""
+  ret, failed = await walk_table(target, [oid], vlan)
+  if oid in failed:
+    raise failed[oid]
+  return ret
+
+
+async def walk_table(target, oids, vlan=None):
+  """Like snmp.SnmpTarget.walk_table."""
+  ret = {}
+  failed = {}
+  if not oids:
+    return ret, failed
+  engine = await get_engine()
+  address = (target.ip, target.port)
+  context = security(target, vlan)
+  bulk_key = target._bulk_key(vlan)
+  max_size = min(snmp.BULK_SIZES.size(bulk_key), target._max_size)
+  resume = collections.OrderedDict((oid, oid) for oid in oids)
+  while resume:
+    columns = list(resume)
+    failed = target._check_deadline(columns)
+    if failed:
+      return ret, failed
+    try:
+      varbinds = await engine.getbulk(address, context, list(resume.values()),
+          max(1, max_size // len(columns)))
+    except snmp.TimeoutError:
+      # Same workaround for dropped fragmented responses as in SnmpTarget
+      max_size = snmp.BULK_SIZES.timeout(bulk_key, max_size)
+      if max_size is None:
+        for column in columns:
+          failed[column] = snmp.TimeoutError(
+              'Timeout getting %s from %s' % (column, target.host))
+        return ret, failed
+      continue
+    except snmp.Error as e:
+      for column in columns:
+        failed[column] = e
+      return ret, failed
+    done = snmp._collect_table(
+        columns, [(oid, result, oid) for oid, result in varbinds], ret, resume)
+    for column in done:
+      del resume[column]
+  snmp.BULK_SIZES.success(bulk_key, max_size)
+  target._record(vlan, ret, oids)
+  return ret, failed
+
+
+async def get(target, oid):
+  """Like snmp.SnmpTarget.get."""
+  return await get_many(target, [oid])
+
+
+async def get_many(target, oids, vlan=None):
+  """Like snmp.SnmpTarget.get_many."""
+  engine = await get_engine()
+  varbinds = await engine.get((target.ip, target.port),
+      security(target, vlan), oids, timeout=5, retries=2)
+  ret = dict(varbinds)
+  target._record(vlan, ret)
+  return ret
+
+
+async def model(target):
+  """Like snmp.SnmpTarget.model."""
+  key = target._model_key()
+  cached = snmp.MODEL_CACHE.lookup(key) if target.capture is None else None
+  if cached is not None:
+    model, booted = cached
+    if not snmp.MODEL_CACHE.rebooted(
+        key, booted, snmp.uptime(await get_many(target, [snmp.SYSUPTIME_OID]))):
+      return model
+
+  oids = snmp.MODEL_OIDS + [snmp.SYSUPTIME_OID]
+  try:
+    results = await get_many(target, oids)
+  except snmp.SnmpError:
+    # SNMPv1 fails the whole request if any of the OIDs is missing
+    results = {}
+    for oid in oids:
+      results.update(await get(target, oid))
+      if snmp.pick_model(results):
+        break
+  model = snmp.pick_model(results)
+  if not model:
+    raise snmp.NoModelOid('No model OID contained a model')
+  snmp.MODEL_CACHE.store(key, model, snmp.uptime(results))
+  return model
+
+
+async def vlans(target):
+  """Like snmp.SnmpTarget.vlans."""
+  oids = await walk(target, snmp.VLAN_OID)
+  try:
+    return set(int(x.split('.')[-1]) for x in oids)
+  except ValueError as e:
+    logging.info('ValueError while parsing VLAN for %s: %s', target.host, e)
+    return []
@@ -0,0 +1,175 @@
+import asyncio
+import binascii
+import mock
+import unittest
+
+import asyncsnmp
+import snmp
+
+
+TABLE = [
+    ('.1.3.6.1.2.1.1.1.0', asyncsnmp._octets(b'Test switch')),
+    ('.1.3.6.1.2.1.1.3.0', asyncsnmp._tlv(0x43, b'\x01\x86\xa0')),
+    ('.1.3.6.1.2.1.2.2.1.2.1', asyncsnmp._octets(b'Gi0/1')),
+    ('.1.3.6.1.2.1.2.2.1.2.2', asyncsnmp._octets(b'Gi0/2')),
+    ('.1.3.6.1.2.1.2.2.1.10.1', asyncsnmp._tlv(0x41, b'\x00\xff\xff\xff\xff')),
+    ('.1.3.6.1.2.1.2.2.1.10.2', asyncsnmp._tlv(0x41, b'\x05')),
+    ('.1.3.6.1.2.1.2.2.1.11.1', asyncsnmp._integer(-3)),
+]
+
+
+class FakeAgent(asyncio.DatagramProtocol):
+  """SNMPv2c agent serving TABLE."""
+
+  def __init__(self):
+    self.requests = []
+
+  def connection_made(self, transport):
+    self.transport = transport
+
+  def datagram_received(self, data, address):
+    _, start, end = asyncsnmp._read(data, 0)
+    version, community, pdu = asyncsnmp._children(data, start, end)
+    tag, request_id, non_repeaters, max_repetitions, varbinds = (
+        asyncsnmp.decode_pdu(data, pdu))
+    self.requests.append((tag, max_repetitions))
+    if tag == asyncsnmp.GET:
+      rows = []
+      for oid, _ in varbinds:
+        rows.extend([x for x in TABLE if x[0] == oid] or [(oid, b'\x80\x00')])
+    else:
+      # The next max_repetitions rows of every column
+      keys = [tuple(int(y) for y in x[0][1:].split('.')) for x in TABLE]
+      columns = [tuple(int(y) for y in x[0][1:].split('.')) for x in varbinds]
+      rows = []
+      for i in range(max_repetitions):
+        for j, column in enumerate(columns):
+          following = [(k, x) for k, x in zip(keys, TABLE) if k > column]
+          if following:
+            columns[j], row = following[0]
+          else:
+            row = ('.1.3.6.1.6', b'\x82\x00')
+          rows.append(row)
+    response = b''.join(asyncsnmp._sequence(asyncsnmp._oid(oid), value)
+        for oid, value in rows)
+    pdu = asyncsnmp._tlv(asyncsnmp.RESPONSE, asyncsnmp._integer(request_id) +
+        asyncsnmp._integer(0) + asyncsnmp._integer(0) +
+        asyncsnmp._sequence(response))
+    self.transport.sendto(asyncsnmp._sequence(asyncsnmp._integer(1),
+        asyncsnmp._octets(b'public'), pdu), address)
+
+
+class TestAsyncSnmp(unittest.TestCase):
+
+  def setUp(self):
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self.loop)
+    self.addCleanup(self.loop.close)
+    self.agent = FakeAgent()
+    transport, _ = self.loop.run_until_complete(
+        self.loop.create_datagram_endpoint(
+          lambda: self.agent, local_addr=('127.0.0.1', 0)))
+    self.addCleanup(self.closeTransports, transport)
+    self.target = snmp.SnmpTarget(
+        'test1', '127.0.0.1', 1234, 'access', version=2, community='public',
+        port=transport.get_extra_info('sockname')[1])
+
+  def closeTransports(self, transport):
+    transport.close()
+    engine = asyncsnmp._ENGINES.pop(self.loop, None)
+    if engine is not None and engine.transport is not None:
+      engine.transport.close()
+    self.loop.run_until_complete(asyncio.sleep(0))
+
+  def testLocalizeKey(self):
+    # RFC 3414 A.3
+    engine_id = binascii.unhexlify('000000000000000000000002')
+    self.assertEqual(binascii.hexlify(asyncsnmp.localize_key(
+        'MD5', 'maplesyrup', engine_id)), b'526f5eed9fcce26f8964c2930787d82b')
+    self.assertEqual(binascii.hexlify(asyncsnmp.localize_key(
+        'SHA', 'maplesyrup', engine_id)),
+        b'6695febc9288e36282235fc7151f128497b38f3f')
+
+  def testOid(self):
+    for oid in ('.1.3.6.1.2.1.1.1.0', '.1.3.6.1.4.1.9.9.46.1.3.1.1.2.4095',
+                '.2.100.3'):
+      _, start, end = asyncsnmp._read(asyncsnmp._oid(oid), 0)
+      self.assertEqual(
+          asyncsnmp._decode_oid(asyncsnmp._oid(oid)[start:end]), oid)
+
+  def testWalk(self):
+    self.target._max_size = 2
+    results = self.loop.run_until_complete(
+        asyncsnmp.walk(self.target, '.1.3.6.1.2.1.2.2.1'))
+    self.assertEqual(results, {
+      '.1.3.6.1.2.1.2.2.1.2.1': snmp.ResultTuple('Gi0/1', 'OCTETSTR'),
+      '.1.3.6.1.2.1.2.2.1.2.2': snmp.ResultTuple('Gi0/2', 'OCTETSTR'),
+      '.1.3.6.1.2.1.2.2.1.10.1': snmp.ResultTuple('4294967295', 'COUNTER'),
+      '.1.3.6.1.2.1.2.2.1.10.2': snmp.ResultTuple('5', 'COUNTER'),
+      '.1.3.6.1.2.1.2.2.1.11.1': snmp.ResultTuple('-3', 'INTEGER'),
+    })
+    self.assertEqual(self.agent.requests, [(asyncsnmp.GETBULK, 2)] * 3)
+
+  def testWalkTable(self):
+    self.target._max_size = 4
+    results, failed = self.loop.run_until_complete(asyncsnmp.walk_table(
+        self.target, ['.1.3.6.1.2.1.2.2.1.2', '.1.3.6.1.2.1.2.2.1.10']))
+    self.assertEqual(sorted(results), [
+      '.1.3.6.1.2.1.2.2.1.10.1', '.1.3.6.1.2.1.2.2.1.10.2',
+      '.1.3.6.1.2.1.2.2.1.2.1', '.1.3.6.1.2.1.2.2.1.2.2'])
+    self.assertEqual(failed, {})
+    # Both columns in one request, the second one sees both have ended
+    self.assertEqual(self.agent.requests, [(asyncsnmp.GETBULK, 2)] * 2)
+
+  def testWalkInParallel(self):
+    walks = [asyncsnmp.walk(self.target, '.1.3.6.1.2.1.2.2.1.%d' % x)
+             for x in (2, 10, 11)]
+    results = self.loop.run_until_complete(asyncio.gather(*walks))
+    self.assertEqual([len(x) for x in results], [2, 2, 1])
+
+  @mock.patch('snmp.MODEL_CACHE', snmp.ModelCache())
+  def testModel(self):
+    self.assertEqual(
+        self.loop.run_until_complete(asyncsnmp.model(self.target)),
+        'Test switch')
+    # Cached, only sysUpTime is checked
+    self.assertEqual(
+        self.loop.run_until_complete(asyncsnmp.model(self.target)),
+        'Test switch')
+    self.assertEqual(self.agent.requests, [(asyncsnmp.GET, 0)] * 2)
+
+  def testTimeout(self):
+    self.agent.datagram_received = lambda data, address: None
+    engine = self.loop.run_until_complete(asyncsnmp.get_engine())
+    request = engine.get(('127.0.0.1', self.target.port),
+        asyncsnmp.security(self.target), ['.1.3.6.1.2.1.1.1.0'],
+        timeout=0.01, retries=1)
+    with self.assertRaises(snmp.TimeoutError):
+      self.loop.run_until_complete(request)
+    self.assertEqual(engine.pending, {})
+
+  def testUsmDigest(self):
+    usm = asyncsnmp.Usm('user', 'authNoPriv', 'SHA', 'maplesyrup')
+    agent = asyncsnmp.Agent(b'\x80\x00\x00\x09\x03', 5, 1000)
+    pdu = asyncsnmp.encode_pdu(asyncsnmp.GET, 42, ['.1.3.6.1.2.1.1.1.0'])
+    message = usm.encode(42, pdu, agent)
+    self.assertEqual(asyncsnmp.message_id(message), 42)
+
+    received = asyncsnmp.Agent()
+    tag, request_id, _, _, varbinds = usm.decode(message, received)
+    self.assertEqual((tag, request_id), (asyncsnmp.GET, 42))
+    self.assertEqual(varbinds[0][0], '.1.3.6.1.2.1.1.1.0')
+    self.assertEqual(received.engine_id, agent.engine_id)
+    self.assertEqual(received.boots, 5)
+
+    tampered = message[:-1] + b'\x01'
+    with self.assertRaises(snmp.SnmpError):
+      usm.decode(tampered, received)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
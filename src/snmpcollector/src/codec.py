@@ -0,0 +1,594 @@
+"""Wire codecs used to move Actions between the pipeline stages.
+
+The codec used for outgoing messages is selected with 'codec' in the 'mq'
+section of the configuration. Every message is tagged with the content type
+of the codec that produced it so stages running different codecs (or older
+versions that only know pickle) can still talk to each other.
+"""
+import array
+import collections
+import pickle
+import struct
+import sys
+
+import actions
+import columnar
+import snmp
+
+
+if sys.version_info[0] == 3:
+  text_type = str
+  integer_types = (int, )
+else:
+  text_type = unicode
+  integer_types = (int, long)
+
+
+class Error(Exception):
+  """Base error class for this module."""
+
+
+class EncodeError(Error):
+  """The object cannot be represented by the codec."""
+
+
+class DecodeError(Error):
+  """The message could not be decoded."""
+
+
+class PickleCodec(object):
+  """The original codec, can serialize anything but is big and slow."""
+
+  name = 'pickle'
+  content_type = 'application/x-python-pickle'
+
+  def encode(self, action, run):
+    #return pickle.dumps((action, run), protocol=pickle.HIGHEST_PROTOCOL)
+    return pickle.dumps((action, run), protocol=2)
+
+  def decode(self, body):
+    return pickle.loads(body)
+
+
+# Value tags used by the compact codec
+_NONE = b'N'
+_TRUE = b'T'
+_FALSE = b'F'
+_INT = b'i'
+_FLOAT = b'f'
+_STRING = b's'
+_STRING_REF = b'r'
+_BYTES = b'b'
+_LIST = b'l'
+_TUPLE = b't'
+_DICT = b'd'
+_ACTION = b'A'
+_TARGET = b'G'
+_RESULT = b'R'
+_ENTRY = b'E'
+_STATISTICS = b'S'
+_RUN = b'U'
+
+# Kinds of result tables
+_TABLE_RESULT = b'R'
+_TABLE_ENTRY = b'E'
+_TABLE_GENERIC = b'V'
+
+# Kinds of result table columns
+_COLUMN_TEXT = b's'
+_COLUMN_BYTES = b'b'
+_COLUMN_INT = b'i'
+_COLUMN_GENERIC = b'v'
+_COLUMN_MIXED = b'm'
+
+_DOUBLE = struct.Struct('>d')
+
+
+_COLUMN_KINDS = {text_type: _COLUMN_TEXT, bytes: _COLUMN_BYTES}
+for _type in integer_types:
+  _COLUMN_KINDS[_type] = _COLUMN_INT
+
+
+# Integer array types from smallest to largest with their value range
+_TYPECODES = collections.OrderedDict()
+for _typecode in ('B', 'b', 'H', 'h', 'I', 'i', 'q', 'Q'):
+  _bits = array.array(_typecode).itemsize * 8
+  if _typecode.isupper():
+    _TYPECODES[_typecode] = (0, 2**_bits - 1)
+  else:
+    _TYPECODES[_typecode] = (-2**(_bits - 1), 2**(_bits - 1) - 1)
+
+
+def _integer_typecode(values):
+  """Returns the smallest array typecode that can hold all values."""
+  low = min(values) if values else 0
+  high = max(values) if values else 0
+  for typecode, (type_low, type_high) in _TYPECODES.items():
+    if type_low <= low and high <= type_high:
+      return typecode
+  return None
+
+
+class _Encoder(object):
+
+  def __init__(self, codec):
+    self.codec = codec
+    self.buf = bytearray()
+    self.strings = {}
+
+  def varint(self, n):
+    buf = self.buf
+    while n > 0x7f:
+      buf.append((n & 0x7f) | 0x80)
+      n >>= 7
+    buf.append(n)
+
+  def raw_string(self, value):
+    data = value.encode('utf-8')
+    self.varint(len(data))
+    self.buf.extend(data)
+
+  def string(self, value):
+    ref = self.strings.get(value, None)
+    if ref is not None:
+      self.buf.extend(_STRING_REF)
+      self.varint(ref)
+      return
+    self.strings[value] = len(self.strings)
+    self.buf.extend(_STRING)
+    self.raw_string(value)
+
+  def value(self, value):
+    buf = self.buf
+    if value is None:
+      buf.extend(_NONE)
+    elif value is True:
+      buf.extend(_TRUE)
+    elif value is False:
+      buf.extend(_FALSE)
+    elif isinstance(value, snmp.ResultTuple):
+      buf.extend(_RESULT)
+      self.value(value.value)
+      self.value(value.type)
+    elif isinstance(value, actions.AnnotatedResultEntry):
+      buf.extend(_ENTRY)
+      for field in value:
+        self.value(field)
+    elif isinstance(value, actions.Statistics):
+      buf.extend(_STATISTICS)
+      self.sequence(value)
+    elif isinstance(value, actions.RunInformation):
+      buf.extend(_RUN)
+      self.sequence(value)
+    elif isinstance(value, bytes):
+      buf.extend(_BYTES)
+      self.varint(len(value))
+      buf.extend(value)
+    elif isinstance(value, text_type):
+      self.string(value)
+    elif isinstance(value, integer_types):
+      buf.extend(_INT)
+      # Zigzag encoding to keep small negative numbers small
+      self.varint(value * 2 if value >= 0 else -value * 2 - 1)
+    elif isinstance(value, float):
+      buf.extend(_FLOAT)
+      buf.extend(_DOUBLE.pack(value))
+    elif isinstance(value, tuple):
+      buf.extend(_TUPLE)
+      self.sequence(value)
+    elif isinstance(value, list):
+      buf.extend(_LIST)
+      self.sequence(value)
+    elif isinstance(value, dict):
+      buf.extend(_DICT)
+      self.varint(len(value))
+      for key, item in value.items():
+        self.value(key)
+        self.value(item)
+    elif isinstance(value, snmp.SnmpTarget):
+      buf.extend(_TARGET)
+      self.sequence([getattr(value, x) for x in CompactCodec.TARGET_FIELDS])
+    elif isinstance(value, actions.Action):
+      self.action(value)
+    else:
+      raise EncodeError('Cannot encode %s' % type(value).__name__)
+
+  def sequence(self, values):
+    self.varint(len(values))
+    for value in values:
+      self.value(value)
+
+  def action(self, action):
+    schema_id = self.codec.schema_ids.get(type(action), None)
+    if schema_id is None:
+      raise EncodeError('No schema for action %s' % type(action).__name__)
+    self.buf.extend(_ACTION)
+    self.varint(schema_id)
+    _, fields = self.codec.schemas[schema_id]
+    for field in fields:
+      if field in CompactCodec.TABLE_FIELDS:
+        self.table(getattr(action, field))
+      else:
+        self.value(getattr(action, field))
+
+  def table(self, results):
+    """Encode a result map column by column.
+
+    OIDs are split into their parent and last component, or their column
+    and index for columnar.Results, the parents are shared between all rows
+    in the same table. Columns with few distinct
+    values (types, contexts, MIB names) are dictionary encoded and the rest
+    are stored as flat arrays.
+    """
+    kind = _TABLE_GENERIC
+    entries = list(results.items())
+    if all(type(k) is tuple and len(k) == 2 and
+           isinstance(k[0], text_type) and '.' in k[0] for k, _ in entries):
+      if all(isinstance(v, snmp.ResultTuple) for _, v in entries):
+        kind = _TABLE_RESULT
+      elif all(isinstance(v, actions.AnnotatedResultEntry) for _, v in entries):
+        kind = _TABLE_ENTRY
+
+    self.buf.extend(kind)
+    if kind == _TABLE_GENERIC:
+      self.value(results)
+      return
+
+    self.varint(len(entries))
+    if kind == _TABLE_RESULT and isinstance(results, columnar.Results):
+      # Keep the columns, their indexes can be several components
+      split = [results.split(k) or k[0].rpartition('.')[::2]
+               for k, _ in entries]
+    else:
+      split = [k[0].rpartition('.')[::2] for k, _ in entries]
+    self.dictionary_column([x[0] for x in split])
+    self.column([x[1] for x in split])
+    self.dictionary_column([k[1] for k, _ in entries])
+
+    if kind == _TABLE_RESULT:
+      data = [v for _, v in entries]
+    else:
+      data = [v.data for _, v in entries]
+    self.dictionary_column([x.type for x in data])
+    self.column([x.value for x in data])
+    if kind == _TABLE_ENTRY:
+      self.dictionary_column([x.mib for _, x in entries])
+      self.dictionary_column([x.obj for _, x in entries])
+      self.column([x.index for _, x in entries])
+      self.column([x.labels for _, x in entries])
+
+  def array(self, values):
+    """Write a flat array of integers using the smallest possible type."""
+    typecode = _integer_typecode(values)
+    self.buf.extend(typecode.encode('ascii'))
+    data = array.array(typecode, values)
+    if sys.byteorder != 'little':
+      data.byteswap()
+    data = data.tobytes() if hasattr(data, 'tobytes') else data.tostring()
+    self.varint(len(data))
+    self.buf.extend(data)
+
+  def dictionary_column(self, values):
+    ids = {}
+    distinct = []
+    for value in values:
+      if value not in ids:
+        ids[value] = len(distinct)
+        distinct.append(value)
+    self.sequence(distinct)
+    self.array([ids[x] for x in values])
+
+  def column(self, values):
+    kinds = [_COLUMN_KINDS.get(type(x), _COLUMN_GENERIC) for x in values]
+    present = set(kinds)
+    if len(present) > 1:
+      self.buf.extend(_COLUMN_MIXED)
+      self.array([ord(x) for x in kinds])
+      for kind in sorted(present):
+        self.typed_column(kind, [v for k, v in zip(kinds, values) if k == kind])
+    else:
+      self.typed_column(present.pop() if present else _COLUMN_GENERIC, values)
+
+  def typed_column(self, kind, values):
+    if kind == _COLUMN_INT:
+      if _integer_typecode(values) is not None:
+        self.buf.extend(kind)
+        self.array(values)
+        return
+      kind = _COLUMN_GENERIC
+
+    self.buf.extend(kind)
+    if kind == _COLUMN_TEXT:
+      self.array([len(x) for x in values])
+      data = u''.join(values).encode('utf-8', 'surrogatepass')
+      self.varint(len(data))
+      self.buf.extend(data)
+    elif kind == _COLUMN_BYTES:
+      self.array([len(x) for x in values])
+      data = b''.join(values)
+      self.varint(len(data))
+      self.buf.extend(data)
+    else:
+      for value in values:
+        self.value(value)
+
+
+class _Decoder(object):
+
+  def __init__(self, codec, body, offset):
+    self.codec = codec
+    self.body = bytearray(body)
+    self.offset = offset
+    self.strings = []
+    self.tags = {
+        ord(_NONE): lambda: None,
+        ord(_TRUE): lambda: True,
+        ord(_FALSE): lambda: False,
+        ord(_INT): self._int,
+        ord(_FLOAT): self._float,
+        ord(_STRING): self._string,
+        ord(_STRING_REF): lambda: self.strings[self.varint()],
+        ord(_BYTES): self._bytes,
+        ord(_LIST): self.sequence,
+        ord(_TUPLE): lambda: tuple(self.sequence()),
+        ord(_DICT): self._dict,
+        ord(_ACTION): self.action,
+        ord(_TARGET): lambda: snmp.SnmpTarget(*self.sequence()),
+        ord(_RESULT): lambda: snmp.ResultTuple(self.value(), self.value()),
+        ord(_ENTRY): lambda: actions.AnnotatedResultEntry(*self.sequence(5)),
+        ord(_STATISTICS): lambda: actions.Statistics(*self.sequence()),
+        ord(_RUN): lambda: actions.RunInformation(*self.sequence()),
+    }
+
+  def byte(self):
+    value = self.body[self.offset]
+    self.offset += 1
+    return value
+
+  def varint(self):
+    body = self.body
+    shift = 0
+    result = 0
+    while True:
+      b = body[self.offset]
+      self.offset += 1
+      result |= (b & 0x7f) << shift
+      if not b & 0x80:
+        return result
+      shift += 7
+
+  def raw_bytes(self):
+    length = self.varint()
+    data = bytes(self.body[self.offset:self.offset + length])
+    if len(data) != length:
+      raise DecodeError('Truncated message')
+    self.offset += length
+    return data
+
+  def raw_string(self):
+    return self.raw_bytes().decode('utf-8')
+
+  def value(self):
+    tag = self.byte()
+    decoder = self.tags.get(tag, None)
+    if decoder is None:
+      raise DecodeError('Unknown tag %r at offset %d' % (tag, self.offset - 1))
+    return decoder()
+
+  def sequence(self, count=None):
+    if count is None:
+      count = self.varint()
+    return [self.value() for _ in range(count)]
+
+  def _int(self):
+    value = self.varint()
+    return value >> 1 if not value & 1 else -(value >> 1) - 1
+
+  def _float(self):
+    value, = _DOUBLE.unpack_from(self.body, self.offset)
+    self.offset += _DOUBLE.size
+    return value
+
+  def _string(self):
+    value = self.raw_string()
+    self.strings.append(value)
+    return value
+
+  def _bytes(self):
+    return self.raw_bytes()
+
+  def _dict(self):
+    count = self.varint()
+    result = {}
+    for _ in range(count):
+      key = self.value()
+      result[key] = self.value()
+    return result
+
+  def action(self):
+    schema_id = self.varint()
+    if schema_id >= len(self.codec.schemas):
+      raise DecodeError('Unknown action schema %d' % schema_id)
+    cls, fields = self.codec.schemas[schema_id]
+    action = cls.__new__(cls)
+    for field in fields:
+      if field in CompactCodec.TABLE_FIELDS:
+        setattr(action, field, self.table())
+      else:
+        setattr(action, field, self.value())
+    return action
+
+  def table(self):
+    kind = self.byte()
+    if kind == ord(_TABLE_GENERIC):
+      return self.value()
+
+    count = self.varint()
+    parents = self.dictionary_column(count)
+    lasts = self.column(count)
+    contexts = self.dictionary_column(count)
+    types = self.dictionary_column(count)
+    values = self.column(count)
+    if kind == ord(_TABLE_RESULT):
+      results = columnar.Results()
+      for row in zip(parents, lasts, contexts, values, types):
+        results.append(*row)
+      return results
+    if kind == ord(_TABLE_ENTRY):
+      mibs = self.dictionary_column(count)
+      objs = self.dictionary_column(count)
+      indexes = self.column(count)
+      labels = self.column(count)
+      results = columnar.AnnotatedResults()
+      for row in zip(parents, lasts, contexts, values, types, mibs, objs,
+                     indexes, labels):
+        results.append_entry(row[0] + '.' + row[1], *row[2:])
+      return results
+    raise DecodeError('Unknown table kind %r' % kind)
+
+  def array(self):
+    typecode = chr(self.byte())
+    if typecode not in _TYPECODES:
+      raise DecodeError('Unknown array type %r' % typecode)
+    data = array.array(typecode)
+    raw = self.raw_bytes()
+    if hasattr(data, 'frombytes'):
+      data.frombytes(raw)
+    else:
+      data.fromstring(raw)
+    if sys.byteorder != 'little':
+      data.byteswap()
+    return data
+
+  def dictionary_column(self, count):
+    distinct = self.sequence()
+    ids = self.array()
+    if len(ids) != count:
+      raise DecodeError('Column has %d rows, expected %d' % (len(ids), count))
+    return [distinct[x] for x in ids]
+
+  def column(self, count):
+    kind = self.byte()
+    if kind != ord(_COLUMN_MIXED):
+      return self.typed_column(kind, count)
+    kinds = self.array()
+    columns = {}
+    for kind in sorted(set(kinds)):
+      columns[kind] = iter(self.typed_column(self.byte(), kinds.count(kind)))
+    return [next(columns[x]) for x in kinds]
+
+  def typed_column(self, kind, count):
+    if kind == ord(_COLUMN_INT):
+      values = self.array().tolist()
+    elif kind in (ord(_COLUMN_TEXT), ord(_COLUMN_BYTES)):
+      lengths = self.array()
+      data = self.raw_bytes()
+      if kind == ord(_COLUMN_TEXT):
+        data = data.decode('utf-8', 'surrogatepass')
+      values = []
+      offset = 0
+      for length in lengths:
+        values.append(data[offset:offset + length])
+        offset += length
+    elif kind == ord(_COLUMN_GENERIC):
+      values = self.sequence(count)
+    else:
+      raise DecodeError('Unknown column kind %r' % kind)
+    if len(values) != count:
+      raise DecodeError('Column has %d rows, expected %d' % (
+        len(values), count))
+    return values
+
+
+class CompactCodec(object):
+  """Schema based binary codec.
+
+  Strings are interned per message (types, MIB names, labels) and result
+  maps are stored column by column with shared OID prefixes, see table().
+  They are decoded to columnar.Results and columnar.AnnotatedResults.
+  The schemas may only ever be appended to, the position in the list is
+  the identifier used on the wire. Changing the format of existing schemas
+  requires bumping VERSION.
+  """
+
+  name = 'compact'
+  content_type = 'application/x-dhmon-compact'
+  MAGIC = b'DHC'
+  VERSION = 1
+
+  TARGET_FIELDS = (
+      'host', 'ip', 'timestamp', 'layer', 'version', 'community', 'user',
+      'auth_proto', 'auth', 'priv_proto', 'priv', 'sec_level', 'port')
+
+  TABLE_FIELDS = frozenset(['results', 'references'])
+
+  schemas = (
+      (actions.Trigger, ()),
+      (actions.SnmpWalk, ('target', )),
+      (actions.Summary, ('timestamp', 'targets')),
+      (actions.Result, ('target', 'results', 'stats')),
+      (actions.AnnotatedResult, ('target', 'results', 'stats')),
+      (actions.ResultChunk, ('target', 'results', 'stats', 'sequence',
+                             'final', 'references')),
+      (actions.AnnotatedResultChunk, ('target', 'results', 'stats',
+                                      'sequence', 'final', 'references')),
+      (actions.SnmpWalkBatch, ('targets', )),
+  )
+
+  schema_ids = dict((cls, i) for i, (cls, _) in enumerate(schemas))
+
+  def encode(self, action, run):
+    encoder = _Encoder(self)
+    encoder.buf.extend(self.MAGIC)
+    encoder.buf.append(self.VERSION)
+    encoder.action(action)
+    encoder.value(run)
+    return bytes(encoder.buf)
+
+  def decode(self, body):
+    header = len(self.MAGIC) + 1
+    if bytes(body[:len(self.MAGIC)]) != self.MAGIC:
+      raise DecodeError('Not a compact message')
+    if bytearray(body[len(self.MAGIC):header])[0] != self.VERSION:
+      raise DecodeError('Unsupported compact codec version %d' % (
+        bytearray(body)[len(self.MAGIC)]))
+    decoder = _Decoder(self, body, header)
+    try:
+      return decoder.value(), decoder.value()
+    except (IndexError, UnicodeDecodeError) as e:
+      raise DecodeError('Malformed message: %s' % e)
+
+
+CODECS = dict((x.name, x) for x in (PickleCodec(), CompactCodec()))
+CONTENT_TYPES = dict((x.content_type, x) for x in CODECS.values())
+
+DEFAULT_CODEC = 'pickle'
+
+
+def encode(action, run, name=None):
+  """Encode an (action, run) pair.
+
+  Returns:
+    (content_type, body) tuple. Falls back to pickle if the selected codec is
+    unable to represent the action.
+  """
+  codec = CODECS.get(name or DEFAULT_CODEC, None)
+  if codec is None:
+    raise Error('Unknown codec %s' % name)
+  try:
+    return codec.content_type, codec.encode(action, run)
+  except EncodeError:
+    codec = CODECS[DEFAULT_CODEC]
+    return codec.content_type, codec.encode(action, run)
+
+
+def decode(content_type, body):
+  """Decode a message produced by encode().
+
+  Messages without a content type are from stages that predate the codecs
+  and are always pickled.
+  """
+  codec = CONTENT_TYPES.get(content_type or PickleCodec.content_type, None)
+  if codec is None:
+    raise DecodeError('Unknown content type %s' % content_type)
+  return codec.decode(body)
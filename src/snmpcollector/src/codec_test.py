@@ -0,0 +1,146 @@
+import unittest
+
+import actions
+import codec
+import columnar
+import snmp
+
+
+class UnknownAction(actions.Action):
+  pass
+
+
+class TestCodec(unittest.TestCase):
+
+  def setUp(self):
+    self.target = snmp.SnmpTarget(
+        'test1', '1.2.3.4', 1234.5, 'dist',
+        version=3, user='user', auth_proto='SHA', auth='secret',
+        priv_proto='AES', priv='secret2', sec_level='authPriv', port=1161)
+    self.run = actions.RunInformation(
+        'vlan', debug={'a': [1, -2, 3.5]}, trace={'Trigger': (1.5, 2.5)})
+
+  def roundTrip(self, action, name='compact'):
+    content_type, body = codec.encode(action, self.run, name)
+    decoded_action, decoded_run = codec.decode(content_type, body)
+    self.assertEqual(decoded_action, action)
+    self.assertEqual(decoded_run, self.run)
+    return content_type, body
+
+  def testSimpleActions(self):
+    self.roundTrip(actions.Trigger())
+    self.roundTrip(actions.SnmpWalk(self.target))
+    self.roundTrip(actions.SnmpWalkBatch([self.target, self.target]))
+    self.roundTrip(actions.Summary(1234.5, 10))
+
+  def testResult(self):
+    results = {
+      ('.1.3.6.1.2.1.2.2.1.2.1', None): snmp.ResultTuple('Gi1/0/1', 'OCTETSTR'),
+      ('.1.3.6.1.2.1.2.2.1.2.10', None): snmp.ResultTuple(b'\xff', 'OCTETSTR'),
+      ('.1.3.6.1.2.1.2.2.1.7.1', None): snmp.ResultTuple(1, 'INTEGER'),
+      ('.1.3.6.1.2.1.31.1.1.1.6.1', None): snmp.ResultTuple(
+        2**64 - 1, 'COUNTER64'),
+      ('.1.3.6.1.2.1.17.4.3.1.2.1', '100'): snmp.ResultTuple('3', 'INTEGER'),
+    }
+    content_type, _ = self.roundTrip(
+        actions.Result(self.target, results,
+                       actions.Statistics(1, 2, {None: 0.5}, True)))
+    self.assertEqual(content_type, codec.CompactCodec.content_type)
+
+  def testAnnotatedResult(self):
+    results = {
+      ('.1.2.3.1', None): actions.AnnotatedResultEntry(
+        snmp.ResultTuple('1', 'INTEGER'), 'DUMMY-MIB', 'testInteger1', '1',
+        {'interface': 'Gi1/0/1'}),
+      ('.1.2.3.2', '100'): actions.AnnotatedResultEntry(
+        snmp.ResultTuple('NaN', 'ANNOTATED'), 'DUMMY-MIB', 'testInteger1',
+        '2', {'vlan': '100', 'hex': b'6162'}),
+    }
+    self.roundTrip(
+        actions.AnnotatedResult(self.target, results, actions.Statistics(0, 0)))
+
+  def testResultChunk(self):
+    results = {
+      ('.1.3.6.1.2.1.2.2.1.7.1', None): snmp.ResultTuple(1, 'INTEGER'),
+    }
+    references = {
+      ('.1.3.6.1.2.1.2.2.1.2.1', None): snmp.ResultTuple('Gi1/0/1', 'OCTETSTR'),
+    }
+    self.roundTrip(actions.ResultChunk(
+      self.target, results, actions.Statistics(0, 0), 3, True, references))
+    self.roundTrip(actions.AnnotatedResultChunk(
+      self.target, {}, actions.Statistics(0, 0), 0, False))
+
+  def testColumnar(self):
+    results = columnar.Results({
+      ('.1.3.6.1.2.1.2.2.1.2.1', None): snmp.ResultTuple('Gi1/0/1', 'OCTETSTR'),
+      ('.1.3.6.1.2.1.2.2.1.2.2', 10): snmp.ResultTuple('Gi1/0/2', 'OCTETSTR'),
+    })
+    content_type, body = codec.encode(actions.Result(
+        self.target, results, actions.Statistics()), self.run, 'compact')
+    action, _ = codec.decode(content_type, body)
+    self.assertIsInstance(action.results, columnar.Results)
+    self.assertEqual(action.results, results)
+
+    # Indexes of several components stay in their column
+    fdb = '.1.3.6.1.2.1.17.4.3.1.2'
+    results = columnar.Results()
+    results.add_all({
+      fdb + '.0.1.2.3.4.5': snmp.ResultTuple('3', 'INTEGER'),
+      fdb + '.12.34.56.78.90.1': snmp.ResultTuple('3', 'INTEGER'),
+    }, None, [fdb])
+    content_type, body = codec.encode(actions.Result(
+        self.target, results, actions.Statistics()), self.run, 'compact')
+    action, _ = codec.decode(content_type, body)
+    self.assertEqual(list(action.results.columns), [(fdb, None)])
+    self.assertEqual(action.results, results)
+
+    annotated = columnar.AnnotatedResults()
+    annotated.append_entry('.1.3.6.1.2.1.2.2.1.2.1', None, 'Gi1/0/1',
+        'OCTETSTR', 'IF-MIB', 'ifDescr', '1', {'interface': 'Gi1/0/1'})
+    content_type, body = codec.encode(actions.AnnotatedResult(
+        self.target, annotated, actions.Statistics()), self.run, 'compact')
+    action, _ = codec.decode(content_type, body)
+    self.assertEqual(list(action.results.columns), [
+      ('.1.3.6.1.2.1.2.2.1.2', None)])
+    self.assertEqual(action.results, annotated)
+
+  def testEmptyResult(self):
+    self.roundTrip(
+        actions.Result(self.target, {}, actions.Statistics(0, 0)))
+
+  def testSmallerThanPickle(self):
+    results = dict(
+        (('.1.3.6.1.2.1.2.2.1.%d.%d' % (col, i), None),
+         snmp.ResultTuple('GigabitEthernet1/0/%d' % i, 'OCTETSTR'))
+        for col in range(2, 22) for i in range(1, 49))
+    action = actions.Result(self.target, results, actions.Statistics(0, 0))
+    _, compact = self.roundTrip(action)
+    _, pickled = self.roundTrip(action, 'pickle')
+    self.assertLess(len(compact), len(pickled) / 2)
+
+  def testFallback(self):
+    content_type, _ = codec.encode(UnknownAction(), self.run, 'compact')
+    self.assertEqual(content_type, codec.PickleCodec.content_type)
+
+  def testLegacy(self):
+    # Messages from stages without codec support have no content type
+    _, body = codec.encode(actions.Trigger(), self.run, 'pickle')
+    action, run = codec.decode(None, body)
+    self.assertEqual(action, actions.Trigger())
+
+  def testBadMessage(self):
+    with self.assertRaises(codec.DecodeError):
+      codec.decode(codec.CompactCodec.content_type, b'DHC\x01A\x63')
+    with self.assertRaises(codec.DecodeError):
+      codec.decode(codec.CompactCodec.content_type, b'DHC\x99')
+    with self.assertRaises(codec.DecodeError):
+      codec.decode('application/json', b'{}')
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
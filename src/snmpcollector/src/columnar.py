@@ -0,0 +1,412 @@
+"""Poll results stored column by column.
+
+A walk returns a few columns (ifDescr, ifInOctets, ...) with one row per
+port. Keeping a key tuple and a ResultTuple per row is most of the memory
+and garbage collection time of every stage, so Results keeps one Column per
+column OID and context instead, with the indexes and values in lists and
+the type shared by the rows when they all have the same.
+
+Results and AnnotatedResults behave like the {(oid, context): row} dicts
+they replace, the rows are created when asked for. Code that cares about
+speed uses the columns directly.
+"""
+try:
+  from collections.abc import ItemsView, MutableMapping, ValuesView
+except ImportError:
+  from collections import ItemsView, MutableMapping, ValuesView
+
+import actions
+import snmp
+
+
+class Column(object):
+  """The rows of one column OID in one context."""
+
+  __slots__ = ('indexes', 'values', 'types', '_positions')
+
+  def __init__(self, indexes=None, values=None, types=None):
+    self.indexes = indexes if indexes is not None else []
+    self.values = values if values is not None else []
+    # One type shared by all rows, or a list with the type of every row
+    self.types = types
+    # index -> row, built when the first row is looked up
+    self._positions = None
+
+  def __getstate__(self):
+    return dict((x, getattr(self, x)) for x in Column.__slots__
+                if x != '_positions')
+
+  def __setstate__(self, state):
+    self._positions = None
+    for name, value in state.items():
+      setattr(self, name, value)
+
+  def __len__(self):
+    return len(self.indexes)
+
+  def type(self, row):
+    types = self.types
+    return types[row] if isinstance(types, list) else types
+
+  def position(self, index):
+    """Returns the row of index, or None."""
+    if self._positions is None:
+      self._positions = dict(
+          (x, row) for row, x in enumerate(self.indexes))
+    return self._positions.get(index, None)
+
+  def _set_type(self, row, type):
+    types = self.types
+    if isinstance(types, list):
+      types[row] = type
+    elif types != type:
+      if len(self.indexes) == 1:
+        self.types = type
+      else:
+        self.types = [types] * len(self.indexes)
+        self.types[row] = type
+
+  def append(self, index, value, type):
+    row = len(self.indexes)
+    self.indexes.append(index)
+    self.values.append(value)
+    if row == 0:
+      self.types = type
+    elif isinstance(self.types, list):
+      self.types.append(type)
+    elif self.types != type:
+      self.types = [self.types] * row + [type]
+    if self._positions is not None:
+      self._positions[index] = row
+    return row
+
+  def copy(self):
+    copy = self.__class__.__new__(self.__class__)
+    state = self.__getstate__()
+    for name in ('indexes', 'values', 'labels'):
+      if name in state:
+        state[name] = list(state[name])
+    if isinstance(state['types'], list):
+      state['types'] = list(state['types'])
+    copy.__setstate__(state)
+    return copy
+
+  def delete(self, row):
+    del self.indexes[row]
+    del self.values[row]
+    if isinstance(self.types, list):
+      del self.types[row]
+    self._positions = None
+
+
+class AnnotatedColumn(Column):
+  """Column of annotated rows, all of the same MIB object."""
+
+  __slots__ = ('mib', 'obj', 'labels')
+
+  def __init__(self, mib, obj):
+    super(AnnotatedColumn, self).__init__()
+    self.mib = mib
+    self.obj = obj
+    self.labels = []
+
+  def __getstate__(self):
+    state = super(AnnotatedColumn, self).__getstate__()
+    for name in AnnotatedColumn.__slots__:
+      state[name] = getattr(self, name)
+    return state
+
+  def delete(self, row):
+    super(AnnotatedColumn, self).delete(row)
+    del self.labels[row]
+
+
+class _Items(ItemsView):
+
+  def __iter__(self):
+    return self._mapping._rows()
+
+
+class _Values(ValuesView):
+
+  def __iter__(self):
+    for _, value in self._mapping._rows():
+      yield value
+
+
+class Results(MutableMapping):
+  """{(oid, context): snmp.ResultTuple} kept as Columns.
+
+  The OIDs are split into their column and index, see add_all. Rows added
+  one by one go to the column they are under, or are split into their
+  parent and last component like in the compact codec. Keys that are not
+  (oid, context) are kept as they are.
+  """
+
+  def __init__(self, rows=()):
+    # (column, context) -> Column
+    self.columns = {}
+    self.other = {}
+    self._len = 0
+    self.update(rows)
+
+  def _split(self, key, value):
+    """Returns the (column, context) and index to add key at, or None."""
+    if type(key) is not tuple or len(key) != 2:
+      return None
+    oid = key[0]
+    if not isinstance(oid, str) or '.' not in oid:
+      return None
+    position = oid.rfind('.')
+    while position > 0:
+      if (oid[:position], key[1]) in self.columns:
+        return (oid[:position], key[1]), oid[position + 1:]
+      position = oid.rfind('.', 0, position)
+    parent, _, index = oid.rpartition('.')
+    return (parent, key[1]), index
+
+  def _locate(self, key):
+    """Returns the (column key, row) of key, or None."""
+    if type(key) is not tuple or len(key) != 2:
+      return None
+    oid, context = key
+    if not isinstance(oid, str):
+      return None
+    # The index can be any number of components
+    position = oid.rfind('.')
+    while position > 0:
+      column = self.columns.get((oid[:position], context), None)
+      if column is not None:
+        row = column.position(oid[position + 1:])
+        if row is not None:
+          return (oid[:position], context), row
+      position = oid.rfind('.', 0, position)
+    return None
+
+  def _find(self, key):
+    """Returns the (column, row) of key, or None."""
+    found = self._locate(key)
+    return None if found is None else (self.columns[found[0]], found[1])
+
+  def split(self, key):
+    """Returns the (column, index) the OID of key is stored as, or None."""
+    found = self._locate(key)
+    if found is None:
+      return None
+    column_key, row = found
+    return column_key[0], self.columns[column_key].indexes[row]
+
+  def _row(self, column, row):
+    return snmp.ResultTuple(column.values[row], column.type(row))
+
+  def _new_column(self, value):
+    return Column()
+
+  def _append(self, column, index, value):
+    column.append(index, value.value, value.type)
+
+  def _replace(self, column, row, value):
+    column.values[row] = value.value
+    column._set_type(row, value.type)
+
+  def _rows(self):
+    for (parent, context), column in self.columns.items():
+      for row, index in enumerate(column.indexes):
+        yield (parent + '.' + index, context), self._row(column, row)
+    for item in self.other.items():
+      yield item
+
+  def __len__(self):
+    return self._len + len(self.other)
+
+  def __iter__(self):
+    for (parent, context), column in self.columns.items():
+      for index in column.indexes:
+        yield parent + '.' + index, context
+    for key in self.other:
+      yield key
+
+  def __getitem__(self, key):
+    found = self._find(key)
+    if found is None:
+      return self.other[key]
+    return self._row(*found)
+
+  def __setitem__(self, key, value):
+    found = self._find(key)
+    if found is not None:
+      self._replace(found[0], found[1], value)
+      return
+    split = None if key in self.other else self._split(key, value)
+    if split is None:
+      self.other[key] = value
+      return
+    column_key, index = split
+    column = self.columns.get(column_key, None)
+    if column is None:
+      column = self.columns[column_key] = self._new_column(value)
+    self._append(column, index, value)
+    self._len += 1
+
+  def __delitem__(self, key):
+    found = self._find(key)
+    if found is None:
+      del self.other[key]
+      return
+    column, row = found
+    column.delete(row)
+    self._len -= 1
+    if not column.indexes:
+      self.columns = dict(
+          (k, v) for k, v in self.columns.items() if v is not column)
+
+  def items(self):
+    return _Items(self)
+
+  def values(self):
+    return _Values(self)
+
+  def update(self, *args, **kwargs):
+    if len(args) == 1 and type(args[0]) is type(self) and not kwargs:
+      self._merge(args[0])
+    else:
+      super(Results, self).update(*args, **kwargs)
+
+  def _merge(self, other):
+    # Columns that may hold rows of one another, see _disjoint
+    parents = set((x[0] + '.', x[1]) for x in self.columns)
+    for key, column in other.columns.items():
+      if key not in self.columns and self._disjoint(key, parents):
+        self.columns[key] = column.copy()
+        self._len += len(column)
+        continue
+      for row in range(len(column)):
+        self[(key[0] + '.' + column.indexes[row], key[1])] = other._row(
+            column, row)
+    for key, value in other.other.items():
+      self[key] = value
+
+  def _disjoint(self, key, parents):
+    """Returns True if no column has rows the column key could have."""
+    oid, context = key
+    if (oid + '.', context) in parents:
+      return False
+    position = oid.rfind('.')
+    while position > 0:
+      if (oid[:position + 1], context) in parents:
+        return False
+      position = oid.rfind('.', 0, position)
+    prefix = oid + '.'
+    return not any(x[1] == context and x[0].startswith(prefix)
+                   for x in parents)
+
+  def append(self, parent, index, context, value, type):
+    """Add the row of parent.index, which must not be in results yet."""
+    column = self.columns.get((parent, context), None)
+    if column is None:
+      column = self.columns[(parent, context)] = Column()
+    column.append(index, value, type)
+    self._len += 1
+
+  def add_all(self, results, context, roots=()):
+    """Add {oid: snmp.ResultTuple}, like returned by SnmpTarget.walk.
+
+    roots are the OIDs that were walked. The rows under each of them are
+    keyed on it with the rest of the OID as the index, so a column indexed
+    by several components (a MAC address in the FDB, an interface and an
+    IP address in ipNetToMedia) is one Column. A table walked as a whole
+    is one Column too, the annotator tells its columns apart with the
+    MIBs. The rest are split into their parent and last component. The
+    OIDs must not be in results yet.
+    """
+    # The most specific root the rows are under
+    roots = sorted(roots, key=len, reverse=True)
+    for oid, result in results.items():
+      for root in roots:
+        if oid.startswith(root + '.'):
+          parent, index = root, oid[len(root) + 1:]
+          break
+      else:
+        parent, _, index = oid.rpartition('.')
+      self.append(parent, index, context, result.value, result.type)
+
+  def subtree(self, oid, context):
+    """Returns the rows under oid in context, keyed on the same columns."""
+    ret = type(self)()
+    prefix = oid + '.'
+    for key, column in self.columns.items():
+      if key[1] != context:
+        continue
+      if key[0] == oid or key[0].startswith(prefix):
+        ret.columns[key] = column.copy()
+        ret._len += len(column)
+      elif oid.startswith(key[0] + '.'):
+        for row, index in enumerate(column.indexes):
+          if (key[0] + '.' + index).startswith(prefix):
+            ret[(key[0] + '.' + index, context)] = self._row(column, row)
+    for key, value in self.other.items():
+      if (type(key) is tuple and len(key) == 2 and key[1] == context and
+          isinstance(key[0], str) and key[0].startswith(prefix)):
+        ret[key] = value
+    return ret
+
+  def __repr__(self):
+    return '%s(%r)' % (type(self).__name__, dict(self.items()))
+
+
+class AnnotatedResults(Results):
+  """{(oid, vlan): actions.AnnotatedResultEntry} kept as AnnotatedColumns.
+
+  The columns are the MIB objects and the rows are keyed on their index.
+  """
+
+  def _split(self, key, value):
+    if type(key) is not tuple or len(key) != 2:
+      return None
+    oid = key[0]
+    index = value.index
+    if (not isinstance(oid, str) or not index or
+        not oid.endswith('.' + index)):
+      return None
+    column_key = (oid[:-len(index) - 1], key[1])
+    column = self.columns.get(column_key, None)
+    if column is not None and (column.mib, column.obj) != (
+        value.mib, value.obj):
+      return None
+    return column_key, index
+
+  def _row(self, column, row):
+    return actions.AnnotatedResultEntry(
+        snmp.ResultTuple(column.values[row], column.type(row)),
+        column.mib, column.obj, column.indexes[row], column.labels[row])
+
+  def _new_column(self, value):
+    return AnnotatedColumn(value.mib, value.obj)
+
+  def _append(self, column, index, value):
+    column.append(index, value.data.value, value.data.type)
+    column.labels.append(value.labels)
+
+  def _replace(self, column, row, value):
+    column.values[row] = value.data.value
+    column._set_type(row, value.data.type)
+    column.labels[row] = value.labels
+
+  def append_entry(self, oid, vlan, value, type, mib, obj, index, labels):
+    """Add an actions.AnnotatedResultEntry without creating it.
+
+    The OID must not be in results yet.
+    """
+    column = None
+    if index and oid.endswith('.' + index):
+      column_key = (oid[:-len(index) - 1], vlan)
+      column = self.columns.get(column_key, None)
+      if column is None:
+        column = self.columns[column_key] = AnnotatedColumn(mib, obj)
+    if column is None or (column.mib, column.obj) != (mib, obj):
+      self.other[(oid, vlan)] = actions.AnnotatedResultEntry(
+          snmp.ResultTuple(value, type), mib, obj, index, labels)
+      return
+    column.append(index, value, type)
+    column.labels.append(labels)
+    self._len += 1
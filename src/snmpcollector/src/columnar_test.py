@@ -0,0 +1,176 @@
+import pickle
+import unittest
+
+import actions
+import columnar
+import snmp
+
+
+ROWS = {
+  ('.1.3.6.1.2.1.2.2.1.2.1', None): snmp.ResultTuple('Gi0/1', 'OCTETSTR'),
+  ('.1.3.6.1.2.1.2.2.1.2.2', None): snmp.ResultTuple('Gi0/2', 'OCTETSTR'),
+  ('.1.3.6.1.2.1.2.2.1.10.1', None): snmp.ResultTuple('10', 'COUNTER'),
+  ('.1.3.6.1.2.1.2.2.1.10.1', 10): snmp.ResultTuple('20', 'COUNTER'),
+}
+
+
+class TestResults(unittest.TestCase):
+
+  def testDict(self):
+    results = columnar.Results(ROWS)
+    self.assertEqual(results, ROWS)
+    self.assertEqual(len(results), 4)
+    self.assertEqual(set(results.columns), set([
+      ('.1.3.6.1.2.1.2.2.1.2', None), ('.1.3.6.1.2.1.2.2.1.10', None),
+      ('.1.3.6.1.2.1.2.2.1.10', 10)]))
+    self.assertEqual(results[('.1.3.6.1.2.1.2.2.1.10.1', 10)].value, '20')
+    self.assertNotIn(('.1.3.6.1.2.1.2.2.1.10.2', None), results)
+
+    results[('.1.3.6.1.2.1.2.2.1.2.2', None)] = snmp.ResultTuple(
+        'Gi0/2', 'ANNOTATED')
+    del results[('.1.3.6.1.2.1.2.2.1.10.1', 10)]
+    results['other'] = 1
+    self.assertEqual(dict(results.items()), {
+      ('.1.3.6.1.2.1.2.2.1.2.1', None): snmp.ResultTuple('Gi0/1', 'OCTETSTR'),
+      ('.1.3.6.1.2.1.2.2.1.2.2', None): snmp.ResultTuple('Gi0/2', 'ANNOTATED'),
+      ('.1.3.6.1.2.1.2.2.1.10.1', None): snmp.ResultTuple('10', 'COUNTER'),
+      'other': 1})
+    self.assertEqual(len(results), 4)
+
+  def testSharedType(self):
+    results = columnar.Results()
+    results.add_all({
+      '.1.3.6.1.2.1.2.2.1.10.1': snmp.ResultTuple('10', 'COUNTER'),
+      '.1.3.6.1.2.1.2.2.1.10.2': snmp.ResultTuple('20', 'COUNTER')}, None)
+    column = results.columns[('.1.3.6.1.2.1.2.2.1.10', None)]
+    self.assertEqual(column.types, 'COUNTER')
+    results.append('.1.3.6.1.2.1.2.2.1.10', '3', None, None, 'NOSUCHINSTANCE')
+    self.assertEqual(column.types, ['COUNTER', 'COUNTER', 'NOSUCHINSTANCE'])
+
+  def testMerge(self):
+    results = columnar.Results(
+        dict(x for x in ROWS.items() if x[0][1] is None))
+    update = columnar.Results(dict(x for x in ROWS.items() if x[0][1]))
+    update[('.1.3.6.1.2.1.2.2.1.2.1', None)] = snmp.ResultTuple(
+        'Gi0/1 new', 'OCTETSTR')
+    results.update(update)
+    self.assertEqual(len(results), 4)
+    self.assertEqual(results[('.1.3.6.1.2.1.2.2.1.2.1', None)].value,
+                     'Gi0/1 new')
+    # The columns are copied, not shared
+    update[('.1.3.6.1.2.1.2.2.1.10.1', 10)] = snmp.ResultTuple('0', 'COUNTER')
+    self.assertEqual(results[('.1.3.6.1.2.1.2.2.1.10.1', 10)].value, '20')
+
+  def testColumns(self):
+    fdb = '.1.3.6.1.2.1.17.4.3.1.2'
+    results = columnar.Results()
+    results.add_all({
+      fdb + '.0.1.2.3.4.5': snmp.ResultTuple('3', 'INTEGER'),
+      fdb + '.0.1.2.3.4.6': snmp.ResultTuple('3', 'INTEGER'),
+      fdb + '.12.34.56.78.90.1': snmp.ResultTuple('3', 'INTEGER'),
+    }, 10, [fdb])
+    # The columns of ifTable, the ifType of a single row
+    results.add_all(dict(
+      (k[0], v) for k, v in ROWS.items() if k[1] is None), None,
+      ['.1.3.6.1.2.1.2.2.1.2', '.1.3.6.1.2.1.2.2.1.10'])
+    results.add_all({
+      '.1.3.6.1.2.1.2.2.1.3.1': snmp.ResultTuple('6', 'INTEGER'),
+    }, None, ['.1.3.6.1.2.1.2.2.1.3'])
+    # Indexes of different lengths in one column
+    results.add_all({
+      '.1.3.6.1.4.1.9.9.23.1.2.1.1.6.1': snmp.ResultTuple('sw1', 'OCTETSTR'),
+      '.1.3.6.1.4.1.9.9.23.1.2.1.1.6.1.2': snmp.ResultTuple('sw2', 'OCTETSTR'),
+    }, None, ['.1.3.6.1.4.1.9.9.23.1.2.1.1.6'])
+    # Not under a walked OID, split into the parent and last component
+    results.add_all({
+      '.1.3.6.1.2.1.1.5.0': snmp.ResultTuple('sw', 'OCTETSTR'),
+    }, None, [fdb])
+    self.assertEqual(set(results.columns), set([
+      (fdb, 10),
+      ('.1.3.6.1.2.1.2.2.1.2', None), ('.1.3.6.1.2.1.2.2.1.10', None),
+      ('.1.3.6.1.2.1.2.2.1.3', None),
+      ('.1.3.6.1.4.1.9.9.23.1.2.1.1.6', None),
+      ('.1.3.6.1.2.1.1.5', None)]))
+    self.assertEqual(results.columns[(fdb, 10)].indexes,
+                     ['0.1.2.3.4.5', '0.1.2.3.4.6', '12.34.56.78.90.1'])
+    self.assertEqual(
+        results.columns[('.1.3.6.1.4.1.9.9.23.1.2.1.1.6', None)].indexes,
+        ['1', '1.2'])
+    self.assertEqual(len(results), 10)
+    self.assertEqual(results[(fdb + '.12.34.56.78.90.1', 10)].value, '3')
+    self.assertEqual(results.split((fdb + '.12.34.56.78.90.1', 10)),
+                     (fdb, '12.34.56.78.90.1'))
+
+    # Rows added one by one go to their column
+    results[(fdb + '.12.1.2.3.4.6', 10)] = snmp.ResultTuple('2', 'INTEGER')
+    self.assertEqual(len(results.columns[(fdb, 10)]), 4)
+    del results[(fdb + '.0.1.2.3.4.6', 10)]
+    self.assertNotIn((fdb + '.0.1.2.3.4.6', 10), results)
+
+    subtree = results.subtree(fdb, 10)
+    self.assertEqual(list(subtree.columns), [(fdb, 10)])
+    self.assertEqual(len(subtree), 3)
+
+  def testTable(self):
+    # A table walked as a whole is one Column, keyed on the walked OID
+    results = columnar.Results()
+    results.add_all(dict(
+      (k[0], v) for k, v in ROWS.items() if k[1] is None), None,
+      ['.1.3.6.1.2.1.2.2', '.1.3.6.1.2.1.2.2.1.10'])
+    self.assertEqual(set(results.columns), set([
+      ('.1.3.6.1.2.1.2.2', None), ('.1.3.6.1.2.1.2.2.1.10', None)]))
+    self.assertEqual(results.columns[('.1.3.6.1.2.1.2.2', None)].indexes,
+                     ['1.2.1', '1.2.2'])
+    self.assertEqual(results.split(('.1.3.6.1.2.1.2.2.1.2.2', None)),
+                     ('.1.3.6.1.2.1.2.2', '1.2.2'))
+
+  def testMergeColumns(self):
+    fdb = '.1.3.6.1.2.1.17.4.3.1.2'
+    results = columnar.Results({
+      (fdb + '.0.1.2.3.4.5', None): snmp.ResultTuple('3', 'INTEGER')})
+    update = columnar.Results()
+    update.add_all({
+      fdb + '.0.1.2.3.4.5': snmp.ResultTuple('2', 'INTEGER'),
+      fdb + '.12.34.56.78.90.1': snmp.ResultTuple('3', 'INTEGER'),
+    }, None, [fdb])
+    results.update(update)
+    # The row in another column is replaced, not added again
+    self.assertEqual(len(results), 2)
+    self.assertEqual(results[(fdb + '.0.1.2.3.4.5', None)].value, '2')
+
+  def testPickle(self):
+    results = columnar.Results(ROWS)
+    results[('.1.3.6.1.2.1.2.2.1.2.1', None)]
+    self.assertEqual(pickle.loads(pickle.dumps(results, 2)), ROWS)
+
+
+class TestAnnotatedResults(unittest.TestCase):
+
+  def testColumns(self):
+    results = columnar.AnnotatedResults()
+    results.append_entry('.1.3.6.1.2.1.17.4.3.1.2.0.1.2.3.4.5', 10, '3',
+        'INTEGER', 'BRIDGE-MIB', 'dot1dTpFdbPort', '0.1.2.3.4.5', {})
+    results.append_entry('.1.3.6.1.2.1.17.4.3.1.2.0.1.2.3.4.6', 10, '4',
+        'INTEGER', 'BRIDGE-MIB', 'dot1dTpFdbPort', '0.1.2.3.4.6', {})
+    # Not ending in the index, kept as it is
+    results.append_entry('.1.3.6.1.2.1.1.5', None, 'sw', 'OCTETSTR',
+        'SNMPv2-MIB', 'sysName', None, {})
+    self.assertEqual(list(results.columns), [
+      ('.1.3.6.1.2.1.17.4.3.1.2', 10)])
+    self.assertEqual(len(results), 3)
+    entry = results[('.1.3.6.1.2.1.17.4.3.1.2.0.1.2.3.4.6', 10)]
+    self.assertEqual(entry, actions.AnnotatedResultEntry(
+        snmp.ResultTuple('4', 'INTEGER'), 'BRIDGE-MIB', 'dot1dTpFdbPort',
+        '0.1.2.3.4.6', {}))
+    self.assertEqual(
+        results[('.1.3.6.1.2.1.1.5', None)].data.value, 'sw')
+    self.assertEqual(
+        pickle.loads(pickle.dumps(results, 2)), dict(results.items()))
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -1,4 +1,5 @@
 #!/usr/bin/env pypy3
+import asyncio
 import http.server
 import socketserver
 import base64
@@ -9,13 +10,19 @@ import time
 
 import actions
 import collections
+import columnar
 import config
+import snmp
 import stage
 
 
 HTTP_MAIN_PORT = 13100
 HTTP_SNMP_PORT = 13101
 
+# Rounds a streamed poll may take before its missing chunks are given up on,
+# polls of slow devices can still be running when the next rounds start
+CHUNK_ROUNDS = 3
+
 ROUND_LATENCY = prometheus_client.Summary(
     'snmp_round_latency_seconds',
     'Time it takes to complete one round of SNMP polls')
@@ -42,6 +49,29 @@ COMPLETED_POLL_COUNT = prometheus_client.Counter(
 SUCCESSFUL_POLL_COUNT = prometheus_client.Counter(
     'snmp_successful_poll_count', 'Number of successful polls', ('device',))
 
+PARTIAL_POLL_COUNT = prometheus_client.Counter(
+    'snmp_partial_poll_count',
+    'Number of polls that ran out of time budget', ('device',))
+
+# Polls take anything from milliseconds to minutes depending on the device
+TRACE_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_LATENCY = prometheus_client.Histogram(
+    'snmp_stage_latency_seconds',
+    'Time spent executing an action in a pipeline stage', ('stage', 'layer'),
+    buckets=TRACE_BUCKETS)
+
+CONTEXT_LATENCY = prometheus_client.Histogram(
+    'snmp_context_latency_seconds',
+    'Time it takes to poll one SNMP context of a device',
+    ('layer', 'context'), buckets=TRACE_BUCKETS)
+
+QUEUE_LATENCY = prometheus_client.Histogram(
+    'snmp_queue_latency_seconds',
+    'Time an action spent queued before reaching a pipeline stage',
+    ('stage', 'layer'), buckets=TRACE_BUCKETS)
+
 
 class Exporter(object):
 
@@ -54,50 +84,147 @@ class Exporter(object):
     self.metrics = {}
     self.prometheus_output = []
     self.copy_lock = threading.Lock()
+    # Guards summaries, seen_targets, chunks and rounds, the actions are run
+    # from several threads with --concurrency
+    self.rounds_lock = threading.Lock()
     self.summaries = {}
     self.seen_targets = collections.defaultdict(set)
+    # (host, layer, timestamp) ->
+    #   [received, total, oids, errors, timeouts, contexts]
+    self.chunks = {}
+    # Timestamps of the last CHUNK_ROUNDS rounds
+    self.rounds = []
 
   def do_summary(self, run, timestamp, targets):
-    self.summaries[timestamp] = targets
-    SUMMARIES_COUNT.set(len(self.summaries))
+    with self.rounds_lock:
+      self.summaries[timestamp] = targets
+      SUMMARIES_COUNT.set(len(self.summaries))
+      self.rounds = sorted(self.rounds + [timestamp])[-CHUNK_ROUNDS:]
+      if len(self.rounds) < CHUNK_ROUNDS:
+        return
+      # The missing chunks of polls that many rounds old are not coming
+      # anymore
+      lost = [x for x in self.chunks if x[2] < self.rounds[0]]
+      for key in lost:
+        del self.chunks[key]
+    if lost:
+      logging.warning('Gave up on %d polls missing chunks', len(lost))
 
   def do_result(self, run, target, results, stats):
+    self._observe_trace(run, target.layer)
     with self.copy_lock:
       self._save(target, results)
 
-    OID_COUNT.labels(target.host).set(len(results))
+    ERROR_COUNT.labels(target.host).inc(stats.errors)
+    TIMEOUT_COUNT.labels(target.host).inc(stats.timeouts)
+    self._complete(target, len(results), stats.errors, stats.timeouts,
+                   stats.contexts, stats.partial)
+
+    logging.debug('Export completed for %d metrics for %s',
+        len(results), target.host)
+
+  def do_result_chunk(self, run, target, results, stats, sequence, final,
+      references):
+    self._observe_trace(run, target.layer)
+    with self.copy_lock:
+      self._save(target, results)
+
+    ERROR_COUNT.labels(target.host).inc(stats.errors)
+    TIMEOUT_COUNT.labels(target.host).inc(stats.timeouts)
+
+    # Chunks may arrive in any order, the poll is complete when all chunks
+    # up to and including the final one have been seen.
+    key = (target.host, target.layer, target.timestamp)
+    with self.rounds_lock:
+      chunks = self.chunks.get(key, None)
+      if chunks is None:
+        chunks = self.chunks[key] = [0, None, 0, 0, 0, {}, False]
+      chunks[0] += 1
+      if final:
+        chunks[1] = sequence + 1
+      chunks[2] += len(results)
+      chunks[3] += stats.errors
+      chunks[4] += stats.timeouts
+      # Sum up the time spent on all the subtrees of a context
+      for context, seconds in stats.contexts.items():
+        chunks[5][context] = chunks[5].get(context, 0) + seconds
+      chunks[6] = chunks[6] or stats.partial
+      received, total, oids, errors, timeouts, contexts, partial = chunks
+      if received == total:
+        del self.chunks[key]
+
+    logging.debug('Export completed for %d metrics for %s (chunk %d)',
+        len(results), target.host, sequence)
+
+    if received != total:
+      return
+    self._complete(target, oids, errors, timeouts, contexts, partial)
+
+  def _observe_trace(self, run, layer):
+    """Record where the time went for the run that produced this result.
+
+    Every stage adds (start, end) of its execution to the trace. The time
+    between one stage finishing and the next one starting is time spent
+    in the queue between them, the exporter is the last stage so it
+    is accounted as starting now.
+    """
+    if not run or not run.trace:
+      return
+    now = time.time()
+    previous_end = None
+    for start, end, name in sorted(
+        (start, end, name) for name, (start, end) in run.trace.items()):
+      # Stages run on different hosts, ignore small clock differences
+      if previous_end is not None:
+        QUEUE_LATENCY.labels(name, layer).observe(max(start - previous_end, 0))
+      STAGE_LATENCY.labels(name, layer).observe(max(end - start, 0))
+      previous_end = end
+    QUEUE_LATENCY.labels('Exporter', layer).observe(max(now - previous_end, 0))
+
+  def _complete(self, target, oids, errors, timeouts, contexts,
+                partial=False):
+    OID_COUNT.labels(target.host).set(oids)
+    for context, seconds in contexts.items():
+      CONTEXT_LATENCY.labels(
+          target.layer, 'global' if context is None else 'vlan').observe(
+              seconds)
 
     timestamp = target.timestamp
     latency = time.time() - timestamp
 
     COMPLETED_POLL_COUNT.labels(target.host).inc(1)
-    ERROR_COUNT.labels(target.host).inc(stats.errors)
-    TIMEOUT_COUNT.labels(target.host).inc(stats.timeouts)
-    if stats.errors == 0 and stats.timeouts == 0:
+    if partial:
+      PARTIAL_POLL_COUNT.labels(target.host).inc(1)
+    elif errors == 0 and timeouts == 0:
       SUCCESSFUL_POLL_COUNT.labels(target.host).inc(1)
     DEVICE_LATENCY.labels(target.host).observe(latency)
 
-    logging.debug('Export completed for %d metrics for %s',
-        len(results), target.host)
-
     # Try to see if we're done with this round
-    if timestamp not in self.seen_targets:
-       self.seen_targets[timestamp] = []
-    self.seen_targets[timestamp].append(target)
-    max_targets = self.summaries.get(timestamp, None)
-    if max_targets is None:
-      return
-
-    if len(self.seen_targets[timestamp]) == max_targets:
-      # We're done! Record the latency
-      ROUND_LATENCY.observe(latency)
-      logging.info('Latency is currently %d', latency)
+    with self.rounds_lock:
+      if timestamp not in self.seen_targets:
+         self.seen_targets[timestamp] = []
+      self.seen_targets[timestamp].append(target)
+      max_targets = self.summaries.get(timestamp, None)
+      if max_targets is None:
+        return
+      if len(self.seen_targets[timestamp]) != max_targets:
+        return
       del self.summaries[timestamp]
       del self.seen_targets[timestamp]
       SUMMARIES_COUNT.set(len(self.summaries))
 
+    # We're done! Record the latency
+    ROUND_LATENCY.observe(latency)
+    logging.info('Latency is currently %d', latency)
+
   def _save(self, target, results):
-    for result in results.values():
+    if not isinstance(results, columnar.AnnotatedResults):
+      for result in results.values():
+        self.export(target, result)
+      return
+    for column in results.columns.values():
+      self.export_column(target, column)
+    for result in results.other.values():
       self.export(target, result)
 
   def export(self, target, result):
@@ -122,81 +249,173 @@ class Exporter(object):
       target.host, target.layer, result.index, result.data.type)] = (
           result.data.value, target.timestamp, result.labels)
 
+  def export_column(self, target, column):
+    """Like export() for all the rows of a columnar.AnnotatedColumn."""
+    if isinstance(column.types, list):
+      for row in range(len(column)):
+        self.export(target, actions.AnnotatedResultEntry(
+            snmp.ResultTuple(column.values[row], column.types[row]),
+            column.mib, column.obj, column.indexes[row], column.labels[row]))
+      return
+
+    type = column.types
+    if type == 'COUNTER64' or type == 'COUNTER':
+      metric_type = 'counter'
+    elif type in self.NUMERIC_TYPES:
+      metric_type = 'gauge'
+    else:
+      metric_type = 'blob'
+    metric = self.metrics.get(column.obj, None)
+    if not metric:
+      metric = (column.mib, metric_type, {})
+      self.metrics[column.obj] = metric
+    _, saved_metric_type, labels = metric
+    if metric_type != saved_metric_type:
+      # See export()
+      return
+    host = target.host
+    layer = target.layer
+    timestamp = target.timestamp
+    for index, value, row_labels in zip(
+        column.indexes, column.values, column.labels):
+      labels[(host, layer, index, type)] = (value, timestamp, row_labels)
+
+  def dump(self):
+    # Since the label map will be mutated we need to do a deep copy here.
+    with self.copy_lock:
+      metrics_copy = {}
+      for obj, (mib, type, labels) in self.metrics.items():
+        metrics_copy[obj] = (mib, type, dict(labels))
+
+    # Assemble the output
+    out = []
+    for obj, (mib, metrics_type, labels_map) in metrics_copy.items():
+      if metrics_type != 'counter' and metrics_type != 'gauge':
+        continue
+      out.append('# HELP {0} {1}::{0}\n'.format(obj, mib))
+      out.append('# TYPE {0} {1}\n'.format(obj, metrics_type))
+      for (host, layer, index, type), (value, timestamp, add_labels) in (
+          labels_map.items()):
+
+        labels = dict(add_labels)
+        labels['device'] = host
+        labels['layer'] = layer
+        labels['index'] = index
+        labels['type'] = type
+
+        label_list = ['{0}="{1}"'.format(k, v) for k, v in labels.items()]
+        label_string = ','.join(label_list)
+        instance = ''.join([obj, '{', label_string, '}'])
+
+        out.append('{0} {1} {2}\n'.format(
+          instance, value, int(timestamp * 1000)))
+
+    self.prometheus_output = out
+
   def run_dump(self):
     while True:
-      # Since the label map will be mutated we need to do a deep copy here.
-      with self.copy_lock:
-        metrics_copy = {}
-        for obj, (mib, type, labels) in self.metrics.items():
-          metrics_copy[obj] = (mib, type, dict(labels))
-
-      # Assemble the output
-      out = []
-      for obj, (mib, metrics_type, labels_map) in metrics_copy.items():
-        if metrics_type != 'counter' and metrics_type != 'gauge':
-          continue
-        out.append('# HELP {0} {1}::{0}\n'.format(obj, mib))
-        out.append('# TYPE {0} {1}\n'.format(obj, metrics_type))
-        for (host, layer, index, type), (value, timestamp, add_labels) in (
-            labels_map.items()):
-
-          labels = dict(add_labels)
-          labels['device'] = host
-          labels['layer'] = layer
-          labels['index'] = index
-          labels['type'] = type
-
-          label_list = ['{0}="{1}"'.format(k, v) for k, v in labels.items()]
-          label_string = ','.join(label_list)
-          instance = ''.join([obj, '{', label_string, '}'])
-
-          out.append('{0} {1} {2}\n'.format(
-            instance, value, int(timestamp * 1000)))
-
-      self.prometheus_output = out
+      self.dump()
       time.sleep(10)
 
+  async def run_dump_async(self):
+    # Runs on the same loop as the results are saved on, so the copy lock
+    # is never contended.
+    while True:
+      self.dump()
+      await asyncio.sleep(10)
+
   def write_metrics(self, out):
     for row in self.prometheus_output:
       out.write(bytes(row, 'ASCII'))
 
 
-if __name__ == '__main__':
-  exporter = stage.Stage(Exporter())
-  # TODO(bluecmd): This seems to be a bit unstable. I never got this to
-  # work in daemon mode, which is odd. I need to debug this more.
-  # For now, run the exporter like 'python src/exporter.py -d'
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+  def do_GET(self):
+    self.send_response(200)
+    self.send_header(
+      'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    self.end_headers()
+    self.server.logic.write_metrics(self.wfile)
 
-  class MetricsHandler(http.server.BaseHTTPRequestHandler):
-    def do_GET(self):
-      self.send_response(200)
-      self.send_header(
-        'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
-      self.end_headers()
-      exporter.logic.write_metrics(self.wfile)
+  def log_message(self, format, *args):
+    return
 
-    def log_message(self, format, *args):
-      return
+
+class ThreadedHTTPServer(
+    socketserver.ThreadingMixIn, http.server.HTTPServer):
+  pass
 
 
-  class ThreadedHTTPServer(
-      socketserver.ThreadingMixIn, http.server.HTTPServer):
-    pass
+class PrometheusMetricsServer(threading.Thread):
+  def __init__(self, logic):
+    super(PrometheusMetricsServer, self).__init__()
+    self.logic = logic
 
-  class PrometheusMetricsServer(threading.Thread):
-    def run(self):
-      httpd = ThreadedHTTPServer(('', HTTP_SNMP_PORT), MetricsHandler)
-      httpd.serve_forever()
-  t = PrometheusMetricsServer()
+  def run(self):
+    httpd = ThreadedHTTPServer(('', HTTP_SNMP_PORT), MetricsHandler)
+    httpd.logic = self.logic
+    httpd.serve_forever()
+
+
+def serve(logic):
+  """Start serving the collected metrics from background threads."""
+  t = PrometheusMetricsServer(logic)
   t.daemon = True
   t.start()
 
-  t = threading.Thread(target=exporter.logic.run_dump)
+  t = threading.Thread(target=logic.run_dump)
   t.daemon = True
   t.start()
 
   prometheus_client.start_http_server(HTTP_MAIN_PORT)
 
+
+async def _handle_metrics(logic, reader, writer):
+  # Only GET is supported, skip the request headers
+  while True:
+    line = await reader.readline()
+    if not line or line in (b'\r\n', b'\n'):
+      break
+  body = b''.join(bytes(row, 'ASCII') for row in logic.prometheus_output)
+  writer.write(
+      b'HTTP/1.0 200 OK\r\n'
+      b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+      b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n\r\n')
+  writer.write(body)
+  try:
+    await writer.drain()
+  finally:
+    writer.close()
+
+
+def serve_async(logic, loop):
+  """Like serve() but the metrics are dumped and served from the loop."""
+  loop.create_task(asyncio.start_server(
+    lambda r, w: _handle_metrics(logic, r, w), port=HTTP_SNMP_PORT))
+  loop.create_task(logic.run_dump_async())
+  prometheus_client.start_http_server(HTTP_MAIN_PORT)
+
+
+if __name__ == '__main__':
+  parser = stage.argument_parser()
+  parser.add_argument(
+      '--asyncio', dest='asyncio', action='store_true', default=False,
+      help='ingest and serve from one event loop instead of threads')
+  args = parser.parse_args()
+  stage.setup_logging(args.debug)
+
+  # TODO(bluecmd): This seems to be a bit unstable. I never got this to
+  # work in daemon mode, which is odd. I need to debug this more.
+  # For now, run the exporter like 'python src/exporter.py -d'
+  if args.asyncio:
+    import aiostage
+    exporter = aiostage.AsyncStage(Exporter(), args=args)
+    serve_async(exporter.logic, exporter.loop)
+  else:
+    exporter = stage.Stage(Exporter(), args=args)
+    serve(exporter.logic)
+
   exporter.listen(actions.AnnotatedResult)
+  exporter.listen(actions.AnnotatedResultChunk)
   exporter.listen(actions.Summary)
   exporter.run()
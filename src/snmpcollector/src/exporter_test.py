@@ -0,0 +1,135 @@
+import mock
+import multiprocessing.pool
+import unittest
+
+import actions
+import columnar
+import exporter
+import snmp
+
+
+class TestExporter(unittest.TestCase):
+
+  def setUp(self):
+    self.logic = exporter.Exporter()
+    patcher = mock.patch('time.time')
+    self.addCleanup(patcher.stop)
+    self.mock_time = patcher.start()
+    self.mock_time.return_value = 1300
+    self.target = snmp.SnmpTarget(
+        'test1', '1.2.3.4', 1234, 'access',
+        version=2, community='REMOVED', port=161)
+
+  @mock.patch('exporter.QUEUE_LATENCY')
+  @mock.patch('exporter.STAGE_LATENCY')
+  def testTrace(self, mock_stage_latency, mock_queue_latency):
+    run = actions.RunInformation(trace={
+      'Trigger': (1234, 1234),
+      'Supervisor': (1235, 1236),
+      'Worker': (1240, 1280),
+      'Annotator': (1290, 1295)})
+    list(actions.AnnotatedResult(
+        self.target, {}, actions.Statistics(0, 0)).do(self.logic, run) or [])
+
+    mock_stage_latency.labels.assert_has_calls([
+        mock.call('Trigger', 'access'), mock.call().observe(0),
+        mock.call('Supervisor', 'access'), mock.call().observe(1),
+        mock.call('Worker', 'access'), mock.call().observe(40),
+        mock.call('Annotator', 'access'), mock.call().observe(5)])
+    mock_queue_latency.labels.assert_has_calls([
+        mock.call('Supervisor', 'access'), mock.call().observe(1),
+        mock.call('Worker', 'access'), mock.call().observe(4),
+        mock.call('Annotator', 'access'), mock.call().observe(10),
+        mock.call('Exporter', 'access'), mock.call().observe(5)])
+
+  @mock.patch('exporter.SUCCESSFUL_POLL_COUNT')
+  @mock.patch('exporter.PARTIAL_POLL_COUNT')
+  def testPartial(self, mock_partial, mock_successful):
+    self.logic.do_result(actions.RunInformation(), self.target, {},
+                         actions.Statistics(partial=True))
+    mock_partial.labels.assert_called_with('test1')
+    self.assertFalse(mock_successful.labels.called)
+
+    stats = actions.Statistics(0, 0)
+    self.logic.do_result_chunk(actions.RunInformation(), self.target, {},
+                               actions.Statistics(partial=True), 0, False, {})
+    self.logic.do_result_chunk(
+        actions.RunInformation(), self.target, {}, stats, 1, True, {})
+    self.assertEqual(mock_partial.labels.call_count, 2)
+    self.assertFalse(mock_successful.labels.called)
+
+  def testColumns(self):
+    results = columnar.AnnotatedResults()
+    for index, value, type in (
+        ('1', '10', 'COUNTER'), ('2', '20', 'COUNTER'), ('3', 'x', 'OCTETSTR')):
+      results.append_entry('.1.3.6.1.2.1.2.2.1.10.' + index, None, value,
+          type, 'IF-MIB', 'ifInOctets', index, {'interface': index})
+    self.logic.do_result(
+        actions.RunInformation(), self.target, results, actions.Statistics())
+
+    rows = exporter.Exporter()
+    for result in results.values():
+      rows.export(self.target, result)
+    self.assertEqual(self.logic.metrics, rows.metrics)
+    self.assertEqual(len(self.logic.metrics['ifInOctets'][2]), 2)
+
+  def testChunksOutOfOrder(self):
+    self.logic.do_summary(None, 1234, 1)
+    stats = actions.Statistics(0, 0)
+    self.logic.do_result_chunk(
+        actions.RunInformation(), self.target, {}, stats, 1, True, {})
+    self.assertEquals(self.logic.summaries, {1234: 1})
+    self.logic.do_result_chunk(
+        actions.RunInformation(), self.target, {}, stats, 0, False, {})
+    self.assertEquals(self.logic.summaries, {})
+    self.assertEquals(self.logic.chunks, {})
+
+
+  def testLostChunks(self):
+    self.logic.do_summary(None, 1234, 1)
+    stats = actions.Statistics(0, 0)
+    self.logic.do_result_chunk(
+        actions.RunInformation(), self.target, {}, stats, 1, True, {})
+    self.assertEquals(len(self.logic.chunks), 1)
+    # Chunk 0 was lost, the poll is given up on some rounds later
+    for timestamp in range(1294, 1234 + 60 * exporter.CHUNK_ROUNDS, 60):
+      self.logic.do_summary(None, timestamp, 1)
+      self.assertEquals(len(self.logic.chunks), 1)
+    self.logic.do_summary(None, 1234 + 60 * exporter.CHUNK_ROUNDS, 1)
+    self.assertEquals(self.logic.chunks, {})
+
+  def testOverlappingRounds(self):
+    self.logic.do_summary(None, 1234, 1)
+    stats = actions.Statistics(0, 0)
+    self.logic.do_result_chunk(
+        actions.RunInformation(), self.target, {}, stats, 0, False, {})
+    # The next round starts while the poll is still streaming
+    self.logic.do_summary(None, 1294, 1)
+    self.logic.do_result_chunk(
+        actions.RunInformation(), self.target, {}, stats, 1, True, {})
+    self.assertEquals(self.logic.chunks, {})
+    self.assertEquals(self.logic.summaries, {1294: 1})
+
+
+  def testConcurrentChunks(self):
+    targets = [snmp.SnmpTarget('test%d' % i, '1.2.3.%d' % i, 1234, 'access',
+                               version=2) for i in range(20)]
+    self.logic.do_summary(None, 1234, len(targets))
+    stats = actions.Statistics(0, 0)
+    calls = [(target, sequence) for sequence in range(5) for target in targets]
+    # Like the stage running the actions with --concurrency
+    pool = multiprocessing.pool.ThreadPool(8)
+    self.addCleanup(pool.terminate)
+    pool.map(lambda x: self.logic.do_result_chunk(
+        actions.RunInformation(), x[0], {}, stats, x[1], x[1] == 4, {}),
+        calls)
+    self.assertEquals(self.logic.chunks, {})
+    self.assertEquals(self.logic.summaries, {})
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,64 @@
+"""Optional Prometheus metrics for the pipeline stages.
+
+Only the exporter requires prometheus_client. The other stages create their
+metrics through this module which hands out no-op metrics if the library
+is not installed, so instrumenting code never has to check for it.
+"""
+import logging
+
+try:
+  import prometheus_client
+except ImportError:
+  prometheus_client = None
+
+
+class _NullMetric(object):
+  """Stand-in for all metric types when prometheus_client is missing."""
+
+  def labels(self, *args, **kwargs):
+    return self
+
+  def inc(self, amount=1):
+    pass
+
+  def dec(self, amount=1):
+    pass
+
+  def set(self, value):
+    pass
+
+  def observe(self, value):
+    pass
+
+
+def _metric(kind, name, documentation, labelnames=(), **kwargs):
+  if prometheus_client is None:
+    return _NullMetric()
+  return getattr(prometheus_client, kind)(
+      name, documentation, labelnames, **kwargs)
+
+
+def counter(name, documentation, labelnames=()):
+  return _metric('Counter', name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+  return _metric('Gauge', name, documentation, labelnames)
+
+
+def summary(name, documentation, labelnames=()):
+  return _metric('Summary', name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=None):
+  if buckets is None:
+    return _metric('Histogram', name, documentation, labelnames)
+  return _metric('Histogram', name, documentation, labelnames, buckets=buckets)
+
+
+def start_http_server(port):
+  if prometheus_client is None:
+    logging.error('prometheus_client is not installed, cannot export metrics')
+    return
+  prometheus_client.start_http_server(port)
+  logging.info('Serving metrics on port %d', port)
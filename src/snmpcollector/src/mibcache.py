@@ -0,0 +1,248 @@
+"""MIB names of OIDs, shared between processes and kept across restarts.
+
+Resolving an OID through net-snmp is expensive, and after a restart every
+annotator resolves every OID it sees again. MibCache keeps the most recently
+used names in memory and all of them in a sqlite file, where every process
+using the same file finds what the others have resolved.
+
+The names depend on the MIB files net-snmp loads, so the file is keyed on
+them (see mib_set) and what was resolved with other MIBs is thrown away.
+"""
+import collections
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+
+import metrics
+
+# Names kept in memory by default
+MIB_CACHE_SIZE = 100000
+
+# Where net-snmp looks for MIBs unless MIBDIRS says otherwise
+MIB_DIRS = [
+    '~/.snmp/mibs',
+    '/usr/share/snmp/mibs',
+    '/usr/share/snmp/mibs/iana',
+    '/usr/share/snmp/mibs/ietf',
+    '/usr/share/mibs/site',
+    '/usr/share/mibs/netsnmp',
+    '/usr/share/mibs/iana',
+    '/usr/share/mibs/ietf',
+]
+
+# Seconds to wait for another process writing the file
+DB_TIMEOUT = 10
+
+MIB_CACHE_HITS = metrics.counter(
+    'snmp_mib_cache_hits', 'Number of OIDs found in the MIB cache')
+
+MIB_CACHE_MISSES = metrics.counter(
+    'snmp_mib_cache_misses', 'Number of OIDs that had to be resolved')
+
+
+def mib_directories():
+  """Returns the directories net-snmp loads MIBs from."""
+  directories = os.environ.get('MIBDIRS', None)
+  if directories is None:
+    return [os.path.expanduser(x) for x in MIB_DIRS]
+  if directories.startswith('+'):
+    return [os.path.expanduser(x) for x in MIB_DIRS] + directories[1:].split(
+        os.pathsep)
+  return directories.split(os.pathsep)
+
+
+def mib_set(directories=None):
+  """Returns a key for the loaded MIBs, it changes when any of them do."""
+  files = []
+  for directory in directories or mib_directories():
+    try:
+      names = os.listdir(directory)
+    except OSError:
+      continue
+    for name in names:
+      path = os.path.join(directory, name)
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+      files.append((path, stat.st_size, int(stat.st_mtime)))
+  key = repr((os.environ.get('MIBS', None), sorted(files)))
+  return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _has_index(name):
+  # MIB::object.1.2, the index is printed as numbers
+  return name.rpartition('.')[2].isdigit()
+
+
+class MibCache(object):
+  """{oid: (name, enum)} from resolve, None if the OID could not be resolved.
+
+  The size most recently used OIDs are kept in memory, see load for sharing
+  them with other processes.
+
+  It can be used from several threads, each of them gets its own connection
+  to the file as sqlite connections cannot be shared.
+  """
+
+  def __init__(self, resolve, size=MIB_CACHE_SIZE):
+    self._resolve = resolve
+    self.size = size
+    # Guards entries and pending
+    self.lock = threading.Lock()
+    # oid -> (name, enum), least recently used first
+    self.entries = collections.OrderedDict()
+    self.filename = None
+    self.mibs = None
+    # The connection of each thread to filename
+    self.local = threading.local()
+    # (oid, resolved) to write to the file on flush
+    self.pending = []
+
+  @property
+  def db(self):
+    """The connection of the calling thread to the file, or None."""
+    if self.filename is None:
+      return None
+    if getattr(self.local, 'filename', None) != self.filename:
+      self.local.db = sqlite3.connect(self.filename, timeout=DB_TIMEOUT)
+      self.local.filename = self.filename
+    return self.local.db
+
+  def load(self, filename, size=None, mibs=None):
+    """Use the names in filename, and save the ones resolved there.
+
+    mibs is the key of the loaded MIBs, from mib_set() unless given.
+    """
+    if size:
+      self.size = size
+    self.filename = None
+    if not filename:
+      return
+    self.mibs = mib_set() if mibs is None else mibs
+    self.filename = filename
+    # Connect again, the file may have been replaced
+    self.local.filename = None
+    try:
+      db = self.db
+      db.execute(
+          'CREATE TABLE IF NOT EXISTS names (mibs TEXT, oid TEXT, name TEXT, '
+          'enum BLOB, PRIMARY KEY (mibs, oid))')
+      # Resolved with MIBs that are not loaded anymore
+      db.execute('DELETE FROM names WHERE mibs != ?', (self.mibs, ))
+      db.commit()
+      rows = db.execute(
+          'SELECT oid, name, enum FROM names WHERE mibs = ? LIMIT ?',
+          (self.mibs, self.size)).fetchall()
+    except sqlite3.Error as e:
+      logging.warning('Unable to use MIB cache %s: %s', filename, e)
+      self.filename = None
+      return
+    with self.lock:
+      for oid, name, enum in rows:
+        self._store(oid, self._decode(name, enum))
+    logging.info('Loaded %d MIB names from %s', len(rows), filename)
+
+  def _decode(self, name, enum):
+    if name is None:
+      return None
+    return name, pickle.loads(bytes(enum))
+
+  def _store(self, oid, resolved):
+    # Called with the lock held
+    self.entries[oid] = resolved
+    if len(self.entries) > self.size:
+      self.entries.popitem(last=False)
+
+  def _add(self, oid, resolved):
+    """Cache what was resolved, and save it on the next flush."""
+    with self.lock:
+      self._store(oid, resolved)
+      if self.filename is not None:
+        self.pending.append((oid, resolved))
+
+  def _lookup(self, oid):
+    """Returns (found, resolved) from memory or the file."""
+    with self.lock:
+      if oid in self.entries:
+        # Move it last, it is the most recently used now
+        resolved = self.entries.pop(oid)
+        self.entries[oid] = resolved
+        return True, resolved
+    if self.filename is None:
+      return False, None
+    try:
+      row = self.db.execute(
+          'SELECT name, enum FROM names WHERE mibs = ? AND oid = ?',
+          (self.mibs, oid)).fetchone()
+    except sqlite3.Error as e:
+      logging.warning('Unable to read MIB cache: %s', e)
+      return False, None
+    if row is None:
+      return False, None
+    resolved = self._decode(*row)
+    with self.lock:
+      self._store(oid, resolved)
+    return True, resolved
+
+  def resolve(self, oid):
+    """Returns (name, enum) of oid, or None if it cannot be resolved."""
+    found, resolved = self._lookup(oid)
+    if found:
+      MIB_CACHE_HITS.inc()
+      return resolved
+    MIB_CACHE_MISSES.inc()
+    resolved = self._resolve(oid)
+    self._add(oid, resolved)
+    return resolved
+
+  def resolve_instance(self, oid):
+    """Returns (name, enum) of an instance OID, or None.
+
+    The instances of a column are named after the column, followed by their
+    index, so only the column (the OID without its last component) is
+    resolved and cached. OIDs that resolve to a name without an index are
+    scalars without their .0, they get one and are cached on their own.
+    """
+    column, _, last = oid.rpartition('.')
+    found, resolved = self._lookup(column)
+    if found and resolved is not None:
+      MIB_CACHE_HITS.inc()
+      name, enum = resolved
+      return '%s.%s' % (name, last), enum
+    found, resolved = self._lookup(oid)
+    if found:
+      MIB_CACHE_HITS.inc()
+    else:
+      MIB_CACHE_MISSES.inc()
+      resolved = self._resolve(oid)
+      if resolved is not None and _has_index(resolved[0]):
+        name, enum = resolved
+        self._add(column, (name.rpartition('.')[0], enum))
+        return resolved
+      self._add(oid, resolved)
+    if resolved is None or _has_index(resolved[0]):
+      return resolved
+    name, enum = resolved
+    return '%s.0' % name, enum
+
+  def flush(self):
+    """Write what was resolved since the last flush to the file."""
+    with self.lock:
+      pending, self.pending = self.pending, []
+    if self.filename is None or not pending:
+      return
+    rows = []
+    for oid, resolved in pending:
+      name, enum = resolved if resolved is not None else (None, None)
+      rows.append((self.mibs, oid, name, None if resolved is None else
+                   sqlite3.Binary(pickle.dumps(enum, 2))))
+    try:
+      self.db.executemany(
+          'INSERT OR REPLACE INTO names VALUES (?, ?, ?, ?)', rows)
+      self.db.commit()
+    except sqlite3.Error as e:
+      logging.warning('Unable to save MIB names: %s', e)
@@ -0,0 +1,171 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mibcache
+
+
+NAMES = {
+    '.1.2.3': ('TEST-MIB::test', {b'1': b'up'}),
+    '.1.2.4': ('TEST-MIB::other', {}),
+}
+
+# Like net-snmp, the deepest known object followed by the rest of the OID
+OBJECTS = {
+    '.1.3.6.1.2.1.1.3': 'SNMPv2-MIB::sysUpTime',
+    '.1.3.6.1.2.1.2.2.1.2': 'IF-MIB::ifDescr',
+    '.1.3.6.1.2.1.17.4.3.1.2': 'BRIDGE-MIB::dot1dTpFdbStatus',
+}
+
+
+class TestMibCache(unittest.TestCase):
+
+  def setUp(self):
+    self.resolved = []
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+    self.filename = os.path.join(self.directory, 'mibs.sqlite')
+
+  def resolve(self, oid):
+    self.resolved.append(oid)
+    return NAMES.get(oid, None)
+
+  def resolve_object(self, oid):
+    self.resolved.append(oid)
+    for key, name in OBJECTS.items():
+      if oid == key or oid.startswith(key + '.'):
+        return name + oid[len(key):], {}
+    return None
+
+  def testResolveInstance(self):
+    cache = mibcache.MibCache(self.resolve_object)
+    for index in ('1', '2', '10101'):
+      self.assertEqual(
+          cache.resolve_instance('.1.3.6.1.2.1.2.2.1.2.' + index),
+          ('IF-MIB::ifDescr.' + index, {}))
+    self.assertEqual(cache.resolve_instance('.1.3.6.1.2.1.1.3.0'),
+                     ('SNMPv2-MIB::sysUpTime.0', {}))
+    # The column is resolved once, for its first instance
+    self.assertEqual(self.resolved,
+                     ['.1.3.6.1.2.1.2.2.1.2.1', '.1.3.6.1.2.1.1.3.0'])
+    self.assertEqual(cache.entries['.1.3.6.1.2.1.2.2.1.2'],
+                     ('IF-MIB::ifDescr', {}))
+
+  def testResolveInstanceIndex(self):
+    cache = mibcache.MibCache(self.resolve_object)
+    fdb = '.1.3.6.1.2.1.17.4.3.1.2'
+    self.assertEqual(cache.resolve_instance(fdb + '.0.1.2.3.4.5'),
+                     ('BRIDGE-MIB::dot1dTpFdbStatus.0.1.2.3.4.5', {}))
+    self.assertEqual(cache.resolve_instance(fdb + '.0.1.2.3.4.6'),
+                     ('BRIDGE-MIB::dot1dTpFdbStatus.0.1.2.3.4.6', {}))
+    self.assertEqual(len(self.resolved), 1)
+
+  def testResolveInstanceScalar(self):
+    cache = mibcache.MibCache(self.resolve_object)
+    # Without the .0 the name has no index
+    self.assertEqual(cache.resolve_instance('.1.3.6.1.2.1.1.3'),
+                     ('SNMPv2-MIB::sysUpTime.0', {}))
+    self.assertEqual(cache.resolve_instance('.1.3.6.1.2.1.1.3'),
+                     ('SNMPv2-MIB::sysUpTime.0', {}))
+    self.assertIsNone(cache.resolve_instance('.1.4.1'))
+    self.assertIsNone(cache.resolve_instance('.1.4.1'))
+    self.assertEqual(self.resolved, ['.1.3.6.1.2.1.1.3', '.1.4.1'])
+    # The parent is not a column
+    self.assertNotIn('.1.3.6.1.2.1.1', cache.entries)
+
+  def testResolveInstanceShared(self):
+    cache = mibcache.MibCache(self.resolve_object)
+    cache.load(self.filename, mibs='a')
+    cache.resolve_instance('.1.3.6.1.2.1.2.2.1.2.1')
+    cache.flush()
+
+    other = mibcache.MibCache(self.resolve_object)
+    other.load(self.filename, mibs='a')
+    self.assertEqual(other.resolve_instance('.1.3.6.1.2.1.2.2.1.2.2'),
+                     ('IF-MIB::ifDescr.2', {}))
+    self.assertEqual(self.resolved, ['.1.3.6.1.2.1.2.2.1.2.1'])
+
+  def testResolve(self):
+    cache = mibcache.MibCache(self.resolve)
+    self.assertEqual(cache.resolve('.1.2.3'), NAMES['.1.2.3'])
+    self.assertEqual(cache.resolve('.1.2.3'), NAMES['.1.2.3'])
+    self.assertIsNone(cache.resolve('.1.2.5'))
+    self.assertIsNone(cache.resolve('.1.2.5'))
+    self.assertEqual(self.resolved, ['.1.2.3', '.1.2.5'])
+
+  def testEviction(self):
+    cache = mibcache.MibCache(self.resolve, size=2)
+    cache.resolve('.1.2.3')
+    cache.resolve('.1.2.4')
+    cache.resolve('.1.2.3')
+    # .1.2.4 is the least recently used
+    cache.resolve('.1.2.5')
+    self.assertEqual(list(cache.entries), ['.1.2.3', '.1.2.5'])
+    cache.resolve('.1.2.4')
+    self.assertEqual(self.resolved, ['.1.2.3', '.1.2.4', '.1.2.5', '.1.2.4'])
+
+  def testShared(self):
+    cache = mibcache.MibCache(self.resolve)
+    cache.load(self.filename, mibs='a')
+    cache.resolve('.1.2.3')
+    cache.resolve('.1.2.5')
+    cache.flush()
+
+    other = mibcache.MibCache(self.resolve)
+    other.load(self.filename, mibs='a')
+    self.assertEqual(other.resolve('.1.2.3'), NAMES['.1.2.3'])
+    self.assertIsNone(other.resolve('.1.2.5'))
+    self.assertEqual(self.resolved, ['.1.2.3', '.1.2.5'])
+
+  def testThreads(self):
+    cache = mibcache.MibCache(self.resolve)
+    cache.load(self.filename, mibs='a')
+    # Like the annotator resolving with --concurrency
+    threads = [threading.Thread(target=cache.resolve, args=(oid, ))
+               for oid in ('.1.2.3', '.1.2.4')]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    thread = threading.Thread(target=cache.flush)
+    thread.start()
+    thread.join()
+    self.assertEqual(cache.pending, [])
+
+    other = mibcache.MibCache(self.resolve)
+    other.load(self.filename, mibs='a')
+    self.assertEqual(other.resolve('.1.2.4'), NAMES['.1.2.4'])
+    self.assertEqual(other.resolve('.1.2.3'), NAMES['.1.2.3'])
+    self.assertEqual(sorted(self.resolved), ['.1.2.3', '.1.2.4'])
+
+  def testOtherMibs(self):
+    cache = mibcache.MibCache(self.resolve)
+    cache.load(self.filename, mibs='a')
+    cache.resolve('.1.2.3')
+    cache.flush()
+
+    other = mibcache.MibCache(self.resolve)
+    other.load(self.filename, mibs='b')
+    other.resolve('.1.2.3')
+    self.assertEqual(self.resolved, ['.1.2.3', '.1.2.3'])
+
+  def testMibSet(self):
+    mibs = os.path.join(self.directory, 'mibs')
+    os.mkdir(mibs)
+    with open(os.path.join(mibs, 'TEST-MIB.txt'), 'w') as f:
+      f.write('TEST-MIB DEFINITIONS ::= BEGIN')
+    before = mibcache.mib_set([mibs])
+    self.assertEqual(mibcache.mib_set([mibs]), before)
+    with open(os.path.join(mibs, 'TEST-MIB.txt'), 'a') as f:
+      f.write(' END')
+    self.assertNotEqual(mibcache.mib_set([mibs]), before)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
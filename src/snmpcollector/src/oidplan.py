@@ -0,0 +1,151 @@
+"""Compile the configured collections into what to poll on a device.
+
+Collections overlap: a dist switch matches both the access and the dist
+collections, which list both ifDescr and the ifTable it is part of. The
+plan for a (layer, model) is the union of the matching collections with
+every OID that is already covered by another one removed, so nothing is
+walked twice. OIDs ending in .0 are scalars and are fetched with GET, a
+walk would start after them.
+"""
+import collections
+import logging
+import re
+
+
+class Plan(collections.namedtuple('Plan', (
+    'collections', 'subtrees', 'scalars', 'vlan_subtrees', 'vlan_scalars'))):
+  """What to poll on a device.
+
+  The subtrees and scalars are polled in the global context, the vlan_ ones
+  in the context of every VLAN.
+  """
+  __slots__ = ()
+
+  @property
+  def oids(self):
+    return self.subtrees + self.scalars
+
+  @property
+  def vlan_oids(self):
+    return self.vlan_subtrees + self.vlan_scalars
+
+
+def is_scalar(oid):
+  return oid.endswith('.0')
+
+
+def _key(oid):
+  return tuple(int(x) for x in oid.strip('.').split('.'))
+
+
+def minimize(oids, intervals=None):
+  """Remove the OIDs that are part of another OID in oids.
+
+  An OID is only left out if the one covering it is walked at least as
+  often, see Compiler.intervals.
+
+  Returns:
+    (subtrees, scalars), both sorted.
+  """
+  intervals = intervals or {}
+  keys = {}
+  subtrees = []
+  scalars = []
+  for oid in oids:
+    try:
+      keys[_key(oid)] = oid
+    except ValueError:
+      # Not numeric, left for the poll to complain about
+      subtrees.append(oid)
+  for key, oid in sorted(keys.items()):
+    interval = intervals.get(oid, 0)
+    covered = False
+    for length in range(1, len(key)):
+      parent = keys.get(key[:length], None)
+      if (parent is not None and not is_scalar(parent) and
+          intervals.get(parent, 0) <= interval):
+        covered = True
+        break
+    if covered:
+      logging.debug('Not polling %s, it is part of %s', oid, parent)
+    elif is_scalar(oid):
+      scalars.append(oid)
+    else:
+      subtrees.append(oid)
+  return subtrees, scalars
+
+
+class Compiler(object):
+  """The collections of one configuration, with the model regexps compiled.
+
+  Build a new one when the configuration changes, the plans are cached.
+  """
+
+  def __init__(self, collections):
+    # [(name, [regexp], layers, vlan_aware, oids, interval)]
+    self.collections = []
+    for name, collection in sorted((collections or {}).items()):
+      if 'oids' not in collection:
+        continue
+      self.collections.append((
+          name,
+          [re.compile(x, re.MULTILINE) for x in collection['models']],
+          collection.get('layers', None),
+          collection.get('vlan_aware', False),
+          collection['oids'],
+          collection.get('interval', 0)))
+    self.plans = {}
+    self.model_intervals = {}
+
+  def intervals(self, layer, model):
+    """Returns {oid: seconds} for the OIDs not to walk on every poll.
+
+    OIDs are only walked every collection.interval seconds, the shortest
+    one if they are part of several of the collections of the device.
+    """
+    intervals = self.model_intervals.get((layer, model), None)
+    if intervals is not None:
+      return intervals
+
+    intervals = {}
+    for _, regexps, layers, _, oids, interval in self.collections:
+      if layers and layer not in layers:
+        continue
+      if not any(x.search(model) for x in regexps):
+        continue
+      for oid in oids:
+        intervals[oid] = min(intervals.get(oid, interval), interval)
+    intervals = dict((k, v) for k, v in intervals.items() if v)
+    self.model_intervals[(layer, model)] = intervals
+    return intervals
+
+  def plan(self, layer, model):
+    """Returns the Plan for a device."""
+    plan = self.plans.get((layer, model), None)
+    if plan is not None:
+      return plan
+
+    names = []
+    oids = set()
+    vlan_oids = set()
+    for name, regexps, layers, vlan_aware, collection_oids, _ in (
+        self.collections):
+      if layers and layer not in layers:
+        continue
+      if not any(x.search(model) for x in regexps):
+        continue
+      logging.debug('Model %s matches collection %s', model, name)
+      names.append(name)
+      # VLAN aware collections are run against every VLAN.
+      # We don't want to run all the other OIDs (there can be a *lot* of
+      # VLANs).
+      if vlan_aware:
+        vlan_oids.update(collection_oids)
+      else:
+        oids.update(collection_oids)
+
+    intervals = self.intervals(layer, model)
+    plan = Plan(names, *(minimize(oids, intervals) +
+                         minimize(vlan_oids, intervals)))
+    self.plans[(layer, model)] = plan
+    return plan
@@ -0,0 +1,95 @@
+import unittest
+import yaml
+
+import oidplan
+
+
+COLLECTIONS = """
+Default OIDs:
+  models:
+    - .*
+  oids:
+    - .1.3.6.1.2.1.1.3.0
+    - .1.3.6.1.2.1.47.1.1.1.1.13
+
+Cisco Switch:
+  models:
+    - ^WS-C
+  oids:
+    - .1.3.6.1.2.1.2.2.1.2
+    - .1.3.6.1.2.1.31.1.1.1.6
+    - .1.3.6.1.2.1.47.1.1.1.1.9
+
+Cisco Dist Switch:
+  models:
+    - ^WS-C
+  layers:
+    - dist
+  oids:
+    - .1.3.6.1.2.1.2.2
+    - .1.3.6.1.2.1.31.1.1
+
+Cisco Dist Switch - Inventory:
+  models:
+    - ^WS-C
+  layers:
+    - dist
+  interval: 600
+  oids:
+    - .1.3.6.1.2.1.47.1.1.1.1
+
+VLAN aware:
+  models:
+    - ^WS-C
+  vlan_aware: yes
+  oids:
+    - .1.3.6.1.2.1.17.4.3.1.2
+"""
+
+
+class TestOidPlan(unittest.TestCase):
+
+  def setUp(self):
+    self.compiler = oidplan.Compiler(yaml.load(COLLECTIONS))
+
+  def testAccess(self):
+    plan = self.compiler.plan('access', 'WS-C2960')
+    self.assertEqual(plan.collections,
+        ['Cisco Switch', 'Default OIDs', 'VLAN aware'])
+    self.assertEqual(plan.subtrees, [
+      '.1.3.6.1.2.1.2.2.1.2', '.1.3.6.1.2.1.31.1.1.1.6',
+      '.1.3.6.1.2.1.47.1.1.1.1.9', '.1.3.6.1.2.1.47.1.1.1.1.13'])
+    self.assertEqual(plan.scalars, ['.1.3.6.1.2.1.1.3.0'])
+    self.assertEqual(plan.vlan_oids, ['.1.3.6.1.2.1.17.4.3.1.2'])
+
+  def testDist(self):
+    plan = self.compiler.plan('dist', 'WS-C4500X')
+    # The inventory is walked less often, so its columns are kept
+    self.assertEqual(plan.subtrees, [
+      '.1.3.6.1.2.1.2.2', '.1.3.6.1.2.1.31.1.1',
+      '.1.3.6.1.2.1.47.1.1.1.1', '.1.3.6.1.2.1.47.1.1.1.1.9',
+      '.1.3.6.1.2.1.47.1.1.1.1.13'])
+    self.assertEqual(self.compiler.intervals('dist', 'WS-C4500X'),
+        {'.1.3.6.1.2.1.47.1.1.1.1': 600})
+    # Only for the models of the collection
+    self.assertEqual(self.compiler.intervals('dist', 'Linux'), {})
+
+  def testOtherModel(self):
+    plan = self.compiler.plan('access', 'Linux')
+    self.assertEqual(plan.oids,
+        ['.1.3.6.1.2.1.47.1.1.1.1.13', '.1.3.6.1.2.1.1.3.0'])
+    self.assertIs(plan, self.compiler.plan('access', 'Linux'))
+
+  def testMinimize(self):
+    self.assertEqual(oidplan.minimize(
+        ['.1.3.6.1.2.1.2', '.1.3.6.1.2.1.2.2.1.2', '.1.3.6.1.2.1.20',
+         '.1.3.6.1.2.1.2.0', '.1.3.6.1.2.1.1.3.0']),
+        (['.1.3.6.1.2.1.2', '.1.3.6.1.2.1.20'], ['.1.3.6.1.2.1.1.3.0']))
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
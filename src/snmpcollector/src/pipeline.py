@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Run the whole pipeline in one process without RabbitMQ.
+
+All stages are connected through an in-memory broker and the actions are
+passed between them without being serialized. This is enough for small
+deployments and makes it possible to profile the whole pipeline at once.
+The supervisor is triggered every --interval seconds.
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+
+import actions
+import annotator
+import exporter
+import profiling
+import stage
+import supervisor
+import transport
+import trigger
+import worker
+
+
+def main():
+  parser = stage.argument_parser()
+  parser.add_argument(
+      '--interval', dest='interval', type=float, default=60,
+      help='seconds between poll rounds, 0 to only poll once')
+  parser.add_argument(
+      '--tag', dest='tag', default='', help='tag to trigger')
+  args = parser.parse_args()
+  stage.setup_logging(args.debug)
+
+  if args.pidfile:
+    with open(args.pidfile, 'w') as f:
+      f.write(str(os.getpid()))
+
+  # The stages run in threads, the signal handler is installed here instead
+  if args.profile_dir:
+    profiling.PROFILER.install(args.profile_dir)
+
+  broker = transport.MemoryBroker()
+
+  def make_stage(logic, concurrency=1):
+    # --concurrency is used for the workers, the rest keep up fine with one
+    stage_args = argparse.Namespace(**vars(args))
+    stage_args.concurrency = concurrency
+    stage_args.pidfile = None
+    stage_args.metrics_port = None
+    return stage.Stage(logic, transport.MemoryTransport(broker), stage_args)
+
+  # Nothing to purge, the broker starts empty. Purging when the stage starts
+  # could throw away the first trigger.
+  supervisor_stage = make_stage(supervisor.Supervisor())
+  supervisor_stage.listen(actions.Trigger)
+
+  worker_stage = make_stage(worker.Worker(), args.concurrency)
+  worker_stage.listen(actions.SnmpWalk)
+  worker_stage.listen(actions.SnmpWalkBatch)
+
+  annotator_stage = make_stage(annotator.Annotator())
+  annotator_stage.listen(actions.Result)
+  annotator_stage.listen(actions.ResultChunk)
+
+  exporter_stage = make_stage(exporter.Exporter())
+  exporter_stage.listen(actions.AnnotatedResult)
+  exporter_stage.listen(actions.AnnotatedResultChunk)
+  exporter_stage.listen(actions.Summary)
+  exporter.serve(exporter_stage.logic)
+
+  stages = (supervisor_stage, worker_stage, annotator_stage, exporter_stage)
+  for s in stages:
+    t = threading.Thread(target=s.run, name=s.name)
+    t.daemon = True
+    t.start()
+
+  trigger_stage = make_stage(trigger.Trigger())
+  try:
+    while True:
+      trigger.Trigger().trigger(args.tag, trigger_stage)
+      if not args.interval:
+        break
+      time.sleep(args.interval)
+    # Only polling once, keep serving the result
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    logging.error('Keyboard interrupt, shutting down..')
+
+
+if __name__ == '__main__':
+  main()
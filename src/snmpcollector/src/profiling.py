@@ -0,0 +1,170 @@
+"""On-demand CPU and memory profiling of the pipeline stages.
+
+Send SIGUSR1 to a stage to start profiling it and SIGUSR1 again to stop
+and write the collected statistics to a file in --profile-dir.
+
+While running, the threads executing an Action are sampled on SIGPROF and
+the stacks are aggregated per stage and Action type in the collapsed
+format used by flamegraph.pl. If tracemalloc is available the allocations
+are traced as well and the biggest allocation sites are added to the dump.
+
+Nothing is sampled or traced until profiling is started, the stages only
+check the `active` flag once per Action.
+"""
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+# Seconds of CPU time between samples
+SAMPLE_INTERVAL = 0.005
+
+# Number of allocation sites to include in the dump
+TOP_ALLOCATIONS = 25
+
+
+class Profiler(object):
+  """Process wide sampling profiler, shared by all stages in the process."""
+
+  def __init__(self):
+    self.active = False
+    self.directory = None
+    self.lock = threading.Lock()
+    # Serializes start and stop
+    self.toggle_lock = threading.Lock()
+    # thread ident -> (stage name, action name) currently executing
+    self.threads = {}
+    self._reset()
+
+  def _reset(self):
+    self.started = None
+    self.samples = collections.defaultdict(int)
+    # (stage name, action name) -> [count, seconds, allocated bytes]
+    self.actions = collections.defaultdict(lambda: [0, 0.0, 0])
+
+  def install(self, directory):
+    """Toggle profiling on SIGUSR1, dumping to directory when stopped."""
+    self.directory = directory
+    if threading.current_thread().name != 'MainThread':
+      logging.warning('Profiling can only be enabled from the main thread')
+      return
+    signal.signal(signal.SIGUSR1, self._toggle_signal)
+    signal.signal(signal.SIGPROF, self._sample)
+
+  def _toggle_signal(self, signum, frame):
+    # The interrupted thread may hold self.lock, and stopping writes a file,
+    # so do it in a thread of its own
+    thread = threading.Thread(target=self.toggle, name='Profiler')
+    thread.daemon = True
+    thread.start()
+
+  def toggle(self):
+    with self.toggle_lock:
+      if self.active:
+        self.stop()
+      else:
+        self.start()
+
+  def start(self):
+    if self.active:
+      return
+    self._reset()
+    self.started = time.time()
+    if tracemalloc is not None:
+      tracemalloc.start()
+    self.active = True
+    signal.setitimer(signal.ITIMER_PROF, SAMPLE_INTERVAL, SAMPLE_INTERVAL)
+    logging.info('Profiling started')
+
+  def stop(self):
+    """Stop profiling and write the statistics, returns the file name."""
+    if not self.active:
+      return None
+    signal.setitimer(signal.ITIMER_PROF, 0, 0)
+    self.active = False
+    snapshot = None
+    if tracemalloc is not None:
+      # Leave out the samples we collected ourselves
+      snapshot = tracemalloc.take_snapshot().filter_traces(
+          [tracemalloc.Filter(False, __file__)])
+      tracemalloc.stop()
+
+    filename = os.path.join(self.directory or '.', 'snmpcollector.%d.%d.prof'
+        % (os.getpid(), self.started))
+    with open(filename, 'w') as f:
+      self.write(f, snapshot)
+    logging.info('Profiling stopped, wrote %s', filename)
+    return filename
+
+  def register_thread(self, stage_name, name):
+    """Attribute all samples of the calling thread to name.
+
+    Used for event loops where many Actions share one thread.
+    """
+    self.threads[threading.current_thread().ident] = (stage_name, name)
+
+  def enter(self, stage_name, action):
+    """Mark the calling thread as executing action, returns a token."""
+    key = (stage_name, action.__class__.__name__)
+    ident = threading.current_thread().ident
+    self.threads[ident] = key
+    allocated = tracemalloc.get_traced_memory()[0] if tracemalloc else 0
+    return ident, key, time.time(), allocated
+
+  def leave(self, token):
+    ident, key, start, allocated = token
+    self.threads.pop(ident, None)
+    if tracemalloc and tracemalloc.is_tracing():
+      # Includes allocations made by other threads in the meantime
+      allocated = tracemalloc.get_traced_memory()[0] - allocated
+    else:
+      allocated = 0
+    with self.lock:
+      stats = self.actions[key]
+      stats[0] += 1
+      stats[1] += time.time() - start
+      stats[2] += allocated
+
+  def _sample(self, signum, frame):
+    # Runs on the main thread, must not take any locks
+    frames = sys._current_frames()
+    current = threading.current_thread().ident
+    for ident, key in list(self.threads.items()):
+      f = frame if ident == current else frames.get(ident, None)
+      stack = []
+      while f is not None:
+        code = f.f_code
+        stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+        f = f.f_back
+      stack.append('%s.%s' % key)
+      self.samples[';'.join(reversed(stack))] += 1
+
+  def write(self, out, snapshot=None):
+    out.write('# Profiled for %.1f seconds\n' % (time.time() - self.started))
+    out.write('# stage.action count seconds allocated_bytes\n')
+    with self.lock:
+      actions = sorted(self.actions.items())
+    for (stage_name, action), (count, seconds, allocated) in actions:
+      out.write('%s.%s %d %.3f %d\n' % (
+          stage_name, action, count, seconds, allocated))
+
+    out.write('# CPU samples every %s seconds, collapsed stacks\n'
+        % SAMPLE_INTERVAL)
+    for stack, count in sorted(self.samples.items()):
+      out.write('%s %d\n' % (stack, count))
+
+    if snapshot is not None:
+      out.write('# Top allocation sites\n')
+      for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+        out.write('%s\n' % stat)
+
+
+PROFILER = Profiler()
@@ -0,0 +1,55 @@
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import actions
+import profiling
+
+
+class TestProfiler(unittest.TestCase):
+
+  def setUp(self):
+    self.profiler = profiling.Profiler()
+    self.profiler.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.profiler.directory)
+
+  def testActionStats(self):
+    self.profiler.start()
+    token = self.profiler.enter('Worker', actions.Trigger())
+    self.profiler._sample(None, sys._getframe())
+    self.profiler.leave(token)
+    filename = self.profiler.stop()
+
+    self.assertFalse(self.profiler.active)
+    self.assertEqual(self.profiler.threads, {})
+    self.assertEqual(self.profiler.actions[('Worker', 'Trigger')][0], 1)
+    with open(filename) as f:
+      dump = f.read()
+    self.assertIn('\nWorker.Trigger 1 ', dump)
+    stacks = [x for x in dump.splitlines() if x.startswith('Worker.Trigger;')]
+    self.assertEqual(len(stacks), 1)
+    self.assertTrue(stacks[0].endswith('profiling_test.py:testActionStats 1'))
+
+  def testToggleSignal(self):
+    # The signal can interrupt a thread holding the lock
+    with self.profiler.lock:
+      self.profiler._toggle_signal(None, None)
+      for thread in threading.enumerate():
+        if thread.name == 'Profiler':
+          thread.join()
+      self.assertTrue(self.profiler.active)
+    self.profiler.stop()
+
+  def testInactive(self):
+    self.assertIsNone(self.profiler.stop())
+    self.assertFalse(self.profiler.active)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""Serve recorded SNMP captures, to poll devices without having them.
+
+Record a device with snmptest.py --record FILE (or by setting
+SnmpTarget.capture), then either:
+
+  * replay.py serve FILE...: answer SNMPv2c on a local UDP port per
+    capture, for worker.py and anything else speaking SNMP.
+  * replay.py bench FILE...: walk the captures in-process through
+    asyncsnmp, the same walks as when they were recorded, and print how
+    long they took.
+
+--latency delays every response, --loss drops that fraction of them and
+--max-pdu drops the responses larger than that many bytes, like a Nexus
+dropping fragmented responses. Give --seed to lose the same responses
+every run.
+"""
+import argparse
+import asyncio
+import bisect
+import logging
+import random
+import time
+
+import asyncsnmp
+import snmp
+
+_END_OF_MIB_VIEW = snmp.ResultTuple(None, 'ENDOFMIBVIEW')
+_NO_SUCH_OBJECT = snmp.ResultTuple(None, 'NOSUCHOBJECT')
+
+
+def _key(oid):
+  return tuple(int(x) for x in oid.strip('.').split('.'))
+
+
+class Responder(object):
+  """Answers the requests for one snmp.Capture."""
+
+  def __init__(self, capture, latency=0, loss=0, max_pdu=None, seed=None):
+    self.capture = capture
+    self.latency = latency
+    self.loss = loss
+    self.max_pdu = max_pdu
+    self.random = random.Random(seed)
+    # vlan -> ([key], [oid]) sorted on the key
+    self.index = {}
+    self.requests = 0
+    self.dropped = 0
+
+  def _sorted(self, vlan):
+    index = self.index.get(vlan, None)
+    if index is None:
+      oids = sorted(self.capture.contexts.get(vlan, {}), key=_key)
+      index = self.index[vlan] = ([_key(x) for x in oids], oids)
+    return index
+
+  def _next(self, vlan, oid):
+    keys, oids = self._sorted(vlan)
+    position = bisect.bisect_right(keys, _key(oid))
+    if position == len(oids):
+      return oid, _END_OF_MIB_VIEW
+    return oids[position], self.capture.contexts[vlan][oids[position]]
+
+  def varbinds(self, tag, vlan, oids, non_repeaters=0, max_repetitions=0):
+    """Returns the [(oid, snmp.ResultTuple)] answering the request."""
+    context = self.capture.contexts.get(vlan, {})
+    if tag == asyncsnmp.GET:
+      return [(x, context.get(x, _NO_SUCH_OBJECT)) for x in oids]
+    if tag == asyncsnmp.GETNEXT:
+      return [self._next(vlan, x) for x in oids]
+    if tag != asyncsnmp.GETBULK:
+      raise snmp.SnmpError('Unsupported PDU %#x' % tag)
+    ret = [self._next(vlan, x) for x in oids[:non_repeaters]]
+    repeaters = oids[non_repeaters:]
+    for _ in range(max_repetitions):
+      if not repeaters:
+        break
+      row = [self._next(vlan, x) for x in repeaters]
+      ret.extend(row)
+      if all(x is _END_OF_MIB_VIEW for _, x in row):
+        break
+      repeaters = [oid for oid, _ in row]
+    return ret
+
+  def respond(self, request_id, tag, vlan, oids, non_repeaters=0,
+      max_repetitions=0):
+    """Returns the encoded RESPONSE PDU, or None if it is to be dropped."""
+    self.requests += 1
+    pdu = asyncsnmp.encode_response(request_id, self.varbinds(
+        tag, vlan, oids, non_repeaters, max_repetitions))
+    if ((self.max_pdu and len(pdu) > self.max_pdu) or
+        (self.loss and self.random.random() < self.loss)):
+      self.dropped += 1
+      return None
+    return pdu
+
+
+def _community_vlan(community):
+  # community@vlan, see SnmpTarget._community
+  _, _, vlan = community.partition('@')
+  return int(vlan) if vlan else None
+
+
+class ReplayEngine(asyncsnmp.Engine):
+  """asyncsnmp.Engine answering from Responders instead of the network."""
+
+  def __init__(self, responders, timeout=None):
+    super(ReplayEngine, self).__init__()
+    # (ip, port) -> Responder
+    self.responders = responders
+    # Seconds to wait for a dropped response, the request's timeout if None
+    self.timeout = timeout
+
+  def install(self, loop):
+    """Use this engine for all the asyncsnmp requests from loop."""
+    self.ready = loop.create_future()
+    self.ready.set_result(None)
+    asyncsnmp._ENGINES[loop] = self
+
+  async def request(self, address, security, tag, oids, non_repeaters=0,
+      max_repetitions=0, timeout=asyncsnmp.TIMEOUT,
+      retries=asyncsnmp.RETRIES):
+    responder = self.responders.get(address, None)
+    if isinstance(security, asyncsnmp.Usm):
+      context = security.context.decode('utf-8')
+      vlan = int(context[5:]) if context.startswith('vlan-') else None
+    else:
+      vlan = _community_vlan(security.community.decode('utf-8'))
+    for attempt in range(retries + 1):
+      pdu = None
+      if responder is not None:
+        pdu = responder.respond(self.next_id(), tag, vlan, oids,
+                                non_repeaters, max_repetitions)
+      if pdu is None:
+        await asyncio.sleep(timeout if self.timeout is None else self.timeout)
+        continue
+      await asyncio.sleep(responder.latency)
+      _, _, error_status, error_index, varbinds = asyncsnmp.decode_pdu(
+          pdu, asyncsnmp._read(pdu, 0))
+      return varbinds
+    raise snmp.TimeoutError('Timeout talking to %s' % address[0])
+
+
+class ReplayAgent(asyncio.DatagramProtocol):
+  """SNMPv2c agent answering from a Responder."""
+
+  def __init__(self, responder):
+    self.responder = responder
+    self.transport = None
+
+  def connection_made(self, transport):
+    self.transport = transport
+
+  def datagram_received(self, data, address):
+    try:
+      _, start, end = asyncsnmp._read(data, 0)
+      version, community, pdu = asyncsnmp._children(data, start, end)
+      tag, request_id, non_repeaters, max_repetitions, varbinds = (
+          asyncsnmp.decode_pdu(data, pdu))
+      vlan = _community_vlan(
+          bytes(data[community[1]:community[2]]).decode('utf-8'))
+      response = self.responder.respond(request_id, tag, vlan,
+          [oid for oid, _ in varbinds], non_repeaters, max_repetitions)
+    except (snmp.Error, ValueError) as e:
+      logging.debug('Dropping request from %s: %s', address[0], e)
+      return
+    if response is None:
+      return
+    message = asyncsnmp._sequence(
+        asyncsnmp._integer(asyncsnmp._int(data, version)),
+        asyncsnmp._octets(bytes(data[community[1]:community[2]])), response)
+    asyncio.get_event_loop().call_later(
+        self.responder.latency, self.transport.sendto, message, address)
+
+
+async def serve(responders, ip, port):
+  """Serve every Responder on its own port from port and up.
+
+  Returns:
+    [(host, port, transport)]
+  """
+  loop = asyncio.get_event_loop()
+  ret = []
+  for i, responder in enumerate(responders):
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: ReplayAgent(responder),
+        local_addr=(ip, (port + i) if port else 0))
+    ret.append((responder.capture.host, transport.get_extra_info(
+        'sockname')[1], transport))
+  return ret
+
+
+async def bench(responders, repeat):
+  """Walk every capture like it was recorded, returns the seconds taken."""
+  engine = ReplayEngine(dict(
+      (('127.0.0.1', i), x) for i, x in enumerate(responders)))
+  engine.install(asyncio.get_event_loop())
+  targets = [snmp.SnmpTarget(
+      x.capture.host, '127.0.0.1', time.time(), 'replay', version=2,
+      community='public', port=i) for i, x in enumerate(responders)]
+
+  async def walk(target, capture):
+    for vlan, oids in capture.walks:
+      await asyncsnmp.walk_table(target, oids, vlan)
+
+  start = time.time()
+  for _ in range(repeat):
+    await asyncio.gather(*[walk(target, responder.capture)
+        for target, responder in zip(targets, responders)])
+  return time.time() - start
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('mode', choices=('serve', 'bench'))
+  parser.add_argument('captures', nargs='+', help='files to replay')
+  parser.add_argument('--ip', dest='ip', default='127.0.0.1',
+      help='address to serve on')
+  parser.add_argument('--port', dest='port', type=int, default=1161,
+      help='port of the first capture, the next one gets the next port')
+  parser.add_argument('--latency', dest='latency', type=float, default=0,
+      help='seconds to delay every response')
+  parser.add_argument('--loss', dest='loss', type=float, default=0,
+      help='fraction of the responses to drop')
+  parser.add_argument('--max-pdu', dest='max_pdu', type=int, default=None,
+      help='drop the responses larger than this many bytes')
+  parser.add_argument('--seed', dest='seed', type=int, default=None,
+      help='seed for which responses are lost')
+  parser.add_argument('--repeat', dest='repeat', type=int, default=1,
+      help='number of times to walk every capture when benchmarking')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+
+  responders = [Responder(snmp.Capture.load(x), args.latency, args.loss,
+                          args.max_pdu, args.seed) for x in args.captures]
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  if args.mode == 'bench':
+    seconds = loop.run_until_complete(bench(responders, args.repeat))
+    for responder in responders:
+      logging.info('%s: %d requests, %d dropped', responder.capture.host,
+                   responder.requests, responder.dropped)
+    logging.info('Walked %d captures %d times in %.3f s',
+                 len(responders), args.repeat, seconds)
+    return
+
+  for host, port, _ in loop.run_until_complete(
+      serve(responders, args.ip, args.port)):
+    logging.info('Serving %s on %s:%d', host, args.ip, port)
+  try:
+    loop.run_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
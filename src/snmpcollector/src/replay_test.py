@@ -0,0 +1,112 @@
+import asyncio
+import mock
+import unittest
+
+import asyncsnmp
+import replay
+import snmp
+
+
+def capture():
+  ret = snmp.Capture('test1')
+  ret.add(None, {
+    '.1.3.6.1.2.1.1.1.0': snmp.ResultTuple('Test switch', 'OCTETSTR'),
+    '.1.3.6.1.2.1.2.2.1.2.1': snmp.ResultTuple('Gi0/1', 'OCTETSTR'),
+    '.1.3.6.1.2.1.2.2.1.2.2': snmp.ResultTuple('Gi0/2', 'OCTETSTR'),
+    '.1.3.6.1.2.1.2.2.1.2.10': snmp.ResultTuple('Gi0/10', 'OCTETSTR'),
+    '.1.3.6.1.2.1.2.2.1.10.1': snmp.ResultTuple('4294967295', 'COUNTER'),
+    '.1.3.6.1.2.1.2.2.1.10.2': snmp.ResultTuple('5', 'COUNTER'),
+  })
+  ret.add(10, {
+    '.1.3.6.1.2.1.17.4.3.1.2.1': snmp.ResultTuple('-3', 'INTEGER'),
+  })
+  return ret
+
+
+class TestResponder(unittest.TestCase):
+
+  def testBulk(self):
+    responder = replay.Responder(capture())
+    varbinds = responder.varbinds(asyncsnmp.GETBULK, None,
+        ['.1.3.6.1.2.1.1.1.0', '.1.3.6.1.2.1.2.2.1.2', '.1.3.6.1.2.1.2.2.1.10'],
+        non_repeaters=1, max_repetitions=3)
+    self.assertEqual([x for x, _ in varbinds], [
+        '.1.3.6.1.2.1.2.2.1.2.1',
+        '.1.3.6.1.2.1.2.2.1.2.1', '.1.3.6.1.2.1.2.2.1.10.1',
+        '.1.3.6.1.2.1.2.2.1.2.2', '.1.3.6.1.2.1.2.2.1.10.2',
+        '.1.3.6.1.2.1.2.2.1.2.10', '.1.3.6.1.2.1.2.2.1.10.2'])
+    self.assertEqual(varbinds[-1][1].type, 'ENDOFMIBVIEW')
+
+  def testGet(self):
+    responder = replay.Responder(capture())
+    self.assertEqual(responder.varbinds(
+        asyncsnmp.GET, 10, ['.1.3.6.1.2.1.17.4.3.1.2.1', '.1.3.6.1.2.1.1.1.0']),
+        [('.1.3.6.1.2.1.17.4.3.1.2.1', snmp.ResultTuple('-3', 'INTEGER')),
+         ('.1.3.6.1.2.1.1.1.0', replay._NO_SUCH_OBJECT)])
+
+  def testLoss(self):
+    dropped = []
+    for _ in range(2):
+      responder = replay.Responder(capture(), loss=0.5, seed=42)
+      dropped.append([responder.respond(
+          1, asyncsnmp.GET, None, ['.1.3.6.1.2.1.1.1.0']) is None
+          for _ in range(20)])
+    self.assertEqual(dropped[0], dropped[1])
+    self.assertTrue(any(dropped[0]) and not all(dropped[0]))
+
+
+class TestReplay(unittest.TestCase):
+
+  def setUp(self):
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self.loop)
+    self.addCleanup(self.loop.close)
+    self.addCleanup(asyncsnmp._ENGINES.pop, self.loop, None)
+    patcher = mock.patch('snmp.BULK_SIZES', snmp.BulkSizes())
+    self.addCleanup(patcher.stop)
+    patcher.start()
+    self.columns = ['.1.3.6.1.2.1.2.2.1.2', '.1.3.6.1.2.1.2.2.1.10']
+
+  def testMaxPdu(self):
+    # Responses with more than two varbinds are too large
+    responder = replay.Responder(capture(), max_pdu=60)
+    replay.ReplayEngine(
+        {('127.0.0.1', 161): responder}, timeout=0).install(self.loop)
+    target = snmp.SnmpTarget(
+        'test1', '127.0.0.1', 1234, 'access', version=2, community='public')
+    results, failed = self.loop.run_until_complete(
+        asyncsnmp.walk_table(target, self.columns))
+    self.assertEqual(failed, {})
+    self.assertEqual(len(results), 5)
+    self.assertTrue(responder.dropped)
+    self.assertEqual(
+        snmp.BULK_SIZES.size(target._bulk_key()), 1)
+
+  def testAgent(self):
+    servers = self.loop.run_until_complete(
+        replay.serve([replay.Responder(capture())], '127.0.0.1', 0))
+    host, port, transport = servers[0]
+    self.addCleanup(transport.close)
+    target = snmp.SnmpTarget('test1', '127.0.0.1', 1234, 'access',
+        version=2, community='public', port=port)
+
+    results, failed = self.loop.run_until_complete(
+        asyncsnmp.walk_table(target, self.columns))
+    self.assertEqual(failed, {})
+    self.assertEqual(results['.1.3.6.1.2.1.2.2.1.10.1'],
+                     snmp.ResultTuple('4294967295', 'COUNTER'))
+    self.assertEqual(len(results), 5)
+    results = self.loop.run_until_complete(
+        asyncsnmp.walk(target, '.1.3.6.1.2.1.17.4.3.1.2', vlan=10))
+    self.assertEqual(results, {
+      '.1.3.6.1.2.1.17.4.3.1.2.1': snmp.ResultTuple('-3', 'INTEGER')})
+    engine = asyncsnmp._ENGINES[self.loop]
+    self.addCleanup(engine.transport.close)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
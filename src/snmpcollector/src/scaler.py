@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""Start and stop worker processes following the SnmpWalk queues.
+
+Every trigger floods the SnmpWalk queue with one message per device and
+the workers are idle once it has been drained. Instead of running a fixed
+number of workers the scaler keeps between --min-workers and
+--max-workers of them, sized after the queue:
+
+  * Enough workers for every one of them to have at most --backlog
+    devices (or batches of devices) queued.
+  * One more worker every --latency seconds the queue has not been empty,
+    as the round will otherwise take longer than that to poll.
+  * One worker less every --cooldown seconds the queue stays empty.
+"""
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import actions
+import metrics
+import stage
+import transport
+
+WORKER_COUNT = metrics.gauge(
+    'snmp_scaler_workers', 'Number of worker processes running')
+
+QUEUE_DEPTH = metrics.gauge(
+    'snmp_scaler_queue_depth', 'Number of devices waiting to be polled')
+
+
+class WorkerProcesses(object):
+  """The worker processes started by the scaler."""
+
+  def __init__(self, command):
+    self.command = command
+    self.processes = []
+
+  def size(self):
+    self.reap()
+    return len(self.processes)
+
+  def reap(self):
+    for process in list(self.processes):
+      if process.poll() is not None:
+        logging.warning('Worker %d exited with %d',
+            process.pid, process.returncode)
+        self.processes.remove(process)
+
+  def resize(self, count):
+    while len(self.processes) < count:
+      process = subprocess.Popen(self.command)
+      logging.info('Started worker %d', process.pid)
+      self.processes.append(process)
+    while len(self.processes) > count:
+      # Messages a worker has not acked are redelivered to the others
+      process = self.processes.pop()
+      logging.info('Stopping worker %d', process.pid)
+      process.terminate()
+      process.wait()
+
+  def stop(self):
+    self.resize(0)
+
+
+class Autoscaler(object):
+
+  def __init__(self, mq, workers, queues, minimum=1, maximum=10, backlog=50,
+      latency=60, cooldown=120):
+    self.mq = mq
+    self.workers = workers
+    self.queues = queues
+    self.minimum = minimum
+    self.maximum = maximum
+    self.backlog = backlog
+    self.latency = latency
+    self.cooldown = cooldown
+    # When the queue last went from empty to non-empty, or the other way
+    self.backlog_since = None
+    self.idle_since = None
+
+  def desired(self, depth, now):
+    """Returns how many workers there should be with depth devices queued."""
+    current = self.workers.size()
+    wanted = current
+    if depth:
+      self.idle_since = None
+      if self.backlog_since is None:
+        self.backlog_since = now
+      wanted = max(wanted, (depth + self.backlog - 1) // self.backlog)
+      if now - self.backlog_since >= self.latency:
+        wanted = max(wanted, current + 1)
+        self.backlog_since = now
+    else:
+      self.backlog_since = None
+      if self.idle_since is None:
+        self.idle_since = now
+      if now - self.idle_since >= self.cooldown:
+        wanted = current - 1
+        self.idle_since = now
+    return min(max(wanted, self.minimum), self.maximum)
+
+  def scale(self, now=None):
+    depth = sum(self.mq.depth(x) for x in self.queues)
+    wanted = self.desired(depth, time.time() if now is None else now)
+    if wanted != self.workers.size():
+      logging.info('%d devices queued, scaling from %d to %d workers',
+          depth, self.workers.size(), wanted)
+      self.workers.resize(wanted)
+    QUEUE_DEPTH.set(depth)
+    WORKER_COUNT.set(wanted)
+    return wanted
+
+
+def _terminate(signum, frame):
+  raise SystemExit(0)
+
+
+def main():
+  parser = stage.argument_parser()
+  parser.add_argument('--min-workers', dest='min_workers', type=int,
+      default=1, help='number of workers to keep running when idle')
+  parser.add_argument('--max-workers', dest='max_workers', type=int,
+      default=10, help='upper limit on the number of workers')
+  parser.add_argument('--backlog', dest='backlog', type=int, default=50,
+      help='number of queued devices per worker')
+  parser.add_argument('--latency', dest='latency', type=float, default=60,
+      help='add a worker for every this many seconds the queue is not empty')
+  parser.add_argument('--cooldown', dest='cooldown', type=float, default=120,
+      help='remove a worker for every this many seconds the queue is empty')
+  parser.add_argument('--interval', dest='interval', type=float, default=5,
+      help='seconds between looking at the queue')
+  args = parser.parse_args()
+  stage.setup_logging(args.debug)
+
+  if args.pidfile:
+    with open(args.pidfile, 'w') as f:
+      f.write(str(os.getpid()))
+  if args.metrics_port:
+    metrics.start_http_server(args.metrics_port)
+
+  command = [
+      os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py'),
+      '--instance=%s' % args.instance,
+      '--concurrency=%d' % args.concurrency]
+  if args.debug:
+    command.append('--debug')
+  workers = WorkerProcesses(command)
+
+  mq = transport.PikaTransport()
+  mq.connect()
+  scaler = Autoscaler(
+      mq, workers, [actions.SnmpWalk.get_queue(args.instance),
+                    actions.SnmpWalkBatch.get_queue(args.instance)],
+      args.min_workers, args.max_workers, args.backlog, args.latency,
+      args.cooldown)
+
+  signal.signal(signal.SIGTERM, _terminate)
+  try:
+    while True:
+      scaler.scale()
+      # Keeps the connection alive while waiting
+      mq.process_events(args.interval)
+  except KeyboardInterrupt:
+    logging.error('Keyboard interrupt, shutting down..')
+  finally:
+    workers.stop()
+    mq.close()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,71 @@
+import unittest
+
+import actions
+import scaler
+import transport
+
+
+class FakeWorkers(object):
+
+  def __init__(self, count=0):
+    self.count = count
+
+  def size(self):
+    return self.count
+
+  def resize(self, count):
+    self.count = count
+
+
+class TestAutoscaler(unittest.TestCase):
+
+  def setUp(self):
+    self.broker = transport.MemoryBroker()
+    self.queue = actions.SnmpWalk.get_queue('test')
+    self.workers = FakeWorkers(1)
+    self.scaler = scaler.Autoscaler(
+        transport.MemoryTransport(self.broker), self.workers, [self.queue],
+        minimum=1, maximum=4, backlog=10, latency=60, cooldown=120)
+
+  def queueDevices(self, count):
+    for i in range(count):
+      self.broker.put(self.queue, (None, None))
+
+  def testScaleWithBacklog(self):
+    self.queueDevices(25)
+    self.assertEqual(self.scaler.scale(now=0), 3)
+    self.queueDevices(100)
+    self.assertEqual(self.scaler.scale(now=1), 4)
+
+  def testScaleOnLatency(self):
+    self.queueDevices(5)
+    self.assertEqual(self.scaler.scale(now=0), 1)
+    self.assertEqual(self.scaler.scale(now=59), 1)
+    self.assertEqual(self.scaler.scale(now=60), 2)
+    self.assertEqual(self.scaler.scale(now=61), 2)
+    self.assertEqual(self.scaler.scale(now=120), 3)
+
+  def testRetireWhenIdle(self):
+    self.workers.count = 3
+    self.assertEqual(self.scaler.scale(now=0), 3)
+    self.assertEqual(self.scaler.scale(now=119), 3)
+    self.assertEqual(self.scaler.scale(now=120), 2)
+    self.assertEqual(self.scaler.scale(now=240), 1)
+    self.assertEqual(self.scaler.scale(now=360), 1)
+
+  def testBacklogResetsIdle(self):
+    self.workers.count = 2
+    self.scaler.scale(now=0)
+    self.queueDevices(1)
+    self.scaler.scale(now=100)
+    self.broker.purge(self.queue)
+    self.assertEqual(self.scaler.scale(now=150), 2)
+    self.assertEqual(self.scaler.scale(now=270), 1)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -1,13 +1,75 @@
+import atexit
 import collections
+import contextlib
+import gzip
+import json
 import logging
 import os
 import sys
+import threading
+import time
+
+import metrics
 
 
 _NETSNMP_CACHE = None
 
+# Pooled sessions unused for this many seconds are closed
+SESSION_IDLE_TIMEOUT = 300
+
+SESSION_HITS = metrics.counter(
+    'snmp_session_pool_hits', 'Number of SNMP sessions reused from the pool')
+
+SESSION_MISSES = metrics.counter(
+    'snmp_session_pool_misses', 'Number of SNMP sessions that were created')
+
+SESSION_SETUP = metrics.summary(
+    'snmp_session_setup_seconds', 'Time it takes to create an SNMP session')
+
+# Largest GETBULK max-repetitions to ask for
+BULK_MAX_SIZE = 256
+
+# What to divide max-repetitions with when a GETBULK times out
+BULK_BACKOFF = 16
+
+# Successful walks before trying a twice as large max-repetitions again
+BULK_PROBE_INTERVAL = 10
+
+# Seconds between writing learned sizes to disk, and reading what the other
+# processes wrote
+BULK_SAVE_INTERVAL = 60
+
+# How long a detected model is used for, unless configured
+MODEL_CACHE_TTL = 3600
+
+# Seconds the boot time calculated from sysUpTime may drift
+MODEL_BOOT_SLACK = 60
+
+MODEL_CACHE_HITS = metrics.counter(
+    'snmp_model_cache_hits', 'Number of polls using a cached device model')
+
+MODEL_CACHE_MISSES = metrics.counter(
+    'snmp_model_cache_misses', 'Number of polls that had to find the model')
+
+BULK_TIMEOUTS = metrics.counter(
+    'snmp_bulk_timeouts', 'Number of GETBULK requests that timed out and '
+    'were retried with a smaller max-repetitions')
+
 ResultTuple = collections.namedtuple('ResultTuple', ['value', 'type'])
 
+MODEL_OIDS = [
+    '.1.3.6.1.2.1.47.1.1.1.1.13.1',     # Normal switches
+    '.1.3.6.1.2.1.47.1.1.1.1.13.1001',  # Stacked switches
+    '.1.3.6.1.2.1.47.1.1.1.1.13.10',    # Nexus
+    '.1.3.6.1.2.1.1.1.0',               # Other appliances (sysDescr)
+    '.1.3.6.1.2.1.1.1',                 # Other appliances (sysDescr)
+]
+
+SYSUPTIME_OID = '.1.3.6.1.2.1.1.3.0'
+
+# vtpVlanState, indexed by the VLAN
+VLAN_OID = '.1.3.6.1.4.1.9.9.46.1.3.1.1.2'
+
 
 class Error(Exception):
   """Base error class for this module."""
@@ -21,10 +83,474 @@ class NoModelOid(Error):
   """Could not locate a model for the switch."""
 
 
+class BudgetExceeded(Error):
+  """The time budget for polling the device has run out."""
+
+
 class SnmpError(Error):
   """A SNMP error occurred."""
 
 
+class SessionPool(object):
+  """Per process pool of SNMP sessions.
+
+  Creating a session is expensive for SNMPv3 as it does engine discovery
+  and key localization, so they are kept around for the next walk of the
+  same device and context. A session is only used by one thread at a time.
+  """
+
+  def __init__(self, idle_timeout=SESSION_IDLE_TIMEOUT):
+    self.idle_timeout = idle_timeout
+    self.lock = threading.Lock()
+    # key -> [(session, last used)], most recently used last
+    self.idle = collections.defaultdict(list)
+    self.hits = 0
+    self.misses = 0
+    self.setup_time = 0.0
+
+  @contextlib.contextmanager
+  def session(self, key, create):
+    """Lends out a session for key, calling create() if there is none."""
+    session = self._take(key)
+    if session is None:
+      start = time.time()
+      session = create()
+      setup_time = time.time() - start
+      with self.lock:
+        self.misses += 1
+        self.setup_time += setup_time
+      SESSION_MISSES.inc()
+      SESSION_SETUP.observe(setup_time)
+    else:
+      SESSION_HITS.inc()
+    try:
+      yield session
+    except Error:
+      # Errors from talking to the device, the session itself is fine
+      self._put(key, session)
+      raise
+    self._put(key, session)
+
+  def _put(self, key, session):
+    with self.lock:
+      self.idle[key].append((session, time.time()))
+
+  def _take(self, key):
+    with self.lock:
+      self._evict(time.time())
+      sessions = self.idle.get(key, None)
+      if not sessions:
+        return None
+      self.hits += 1
+      return sessions.pop()[0]
+
+  def _evict(self, now):
+    for key, sessions in list(self.idle.items()):
+      sessions[:] = [x for x in sessions if now - x[1] < self.idle_timeout]
+      if not sessions:
+        del self.idle[key]
+
+
+SESSION_POOL = SessionPool()
+
+
+def _load_entries(filename):
+  """Returns the list saved with _save_entries, empty if there is none."""
+  try:
+    with open(filename, 'r') as f:
+      return json.load(f)
+  except (IOError, OSError, ValueError):
+    return []
+
+
+def _save_entries(filename, entries):
+  """Atomically replaces filename, other processes may be reading it."""
+  temporary = '%s.%d' % (filename, os.getpid())
+  try:
+    with open(temporary, 'w') as f:
+      json.dump(entries, f)
+    os.rename(temporary, filename)
+  except (IOError, OSError) as e:
+    logging.warning('Unable to save %s: %s', filename, e)
+
+
+class BulkSizes(object):
+  """Learned GETBULK max-repetitions per device and OID subtree.
+
+  Some devices (notably Nexus) silently drop responses that need to be
+  fragmented, which shows up as a timeout. Every timeout is expensive, so
+  the largest max-repetitions that works is remembered across polls and
+  optionally on disk across restarts. Once a size has worked for a while a
+  twice as large one is tried, when that times out it is tried again
+  less often.
+
+  The sizes are learned in the worker pool processes, each of them saves
+  what it learned at most every BULK_SAVE_INTERVAL seconds and reads what
+  the others saved as often.
+  """
+
+  def __init__(self, probe_interval=BULK_PROBE_INTERVAL):
+    self.probe_interval = probe_interval
+    self.lock = threading.Lock()
+    # (ip, port, vlan) -> [size, successful walks, failed probes]
+    self.sizes = {}
+    self.filename = None
+    self.dirty = set()
+    self.saved = 0
+    # Saves the changes made since the last save, see _maybe_save
+    self.timer = None
+    # Modification time of the file when it was last read, and when it was
+    # last checked
+    self.mtime = None
+    self.checked = 0
+    self.save_at_exit = False
+
+  def load(self, filename):
+    """Loads sizes saved by any process using filename and saves there."""
+    self.filename = filename
+    if not filename:
+      return
+    if not self.save_at_exit:
+      atexit.register(self.save)
+      self.save_at_exit = True
+    self.checked = time.time()
+    self._read()
+
+  def _read(self):
+    """Uses the sizes in the file, except the ones not saved yet."""
+    try:
+      self.mtime = os.stat(self.filename).st_mtime
+    except OSError:
+      self.mtime = None
+    with self.lock:
+      for ip, port, vlan, size, failed in _load_entries(self.filename):
+        if isinstance(vlan, str):
+          # Learned per OID by older versions
+          continue
+        key = (ip, port, vlan)
+        entry = self.sizes.get(key, None)
+        if key in self.dirty or (entry is not None and entry[0] == size):
+          continue
+        self.sizes[key] = [size, 0, failed]
+
+  def _maybe_reload(self):
+    now = time.time()
+    if not self.filename or now - self.checked < BULK_SAVE_INTERVAL:
+      return
+    self.checked = now
+    try:
+      mtime = os.stat(self.filename).st_mtime
+    except OSError:
+      return
+    if mtime != self.mtime:
+      self._read()
+
+  def size(self, key):
+    """Returns the max-repetitions to walk the subtree in key with."""
+    self._maybe_reload()
+    entry = self.sizes.get(key, None)
+    if entry is None:
+      return BULK_MAX_SIZE
+    size, successes, failed = entry
+    if size < BULK_MAX_SIZE and successes >= self.probe_interval << failed:
+      return min(size * 2, BULK_MAX_SIZE)
+    return size
+
+  def timeout(self, key, size):
+    """Returns the size to retry with after size timed out, or None."""
+    BULK_TIMEOUTS.inc()
+    with self.lock:
+      entry = self.sizes.get(key, None)
+      if entry is not None and size > entry[0]:
+        # A failed probe, what worked before is still the best guess
+        entry[1] = 0
+        entry[2] = min(entry[2] + 1, 8)
+        retry = entry[0]
+      elif size == 1:
+        return None
+      else:
+        retry = max(1, size // BULK_BACKOFF)
+        self.sizes[key] = [retry, 0, 0]
+      self.dirty.add(key)
+    self._maybe_save()
+    return retry
+
+  def success(self, key, size):
+    """Records that a walk of the subtree in key worked with size."""
+    with self.lock:
+      entry = self.sizes.get(key, None)
+      if entry is not None and size <= entry[0]:
+        entry[1] += 1
+        return
+      self.sizes[key] = [size, 0, 0]
+      self.dirty.add(key)
+    self._maybe_save()
+
+  def _maybe_save(self):
+    if not self.filename:
+      return
+    wait = BULK_SAVE_INTERVAL - (time.time() - self.saved)
+    if wait <= 0:
+      self.save()
+      return
+    # Save the change later even if nothing else changes until then. The
+    # timer of the parent does not run in forked pool processes.
+    with self.lock:
+      if self.timer is not None and self.timer.is_alive():
+        return
+      self.timer = threading.Timer(wait, self.save)
+      self.timer.daemon = True
+      self.timer.start()
+
+  def save(self):
+    """Merges the sizes learned by this process into the file."""
+    if not self.filename:
+      return
+    with self.lock:
+      changed = dict((x, self.sizes[x]) for x in self.dirty)
+      self.dirty = set()
+      self.saved = time.time()
+    if not changed:
+      return
+    merged = {}
+    for ip, port, vlan, size, failed in _load_entries(self.filename):
+      if not isinstance(vlan, str):
+        merged[(ip, port, vlan)] = (size, failed)
+    for key, (size, _, failed) in changed.items():
+      merged[key] = (size, failed)
+    # The global context (None) does not sort with the VLANs
+    _save_entries(self.filename, [list(key) + list(value)
+      for key, value in sorted(merged.items(), key=lambda x: (
+          x[0][0], x[0][1], -1 if x[0][2] is None else x[0][2]))])
+
+
+BULK_SIZES = BulkSizes()
+
+
+class ModelCache(object):
+  """Device models, valid for ttl seconds or until the device reboots.
+
+  Finding the model takes several GETs before any polling can start, and
+  it rarely changes. With a file the models found by one worker process
+  are used by all of them.
+  """
+
+  def __init__(self, ttl=MODEL_CACHE_TTL):
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    # (ip, port) -> (model, boot time, detected)
+    self.models = {}
+    self.filename = None
+    self.mtime = None
+
+  def load(self, filename, ttl=None):
+    """Share the models with other processes using filename."""
+    self.filename = filename
+    if ttl:
+      self.ttl = ttl
+
+  def lookup(self, key, now=None):
+    """Returns (model, boot time) for key or None if it has to be found."""
+    now = time.time() if now is None else now
+    entry = self.models.get(key, None)
+    if entry is None or now - entry[2] >= self.ttl:
+      self._reload()
+      entry = self.models.get(key, None)
+    if entry is None or now - entry[2] >= self.ttl:
+      MODEL_CACHE_MISSES.inc()
+      return None
+    return entry[:2]
+
+  def rebooted(self, key, booted, uptime, now=None):
+    """Returns True, and forgets the model, if the device has rebooted.
+
+    booted is from lookup() and uptime the current sysUpTime in seconds,
+    when either is unknown only the ttl applies.
+    """
+    now = time.time() if now is None else now
+    if uptime is not None and booted is not None and (
+        abs(now - uptime - booted) > MODEL_BOOT_SLACK):
+      logging.info('%s:%s has rebooted, finding the model again', *key)
+      self.invalidate(key)
+      MODEL_CACHE_MISSES.inc()
+      return True
+    MODEL_CACHE_HITS.inc()
+    return False
+
+  def store(self, key, model, uptime, now=None):
+    now = time.time() if now is None else now
+    booted = None if uptime is None else now - uptime
+    with self.lock:
+      self.models[key] = (model, booted, now)
+    self._save({key: (model, booted, now)})
+
+  def invalidate(self, key):
+    with self.lock:
+      self.models.pop(key, None)
+    self._save({key: None})
+
+  def _reload(self):
+    if not self.filename:
+      return
+    try:
+      mtime = os.stat(self.filename).st_mtime
+    except OSError:
+      return
+    if mtime == self.mtime:
+      return
+    entries = _load_entries(self.filename)
+    with self.lock:
+      self.mtime = mtime
+      for ip, port, model, booted, detected in entries:
+        current = self.models.get((ip, port), None)
+        if current is None or current[2] < detected:
+          self.models[(ip, port)] = (model, booted, detected)
+
+  def _save(self, changed):
+    if not self.filename:
+      return
+    merged = dict(((ip, port), (model, booted, detected))
+        for ip, port, model, booted, detected in _load_entries(self.filename))
+    for key, value in changed.items():
+      if value is None:
+        merged.pop(key, None)
+      else:
+        merged[key] = value
+    _save_entries(self.filename, [list(key) + list(value)
+      for key, value in sorted(merged.items())])
+
+
+MODEL_CACHE = ModelCache()
+
+
+def uptime(results):
+  """Returns sysUpTime from GET results in seconds, or None."""
+  result = results.get(SYSUPTIME_OID, None)
+  try:
+    return int(result.value) / 100.0
+  except (AttributeError, TypeError, ValueError):
+    return None
+
+
+def pick_model(results):
+  """Returns the model from GET results of MODEL_OIDS, or None."""
+  for oid in MODEL_OIDS:
+    result = results.get(oid, None)
+    if result is None or result.type in ('NOSUCHOBJECT', 'NOSUCHINSTANCE'):
+      continue
+    if result.value:
+      return result.value
+  return None
+
+
+class Capture(object):
+  """The responses of a device, recorded to be served again by replay.py.
+
+  Set SnmpTarget.capture to record everything the target is sent back.
+  Saved as gzipped JSON with the values as netsnmp strings, like
+  asyncsnmp returns them.
+  """
+
+  def __init__(self, host=None):
+    self.host = host
+    # vlan -> {oid: ResultTuple}
+    self.contexts = {}
+    # [(vlan, oids)] walked with walk_table, in order
+    self.walks = []
+
+  def add(self, vlan, results):
+    context = self.contexts.setdefault(vlan, {})
+    for oid, result in results.items():
+      if result.type in ('NOSUCHOBJECT', 'NOSUCHINSTANCE', 'ENDOFMIBVIEW'):
+        continue
+      value = result.value
+      if isinstance(value, bytes):
+        value = value.decode('latin-1')
+      elif value is not None and not isinstance(value, str):
+        value = str(value)
+      context[oid] = ResultTuple(value, result.type)
+
+  def add_results(self, results):
+    """Add results keyed by (oid, vlan), like in actions.Result."""
+    for (oid, vlan), result in results.items():
+      self.add(vlan, {oid: result})
+
+  def add_walk(self, vlan, oids):
+    if (vlan, list(oids)) not in self.walks:
+      self.walks.append((vlan, list(oids)))
+
+  def save(self, filename):
+    contexts = dict(('' if vlan is None else str(vlan), sorted(
+        [oid, x.type, x.value] for oid, x in context.items()))
+        for vlan, context in self.contexts.items())
+    with gzip.open(filename, 'wt') as f:
+      json.dump({'host': self.host, 'contexts': contexts,
+                 'walks': self.walks}, f)
+
+  @classmethod
+  def load(cls, filename):
+    with gzip.open(filename, 'rt') as f:
+      data = json.load(f)
+    capture = cls(data.get('host', None))
+    for vlan, rows in data.get('contexts', {}).items():
+      capture.contexts[int(vlan) if vlan else None] = dict(
+          (oid, ResultTuple(value, type)) for oid, type, value in rows)
+    capture.walks = [(vlan, oids) for vlan, oids in data.get('walks', [])]
+    return capture
+
+
+def _collect_table(columns, varbinds, ret, resume):
+  """Collect a GETBULK response for a multi-column walk into ret.
+
+  varbinds are (oid, ResultTuple, position) in the order they were
+  returned, which is row by row for the columns requested. position is
+  where to continue walking the column from and is saved in resume.
+
+  Returns the columns that have been walked to the end.
+  """
+  if not varbinds:
+    return set(columns)
+  done = set()
+  for i, (oid, result, position) in enumerate(varbinds):
+    column = columns[i % len(columns)]
+    if column in done:
+      continue
+    # We don't want to save extra oids that the bulk walk might have
+    # contained.
+    if (result.type == 'ENDOFMIBVIEW' or not oid.startswith(column + '.') or
+        position == resume[column]):
+      done.add(column)
+      continue
+    ret[oid] = result
+    resume[column] = position
+  # Columns missing from a truncated response are asked for again
+  return done
+
+
+def walk_hosts(targets, oids, community):
+  """Walk the same subtrees on many devices in one fastsnmp poller call.
+
+  Returns:
+    ({ip: {oid: ResultTuple}}, timed_out) where timed_out is the set of the
+    IPs that did not answer some request, or returned nothing at all. What
+    they did return is kept, but may be incomplete.
+  """
+  from fastsnmp import snmp_poller
+  ret = dict((x.ip, {}) for x in targets)
+  timed_out = set()
+  for data in snmp_poller.poller(
+      tuple(sorted(ret)), (tuple(x[1:] for x in oids), ), community):
+    snmp_host, snmp_oid, snmp_idx, snmp_value, snmp_type = data
+    if isinstance(snmp_value, Exception):
+      # fastsnmp reports timeouts as the value
+      timed_out.add(snmp_host)
+      continue
+    ret.setdefault(snmp_host, {})['.%s.%s' % (snmp_oid, snmp_idx)] = (
+        ResultTuple(snmp_value, snmp_type))
+  timed_out.update(ip for ip, results in ret.items() if not results)
+  return ret, timed_out
+
+
 class SnmpTarget(object):
 
   def __init__(self, host, ip, timestamp, layer, version, community=None,
@@ -45,7 +571,15 @@ class SnmpTarget(object):
     self.priv_proto=priv_proto
     self.priv=priv
     self.sec_level=sec_level
+    self.port=port
     self.netsnmp = None
+    # time.time() after which no new requests are sent, see Worker.budget
+    self.deadline = None
+    # {oid: seconds} of the OIDs not walked on every poll, see
+    # Worker.oid_intervals
+    self.intervals = {}
+    # Capture recording the responses, see replay.py
+    self.capture = None
 
   def __eq__(self, other):
     if not isinstance(other, self.__class__):
@@ -59,6 +593,14 @@ class SnmpTarget(object):
         self.priv == other.priv and self.sec_level == other.sec_level)
 
   def _snmp_session(self, vlan=None, timeout=2000000, retries=3):
+    """Returns a context manager holding a (session, netsnmp) tuple."""
+    key = (self.ip, self.port, self.version, self.community, self.user,
+        self.auth_proto, self.auth, self.priv_proto, self.priv,
+        self.sec_level, vlan, timeout, retries)
+    return SESSION_POOL.session(
+        key, lambda: self._new_snmp_session(vlan, timeout, retries))
+
+  def _new_snmp_session(self, vlan, timeout, retries):
     # Since pickle will import this module we do not want to drag netsnmp into
     # this on every load. Load it when we need it.
     global _NETSNMP_CACHE
@@ -92,7 +634,7 @@ class SnmpTarget(object):
         PrivProto=self.priv_proto, PrivPass=self.priv,
         UseNumeric=1, Timeout=timeout, Retries=retries), netsnmp
     else:
-      community = ('%s@%s' % (self.community, vlan)) if vlan else self.community
+      community = self._community(vlan)
       session = netsnmp.Session(Version=self.version, DestHost=self._full_host,
           Community=community, UseNumeric=1, Timeout=timeout,
           Retries=retries), netsnmp
@@ -103,8 +645,36 @@ class SnmpTarget(object):
       os.close(stderr)
     return session
 
+  def _check_deadline(self, oids):
+    """Returns {oid: BudgetExceeded} if the deadline has passed."""
+    if self.deadline is None or time.time() < self.deadline:
+      return {}
+    error = BudgetExceeded('Time budget of %s exceeded' % self.host)
+    return dict((oid, error) for oid in oids)
+
+  def _record(self, vlan, results, walked=None):
+    if self.capture is None:
+      return
+    self.capture.add(vlan, results)
+    if walked:
+      self.capture.add_walk(vlan, walked)
+
+  def _bulk_key(self, vlan=None):
+    # Per device and context, not per OID: the OIDs walked change with the
+    # collections, intervals and budgets, what gets fragmented does not
+    return (self.ip, self.port, vlan)
+
+  def _community(self, vlan=None):
+    # Cisco selects the VLAN context with community@vlan for SNMPv2
+    return ('%s@%s' % (self.community, vlan)) if vlan else self.community
+
   def walk_fastsnmp(self, oids, vlan=None):
+    """Like walk_table, but the OIDs lack the leading dot.
+
+    The OIDs of a group that timed out are in failed, keyed with the dot.
+    """
     ret = {}
+    failed = {}
 
     from fastsnmp import snmp_poller
   
@@ -119,113 +689,210 @@ class SnmpTarget(object):
       t_oids = ([]) 
       for oid in new_oids[oid_base]:
          t_oids.append(oid)
-      snmp_data = snmp_poller.poller((self.ip,), tuple([t_oids]), self.community)
+      snmp_data = snmp_poller.poller(
+          (self.ip,), tuple([t_oids]), self._community(vlan))
       for data in snmp_data:
         snmp_host, snmp_oid, snmp_idx, snmp_value, snmp_type = data
+        if isinstance(snmp_value, Exception):
+          # fastsnmp reports timeouts as the value
+          for oid in t_oids:
+            failed['.' + oid] = TimeoutError(
+                'Timeout walking .%s on %s' % (oid, self.host))
+          continue
         ret[ ".%s.%s" %(snmp_oid, snmp_idx) ] = ResultTuple(snmp_value, snmp_type)
 
-    return ret
+    return ret, failed
 
 
   def walk(self, oid, vlan=None):
     ret = {}
-    nextoid = oid
-    offset = 0
 
     if sys.version_info[0] == 3:
       from fastsnmp import snmp_poller
-      snmp_data =[x for x in snmp_poller.poller((self.ip,), ([oid[1:]],), self.community) ]
+      snmp_data =[x for x in snmp_poller.poller((self.ip,), ([oid[1:]],), self._community(vlan)) ]
      
       for data in snmp_data:
           snmp_host, snmp_oid, snmp_idx, snmp_value, snmp_type = data
+          if isinstance(snmp_value, Exception):
+            # fastsnmp reports timeouts as the value
+            raise TimeoutError('Timeout walking %s on %s' % (oid, self.host))
           ret[ ".%s.%s" %(snmp_oid, snmp_idx) ] = ResultTuple(snmp_value, snmp_type)
+      self._record(vlan, ret, [oid])
       return ret
 
-    sess, netsnmp = self._snmp_session(vlan)
-    # Abort the walk when it exits the OID tree we are interested in
-    while nextoid.startswith(oid):
-      if offset == 0:
-         var_list = netsnmp.VarList(netsnmp.Varbind(nextoid))
-      else:
-         var_list = netsnmp.VarList(netsnmp.Varbind(nextoid, offset))
-      sess.getbulk(nonrepeaters=0, maxrepetitions=self._max_size, varlist=var_list)
-
-      # WORKAROUND FOR NEXUS BUG (2014-11-24)
-      # Indy told blueCmd that Nexus silently drops the SNMP response
-      # if the packet is fragmented. Try with large size first, but drop down
-      # to smaller one.
-      if sess.ErrorStr == 'Timeout':
-        if self._max_size == 1:
-          raise TimeoutError(
-              'Timeout getting %s from %s' % (nextoid, self.host))
-        self._max_size = int(self._max_size / 16)
-        continue
-      if sess.ErrorStr != '':
-        raise SnmpError('SNMP error while walking host %s: %s' % (
-          self.host, sess.ErrorStr))
-
-      for result in var_list:
-        currentoid = '%s.%s' % (result.tag, int(result.iid))
-        # We don't want to save extra oids that the bulk walk might have
-        # contained.
-        if not currentoid.startswith(oid):
-          break
-        ret[currentoid] = ResultTuple(result.val, result.type)
-      # Continue bulk walk
-      offset = int(var_list[-1].iid)
-      if offset == 0:
-         break
-      nextoid = var_list[-1].tag
+    ret, failed = self.walk_table([oid], vlan)
+    if oid in failed:
+      raise failed[oid]
     return ret
 
-  def get(self, oid):
+  def walk_table(self, oids, vlan=None):
+    """Walk several OID subtrees, usually the columns of a table, at once.
+
+    Every GETBULK asks for the next rows of all the subtrees that have not
+    been walked to the end, so a table takes as many round-trips as its
+    longest column instead of the sum of them.
+
+    Returns:
+      (results, failed) where failed maps the OIDs that could not be
+      walked (completely) to the Error.
+    """
+    ret = {}
+    failed = {}
+    if not oids:
+      return ret, failed
 
     if sys.version_info[0] == 3:
+      failed = self._check_deadline(oids)
+      if failed:
+        return ret, failed
       from fastsnmp import snmp_poller
-      snmp_data =[x for x in snmp_poller.poller((self.ip,), ([oid[1:]],), self.community) ]
-      if len(snmp_data) == 0:
-         return { oid: ResultTuple("", "OCTETSTR") }
-      return { oid: ResultTuple(snmp_data[0][3], snmp_data[0][4]) }
+      # fastsnmp walks the OIDs of a group together by itself
+      for data in snmp_poller.poller(
+          (self.ip,), ([x[1:] for x in oids],), self._community(vlan)):
+        snmp_host, snmp_oid, snmp_idx, snmp_value, snmp_type = data
+        if isinstance(snmp_value, Exception):
+          # fastsnmp reports timeouts as the value
+          for oid in oids:
+            failed[oid] = TimeoutError(
+                'Timeout getting %s from %s' % (oid, self.host))
+          continue
+        ret['.%s.%s' % (snmp_oid, snmp_idx)] = ResultTuple(
+            snmp_value, snmp_type)
+      self._record(vlan, ret, oids)
+      return ret, failed
+
+    # The learned size is the number of varbinds in a response, which is
+    # what decides if it has to be fragmented.
+    bulk_key = self._bulk_key(vlan)
+    max_size = min(BULK_SIZES.size(bulk_key), self._max_size)
+    # OID -> (tag, iid) to continue walking it from
+    resume = collections.OrderedDict((oid, (oid, None)) for oid in oids)
+    with self._snmp_session(vlan) as (sess, netsnmp):
+      while resume:
+        columns = list(resume)
+        failed = self._check_deadline(columns)
+        if failed:
+          return ret, failed
+        var_list = netsnmp.VarList(*[
+            netsnmp.Varbind(tag) if iid is None else netsnmp.Varbind(tag, iid)
+            for tag, iid in resume.values()])
+        sess.getbulk(nonrepeaters=0,
+            maxrepetitions=max(1, max_size // len(columns)), varlist=var_list)
+
+        # WORKAROUND FOR NEXUS BUG (2014-11-24)
+        # Indy told blueCmd that Nexus silently drops the SNMP response
+        # if the packet is fragmented. Try with large size first, but drop down
+        # to smaller one. What worked is remembered for the next poll.
+        if sess.ErrorStr == 'Timeout':
+          max_size = BULK_SIZES.timeout(bulk_key, max_size)
+          if max_size is None:
+            for column in columns:
+              failed[column] = TimeoutError(
+                  'Timeout getting %s from %s' % (column, self.host))
+            return ret, failed
+          continue
+        if sess.ErrorStr != '':
+          for column in columns:
+            failed[column] = SnmpError('SNMP error while walking host %s: %s' % (
+              self.host, sess.ErrorStr))
+          return ret, failed
+
+        varbinds = [('%s.%s' % (x.tag, int(x.iid)), ResultTuple(x.val, x.type),
+                     (x.tag, x.iid)) for x in var_list]
+        for column in _collect_table(columns, varbinds, ret, resume):
+          del resume[column]
+    BULK_SIZES.success(bulk_key, max_size)
+    self._record(vlan, ret, oids)
+    return ret, failed
+
+  def _get_fastsnmp(self, oids, vlan=None):
+    """GET all of oids in one request, the OIDs the device lacks are left out."""
+    from fastsnmp import snmp_poller
+    ret = {}
+    for data in snmp_poller.poller((self.ip,), ([x[1:] for x in oids],),
+                                   self._community(vlan), msg_type='Get'):
+      snmp_host, snmp_oid, snmp_idx, snmp_value, snmp_type = data
+      if isinstance(snmp_value, Exception):
+        # fastsnmp reports timeouts as the value
+        raise TimeoutError('Timeout getting %s from %s' % (
+          ', '.join(oids), self.host))
+      oid = '.%s.%s' % (snmp_oid, snmp_idx) if snmp_idx else '.' + snmp_oid
+      ret[oid] = ResultTuple(snmp_value, snmp_type)
+    self._record(vlan, ret)
+    return ret
 
+  def get(self, oid):
+    if sys.version_info[0] == 3:
+      return self._get_fastsnmp([oid])
 
+    with self._snmp_session(timeout=5000000, retries=2) as (sess, netsnmp):
+      var = netsnmp.Varbind(oid)
+      var_list = netsnmp.VarList(var)
+      sess.get(var_list)
+      if sess.ErrorStr != '':
+        if sess.ErrorStr == 'Timeout':
+          raise TimeoutError('Timeout getting %s from %s' % (oid, self.host))
+        raise SnmpError('SNMP error while talking to host %s: %s' % (
+          self.host, sess.ErrorStr))
 
-    sess, netsnmp = self._snmp_session(timeout=5000000, retries=2)
+    ret = {var.tag: ResultTuple(var.val, var.type)}
+    self._record(None, ret)
+    return ret
 
-    var = netsnmp.Varbind(oid)
-    var_list = netsnmp.VarList(var)
-    sess.get(var_list)
-    if sess.ErrorStr != '':
-      if sess.ErrorStr == 'Timeout':
-        raise TimeoutError('Timeout getting %s from %s' % (oid, self.host))
-      raise SnmpError('SNMP error while talking to host %s: %s' % (
-        self.host, sess.ErrorStr))
+  def get_many(self, oids, vlan=None):
+    """Like get() but for several OIDs in one request."""
+    if sys.version_info[0] == 3:
+      return self._get_fastsnmp(oids, vlan)
 
+    with self._snmp_session(vlan, timeout=5000000, retries=2) as (
+        sess, netsnmp):
+      var_list = netsnmp.VarList(*[netsnmp.Varbind(oid) for oid in oids])
+      sess.get(var_list)
+      if sess.ErrorStr != '':
+        if sess.ErrorStr == 'Timeout':
+          raise TimeoutError('Timeout getting %s from %s' % (
+            ', '.join(oids), self.host))
+        raise SnmpError('SNMP error while talking to host %s: %s' % (
+          self.host, sess.ErrorStr))
+
+    # The varbinds are returned in the order they were asked for
+    ret = dict((oid, ResultTuple(var.val, var.type))
+               for oid, var in zip(oids, var_list))
+    self._record(vlan, ret)
+    return ret
 
-    return {var.tag: ResultTuple(var.val, var.type)}
+  def _model_key(self):
+    return (self.ip, self.port)
 
   def model(self):
-    model_oids = [
-        '.1.3.6.1.2.1.47.1.1.1.1.13.1',     # Normal switches
-        '.1.3.6.1.2.1.47.1.1.1.1.13.1001',  # Stacked switches
-        '.1.3.6.1.2.1.47.1.1.1.1.13.10',    # Nexus
-        '.1.3.6.1.2.1.1.1.0',               # Other appliances (sysDescr)
-        '.1.3.6.1.2.1.1.1',                 # Other appliances (sysDescr)
-    ]
-    for oid in model_oids:
-      model = self.get(oid)
-      if not model:
-        continue
-      if sys.version_info[0] < 3:
-        value = model.values().pop().value
-      else:
-        value = list(model.values()).pop().value
-      if value:
-        return value
-    raise NoModelOid('No model OID contained a model')
+    key = self._model_key()
+    # A capture needs the model OIDs to replay the model
+    cached = MODEL_CACHE.lookup(key) if self.capture is None else None
+    if cached is not None:
+      model, booted = cached
+      if not MODEL_CACHE.rebooted(
+          key, booted, uptime(self.get_many([SYSUPTIME_OID]))):
+        return model
+
+    oids = MODEL_OIDS + [SYSUPTIME_OID]
+    try:
+      results = self.get_many(oids)
+    except SnmpError:
+      # SNMPv1 fails the whole request if any of the OIDs is missing
+      results = {}
+      for oid in oids:
+        results.update(self.get(oid))
+        if pick_model(results):
+          break
+    model = pick_model(results)
+    if not model:
+      raise NoModelOid('No model OID contained a model')
+    MODEL_CACHE.store(key, model, uptime(results))
+    return model
 
   def vlans(self):
     try:
-      oids = self.walk('.1.3.6.1.4.1.9.9.46.1.3.1.1.2').keys()
+      oids = self.walk(VLAN_OID).keys()
       vlans = {int(x.split('.')[-1]) for x in oids}
       return vlans
     except ValueError as e:
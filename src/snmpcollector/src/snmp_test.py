@@ -0,0 +1,488 @@
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import snmp
+
+
+class TestSessionPool(unittest.TestCase):
+
+  def setUp(self):
+    self.pool = snmp.SessionPool(idle_timeout=300)
+    patcher = mock.patch('time.time')
+    self.addCleanup(patcher.stop)
+    self.mock_time = patcher.start()
+    self.mock_time.return_value = 1000
+    self.created = []
+
+  def create(self):
+    session = object()
+    self.created.append(session)
+    return session
+
+  def testReuse(self):
+    with self.pool.session('a', self.create) as first:
+      pass
+    with self.pool.session('a', self.create) as second:
+      pass
+    self.assertIs(first, second)
+    self.assertEqual((self.pool.hits, self.pool.misses), (1, 1))
+
+  def testKeys(self):
+    with self.pool.session('a', self.create) as first:
+      with self.pool.session('a', self.create) as second:
+        pass
+    with self.pool.session('b', self.create) as third:
+      pass
+    self.assertEqual(len(set([id(first), id(second), id(third)])), 3)
+    self.assertEqual((self.pool.hits, self.pool.misses), (0, 3))
+
+  def testIdleEviction(self):
+    with self.pool.session('a', self.create):
+      pass
+    self.mock_time.return_value = 1300
+    with self.pool.session('a', self.create):
+      pass
+    self.assertEqual(len(self.created), 2)
+
+  def testErrors(self):
+    with self.assertRaises(snmp.TimeoutError):
+      with self.pool.session('a', self.create):
+        raise snmp.TimeoutError('Timeout')
+    with self.assertRaises(ValueError):
+      with self.pool.session('a', self.create):
+        raise ValueError('Broken session')
+    with self.pool.session('a', self.create):
+      pass
+    self.assertEqual(len(self.created), 2)
+
+
+class TestBulkSizes(unittest.TestCase):
+
+  def setUp(self):
+    self.sizes = snmp.BulkSizes(probe_interval=2)
+    self.key = ('10.0.0.1', 161, None)
+
+  def testBackoff(self):
+    self.assertEqual(self.sizes.size(self.key), 256)
+    self.assertEqual(self.sizes.timeout(self.key, 256), 16)
+    self.assertEqual(self.sizes.timeout(self.key, 16), 1)
+    self.assertEqual(self.sizes.timeout(self.key, 1), None)
+
+  def testRemembered(self):
+    self.sizes.timeout(self.key, 256)
+    self.sizes.success(self.key, 16)
+    self.assertEqual(self.sizes.size(self.key), 16)
+    self.assertEqual(self.sizes.size(('10.0.0.2', 161, self.key[2])), 256)
+
+  def testProbe(self):
+    self.sizes.timeout(self.key, 256)
+    self.sizes.success(self.key, 16)
+    self.sizes.success(self.key, 16)
+    self.assertEqual(self.sizes.size(self.key), 32)
+    self.sizes.success(self.key, 32)
+    self.assertEqual(self.sizes.size(self.key), 32)
+
+  def testFailedProbe(self):
+    self.sizes.timeout(self.key, 256)
+    self.sizes.success(self.key, 16)
+    self.sizes.success(self.key, 16)
+    self.assertEqual(self.sizes.timeout(self.key, 32), 16)
+    # Probed less often after a failed probe
+    for i in range(3):
+      self.sizes.success(self.key, 16)
+      self.assertEqual(self.sizes.size(self.key), 16)
+    self.sizes.success(self.key, 16)
+    self.assertEqual(self.sizes.size(self.key), 32)
+
+  def testSave(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    filename = os.path.join(directory, 'sizes.json')
+    self.sizes.load(filename)
+    self.sizes.timeout(self.key, 256)
+    self.sizes.save()
+
+    other = snmp.BulkSizes()
+    other.load(filename)
+    self.assertEqual(other.size(self.key), 16)
+
+  def testSaveLater(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    filename = os.path.join(directory, 'sizes.json')
+    self.sizes.load(filename)
+    with mock.patch('threading.Timer') as mock_timer:
+      self.sizes.timeout(self.key, 256)
+      self.assertFalse(mock_timer.called)
+      # Too soon after the last save, nothing else changes afterwards
+      self.sizes.timeout(self.key, 16)
+      self.sizes.success(self.key, 1)
+      self.assertEqual(mock_timer.call_count, 1)
+    wait, save = mock_timer.call_args[0]
+    self.assertTrue(0 < wait <= snmp.BULK_SAVE_INTERVAL)
+    save()
+    with open(filename) as f:
+      self.assertEqual(json.load(f), [['10.0.0.1', 161, None, 1, 0]])
+
+  def testReload(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    filename = os.path.join(directory, 'sizes.json')
+    self.sizes.load(filename)
+    other = snmp.BulkSizes()
+    other.load(filename)
+    self.assertEqual(other.size(self.key), 256)
+    self.sizes.timeout(self.key, 256)
+    # Only read again every BULK_SAVE_INTERVAL
+    self.assertEqual(other.size(self.key), 256)
+    other.checked -= snmp.BULK_SAVE_INTERVAL
+    other.mtime = None
+    self.assertEqual(other.size(self.key), 16)
+
+  def testLoadOldEntries(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    filename = os.path.join(directory, 'sizes.json')
+    with open(filename, 'w') as f:
+      json.dump([['10.0.0.1', 161, '.1.3.6.1.2.1.2.2.1', 16, 0]], f)
+    self.sizes.load(filename)
+    self.assertEqual(self.sizes.size(self.key), 256)
+    self.sizes.timeout(self.key, 256)
+    self.sizes.timeout(self.key[:2] + (10, ), 256)
+    self.sizes.save()
+    with open(filename) as f:
+      self.assertEqual(json.load(f), [['10.0.0.1', 161, None, 16, 0],
+                                      ['10.0.0.1', 161, 10, 16, 0]])
+
+
+TABLE = [
+    ('.1.3.6.1.2.1.2.2.1.2', '1', 'Gi0/1', 'OCTETSTR'),
+    ('.1.3.6.1.2.1.2.2.1.2', '2', 'Gi0/2', 'OCTETSTR'),
+    ('.1.3.6.1.2.1.2.2.1.10', '1', '10', 'COUNTER'),
+    ('.1.3.6.1.2.1.2.2.1.10', '2', '20', 'COUNTER'),
+    ('.1.3.6.1.2.1.2.2.1.11', '1', '1', 'INTEGER'),
+]
+
+SCALARS = {
+    '.1.3.6.1.2.1.1.1.0': ('Test switch', 'OCTETSTR'),
+    '.1.3.6.1.2.1.1.3.0': ('100000', 'TICKS'),
+}
+
+
+class FakeVarbind(object):
+
+  def __init__(self, tag, iid=None, val=None, type=None):
+    self.tag = tag
+    self.iid = iid
+    self.val = val
+    self.type = type
+
+
+class FakeNetsnmp(object):
+  Varbind = FakeVarbind
+
+  @staticmethod
+  def VarList(*varbinds):
+    return list(varbinds)
+
+
+class FakePoller(object):
+  """fastsnmp.snmp_poller answering GETs from SCALARS."""
+
+  class Timeout(Exception):
+    pass
+
+  def __init__(self, scalars=SCALARS):
+    self.scalars = dict(scalars)
+    self.requests = []
+    self.timeout = False
+
+  def poller(self, hosts, oids_groups, community, msg_type='GetBulk'):
+    for oids in oids_groups:
+      self.requests.append((community, msg_type, tuple(oids)))
+      if self.timeout:
+        yield hosts[0], oids, '', self.Timeout(), None
+        continue
+      for oid in oids:
+        if '.' + oid in self.scalars:
+          value, type = self.scalars['.' + oid]
+          yield hosts[0], oid, '', value, type
+
+
+class FakeSession(object):
+  """netsnmp session serving TABLE, timing out above max_size varbinds."""
+
+  def __init__(self, max_size=256):
+    self.max_size = max_size
+    self.requests = []
+    self.ErrorStr = ''
+
+  def getbulk(self, nonrepeaters, maxrepetitions, varlist):
+    self.requests.append((len(varlist), maxrepetitions))
+    if len(varlist) * maxrepetitions > self.max_size:
+      self.ErrorStr = 'Timeout'
+      return
+    self.ErrorStr = ''
+    def key(tag, iid):
+      return tuple(int(x) for x in tag[1:].split('.') + ([iid] if iid else []))
+    rows = [(key(x[0], x[1]), x) for x in TABLE]
+    positions = [key(x.tag, x.iid) for x in varlist]
+    response = []
+    for i in range(maxrepetitions):
+      for j, position in enumerate(positions):
+        following = [x for x in rows if x[0] > position]
+        if not following:
+          response.append(FakeVarbind('.1.3.6.1.6', '0', '', 'ENDOFMIBVIEW'))
+          continue
+        positions[j], row = following[0]
+        response.append(FakeVarbind(*row))
+    varlist[:] = response
+
+  def get(self, varlist):
+    self.requests.append(tuple(x.tag for x in varlist))
+    self.ErrorStr = ''
+    for var in varlist:
+      var.val, var.type = SCALARS.get(var.tag, (None, 'NOSUCHOBJECT'))
+
+
+class TestWalkTable(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch.object(snmp.sys, 'version_info', (2, 7))
+    self.addCleanup(patcher.stop)
+    patcher.start()
+    patcher = mock.patch('snmp.BULK_SIZES', snmp.BulkSizes())
+    self.addCleanup(patcher.stop)
+    patcher.start()
+    self.target = snmp.SnmpTarget(
+        'test1', '10.0.0.1', 1234, 'access', version=2, community='public')
+
+  def useSession(self, session):
+    context = mock.MagicMock()
+    context.__enter__.return_value = (session, FakeNetsnmp)
+    self.target._snmp_session = mock.Mock(return_value=context)
+
+  def testWalkTable(self):
+    session = FakeSession()
+    self.useSession(session)
+    results, failed = self.target.walk_table(
+        ['.1.3.6.1.2.1.2.2.1.2', '.1.3.6.1.2.1.2.2.1.10'])
+    self.assertEqual(failed, {})
+    self.assertEqual(results, {
+      '.1.3.6.1.2.1.2.2.1.2.1': snmp.ResultTuple('Gi0/1', 'OCTETSTR'),
+      '.1.3.6.1.2.1.2.2.1.2.2': snmp.ResultTuple('Gi0/2', 'OCTETSTR'),
+      '.1.3.6.1.2.1.2.2.1.10.1': snmp.ResultTuple('10', 'COUNTER'),
+      '.1.3.6.1.2.1.2.2.1.10.2': snmp.ResultTuple('20', 'COUNTER'),
+    })
+    self.assertEqual(session.requests, [(2, 128)])
+
+  def testLearnedSize(self):
+    session = FakeSession(max_size=20)
+    self.useSession(session)
+    columns = ['.1.3.6.1.2.1.2.2.1.2', '.1.3.6.1.2.1.2.2.1.10']
+    self.assertEqual(len(self.target.walk_table(columns)[0]), 4)
+    self.assertEqual(session.requests, [(2, 128), (2, 8)])
+
+    # The next poll builds a new target, the size is remembered
+    del session.requests[:]
+    target = snmp.SnmpTarget(
+        'test1', '10.0.0.1', 1235, 'access', version=2, community='public')
+    target._snmp_session = self.target._snmp_session
+    self.assertEqual(len(target.walk_table(columns)[0]), 4)
+    self.assertEqual(session.requests, [(2, 8)])
+
+    # Also when other OIDs are walked
+    del session.requests[:]
+    self.assertEqual(len(target.walk_table(columns[:1])[0]), 2)
+    self.assertEqual(session.requests, [(1, 16)])
+
+  def testTimeout(self):
+    self.useSession(FakeSession(max_size=0))
+    results, failed = self.target.walk_table(['.1.3.6.1.2.1.2.2.1.2'])
+    self.assertEqual(results, {})
+    self.assertIsInstance(failed['.1.3.6.1.2.1.2.2.1.2'], snmp.TimeoutError)
+    with self.assertRaises(snmp.TimeoutError):
+      self.target.walk('.1.3.6.1.2.1.2.2.1.2')
+
+  def testDeadline(self):
+    session = FakeSession()
+    self.useSession(session)
+    self.target.deadline = 0
+    results, failed = self.target.walk_table(['.1.3.6.1.2.1.2.2.1.2'])
+    self.assertEqual(results, {})
+    self.assertIsInstance(
+        failed['.1.3.6.1.2.1.2.2.1.2'], snmp.BudgetExceeded)
+    self.assertEqual(session.requests, [])
+
+
+class TestCapture(unittest.TestCase):
+
+  @mock.patch('snmp.BULK_SIZES', snmp.BulkSizes())
+  @mock.patch('snmp.MODEL_CACHE', snmp.ModelCache())
+  @mock.patch.object(snmp.sys, 'version_info', (2, 7))
+  def testRecord(self):
+    target = snmp.SnmpTarget(
+        'test1', '10.0.0.1', 1234, 'access', version=2, community='public')
+    context = mock.MagicMock()
+    context.__enter__.return_value = (FakeSession(), FakeNetsnmp)
+    target._snmp_session = mock.Mock(return_value=context)
+    target.capture = snmp.Capture(target.host)
+    target.model()
+    target.walk_table(['.1.3.6.1.2.1.2.2.1.2'], vlan=10)
+
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    filename = os.path.join(directory, 'test1.capture')
+    target.capture.save(filename)
+    capture = snmp.Capture.load(filename)
+    self.assertEqual(capture.host, 'test1')
+    self.assertEqual(capture.contexts[None], {
+      '.1.3.6.1.2.1.1.1.0': snmp.ResultTuple('Test switch', 'OCTETSTR'),
+      '.1.3.6.1.2.1.1.3.0': snmp.ResultTuple('100000', 'TICKS')})
+    self.assertEqual(capture.contexts[10], {
+      '.1.3.6.1.2.1.2.2.1.2.1': snmp.ResultTuple('Gi0/1', 'OCTETSTR'),
+      '.1.3.6.1.2.1.2.2.1.2.2': snmp.ResultTuple('Gi0/2', 'OCTETSTR')})
+    self.assertEqual(capture.walks, [(10, ['.1.3.6.1.2.1.2.2.1.2'])])
+
+
+class TestModelCache(unittest.TestCase):
+
+  def setUp(self):
+    self.cache = snmp.ModelCache(ttl=100)
+    self.key = ('10.0.0.1', 161)
+
+  def testTtl(self):
+    self.assertIsNone(self.cache.lookup(self.key, now=1000))
+    self.cache.store(self.key, 'WS-C2960', 500, now=1000)
+    self.assertEqual(self.cache.lookup(self.key, now=1099), ('WS-C2960', 500))
+    self.assertIsNone(self.cache.lookup(self.key, now=1100))
+
+  def testRebooted(self):
+    self.cache.store(self.key, 'WS-C2960', 500, now=1000)
+    self.assertFalse(self.cache.rebooted(self.key, 500, 550, now=1050))
+    self.assertFalse(self.cache.rebooted(self.key, 500, None, now=1050))
+    self.assertTrue(self.cache.rebooted(self.key, 500, 10, now=1050))
+    self.assertIsNone(self.cache.lookup(self.key, now=1050))
+
+  def testShared(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    filename = os.path.join(directory, 'models.json')
+    self.cache.load(filename)
+    other = snmp.ModelCache(ttl=100)
+    other.load(filename)
+
+    self.cache.store(self.key, 'WS-C2960', 500, now=1000)
+    self.assertEqual(other.lookup(self.key, now=1050), ('WS-C2960', 500))
+    self.cache.invalidate(self.key)
+    # The other process keeps using what it has until the ttl expires
+    self.assertIsNone(other.lookup(self.key, now=1100))
+
+  @mock.patch('snmp.MODEL_CACHE', snmp.ModelCache())
+  @mock.patch.object(snmp.sys, 'version_info', (2, 7))
+  def testModel(self):
+    target = snmp.SnmpTarget(
+        'test1', '10.0.0.1', 1234, 'access', version=2, community='public')
+    session = FakeSession()
+    context = mock.MagicMock()
+    context.__enter__.return_value = (session, FakeNetsnmp)
+    target._snmp_session = mock.Mock(return_value=context)
+
+    self.assertEqual(target.model(), 'Test switch')
+    self.assertEqual(target.model(), 'Test switch')
+    self.assertEqual(session.requests, [
+      tuple(snmp.MODEL_OIDS + [snmp.SYSUPTIME_OID]), (snmp.SYSUPTIME_OID, )])
+
+
+class TestFastsnmp(unittest.TestCase):
+
+  def setUp(self):
+    self.poller = FakePoller()
+    fastsnmp = mock.Mock(snmp_poller=self.poller)
+    patcher = mock.patch.dict('sys.modules', {
+        'fastsnmp': fastsnmp, 'fastsnmp.snmp_poller': self.poller})
+    self.addCleanup(patcher.stop)
+    patcher.start()
+    patcher = mock.patch.object(snmp.sys, 'version_info', (3, 6))
+    self.addCleanup(patcher.stop)
+    patcher.start()
+    self.target = snmp.SnmpTarget(
+        'test1', '10.0.0.1', 1234, 'access', version=2, community='public')
+
+  def testGetMany(self):
+    self.assertEqual(self.target.get_many(
+        ['.1.3.6.1.2.1.1.1.0', '.1.3.6.1.2.1.1.3.0', '.1.3.6.1.2.1.1.5.0'],
+        vlan=10), {
+      '.1.3.6.1.2.1.1.1.0': snmp.ResultTuple('Test switch', 'OCTETSTR'),
+      '.1.3.6.1.2.1.1.3.0': snmp.ResultTuple('100000', 'TICKS'),
+    })
+    # One GET in the context of the VLAN
+    self.assertEqual(self.poller.requests, [('public@10', 'Get', (
+        '1.3.6.1.2.1.1.1.0', '1.3.6.1.2.1.1.3.0', '1.3.6.1.2.1.1.5.0'))])
+
+  def testWalkHosts(self):
+    targets = [snmp.SnmpTarget('test%d' % i, '10.0.0.%d' % i, 1234, 'access',
+                               version=2, community='public')
+               for i in range(3)]
+    with mock.patch.object(self.poller, 'poller') as mock_poller:
+      mock_poller.return_value = [
+          ('10.0.0.0', '1.3.6.1.2.1.2.2.1.2', '1', 'eth0', 'OCTETSTR'),
+          ('10.0.0.1', '1.3.6.1.2.1.2.2.1.2', '1', 'eth0', 'OCTETSTR'),
+          ('10.0.0.1', ('1.3.6.1.2.1.2.2.1.2', ), '', FakePoller.Timeout(),
+           None)]
+      walked, timed_out = snmp.walk_hosts(
+          targets, ['.1.3.6.1.2.1.2.2.1.2'], 'public')
+    self.assertEqual(walked['10.0.0.0'], {
+        '.1.3.6.1.2.1.2.2.1.2.1': snmp.ResultTuple('eth0', 'OCTETSTR')})
+    # 10.0.0.2 returned nothing
+    self.assertEqual(timed_out, set(['10.0.0.1', '10.0.0.2']))
+
+  def testTimeout(self):
+    self.poller.timeout = True
+    with self.assertRaises(snmp.TimeoutError):
+      self.target.get('.1.3.6.1.2.1.1.3.0')
+
+  def testWalkTimeout(self):
+    with mock.patch.object(self.poller, 'poller') as mock_poller:
+      mock_poller.side_effect = lambda *args: iter([
+          ('10.0.0.1', '1.3.6.1.2.1.2.2.1.2', '1', 'eth0', 'OCTETSTR'),
+          ('10.0.0.1', ('1.3.6.1.2.1.2.2.1.2', ), '', FakePoller.Timeout(),
+           None)])
+      walked, failed = self.target.walk_table(['.1.3.6.1.2.1.2.2.1.2'])
+      self.assertEqual(walked, {
+          '.1.3.6.1.2.1.2.2.1.2.1': snmp.ResultTuple('eth0', 'OCTETSTR')})
+      self.assertIsInstance(
+          failed['.1.3.6.1.2.1.2.2.1.2'], snmp.TimeoutError)
+
+      walked, failed = self.target.walk_fastsnmp(['1.3.6.1.2.1.2.2.1.2'])
+      self.assertEqual(list(walked), ['.1.3.6.1.2.1.2.2.1.2.1'])
+      self.assertEqual(list(failed), ['.1.3.6.1.2.1.2.2.1.2'])
+
+      with self.assertRaises(snmp.TimeoutError):
+        self.target.walk('.1.3.6.1.2.1.2.2.1.2')
+
+  @mock.patch('snmp.MODEL_CACHE', snmp.ModelCache())
+  def testModel(self):
+    self.assertEqual(self.target.model(), 'Test switch')
+    self.assertEqual(self.target.model(), 'Test switch')
+    self.assertEqual([x[2] for x in self.poller.requests], [
+        tuple(x[1:] for x in snmp.MODEL_OIDS + [snmp.SYSUPTIME_OID]),
+        (snmp.SYSUPTIME_OID[1:], )])
+
+    # The uptime went back, the device has rebooted
+    del self.poller.requests[:]
+    self.poller.scalars[snmp.SYSUPTIME_OID] = ('100', 'TICKS')
+    self.assertEqual(self.target.model(), 'Test switch')
+    self.assertEqual(len(self.poller.requests), 2)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -7,6 +7,8 @@ import time
 
 import actions
 import config
+import mibcache
+import snmp
 import supervisor
 import worker
 
@@ -18,6 +20,12 @@ parser.add_argument(
 parser.add_argument(
     '-o', '--oid', dest='oid', default=None,
     help='walk this oid')
+parser.add_argument(
+    '-p', '--plan', dest='plan', default=False, action='store_true',
+    help='only show what would be polled on the target')
+parser.add_argument(
+    '-r', '--record', dest='record', default=None,
+    help='save everything the target answers to this file, see replay.py')
 parser.add_argument(
     '-n', '--numeric', dest='numeric', default=False, action='store_true',
     help='do not resolve oids')
@@ -54,9 +62,14 @@ if not target:
   logging.error('Target not found')
   exit(1)
 
+if args.record:
+  target.capture = snmp.Capture(target.host)
+
 logging.debug('Loading MIBs and querying device ...')
 # Load here to make user aware of what's going on
 import mibresolver
+mib_cache = mibcache.MibCache(mibresolver.resolve)
+mib_cache.load(config.get('annotator', 'mib_cache', 'filename'))
 
 model = target.model()
 if not model:
@@ -65,6 +78,22 @@ if not model:
   exit(1)
 
 logging.info('Target model: %s', model)
+
+if args.plan:
+  plan = worker_stage.plan(target, model)
+  print 'Collections:', ', '.join(plan.collections)
+  intervals = worker_stage.oid_intervals(target.layer, model)
+  for title, oids in (
+      ('Walk', plan.subtrees), ('Get', plan.scalars),
+      ('Walk in every VLAN', plan.vlan_subtrees),
+      ('Get in every VLAN', plan.vlan_scalars)):
+    for oid in oids:
+      print '%-20s %s' % (title, oid),
+      if oid in intervals:
+        print '(every %d s)' % intervals[oid],
+      print
+  exit(0)
+
 logging.info('Target VLANs: %s', target.vlans())
 
 if args.oid:
@@ -77,7 +106,7 @@ else:
       if args.numeric:
         print oid,
       else:
-        obj, enum = mibresolver.resolve(oid)
+        obj, enum = mib_cache.resolve_instance(oid)
         print obj,
       if ctxt:
         print '(%s)' % ctxt,
@@ -88,5 +117,17 @@ else:
                      '<INVALID ENUM VALUE>')),
       print
     logging.info('Run stats: %s', action.stats)
+    if args.record:
+      # The contexts are walked in other processes, record what they got
+      target.capture.add_results(action.results)
+      plan = worker_stage.plan(target, model)
+      for ctxt in sorted(set(x[1] for x in action.results), key=str):
+        target.capture.add_walk(
+            ctxt, plan.vlan_subtrees if ctxt else plan.subtrees)
+
+mib_cache.flush()
+if args.record:
+  target.capture.save(args.record)
+  logging.info('Saved capture to %s', args.record)
 
 logging.info('Duration: %s', time.time() - start)
@@ -2,13 +2,42 @@ import argparse
 import logging
 import logging.handlers
 import os
-import pickle
-import pika
 import sys
 import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
 
 import actions
+import codec
 import config
+import metrics
+import profiling
+import transport
+
+# How often the connection thread looks for finished tasks when running
+# with more than one task in flight
+COMPLETION_POLL_INTERVAL = 0.05
+
+# zlib level used for messages above mq.compress_threshold. The payloads are
+# very repetitive so the fastest level gets almost all of the gain.
+COMPRESSION_LEVEL = 1
+
+RAW_BYTES = metrics.counter(
+    'snmp_stage_raw_bytes',
+    'Bytes published before compression', ('stage', ))
+
+WIRE_BYTES = metrics.counter(
+    'snmp_stage_wire_bytes',
+    'Bytes published after compression', ('stage', ))
+
+COMPRESSED_MESSAGES = metrics.counter(
+    'snmp_stage_compressed_messages',
+    'Number of published messages that were compressed', ('stage', ))
 
 
 class Stage(object):
@@ -21,104 +50,155 @@ class Stage(object):
      * Action will be called with the 'logic' as parameter
      * Action calls the logic
     * Result from the Action is pushed on the outgoing queue for that Action
+
+  With --concurrency N the stage keeps N messages in flight and executes
+  the Actions on a pool of N threads. The threads only serialize the
+  results, all publishing and acking is done on the connection thread.
+
+  Sending SIGUSR1 toggles profiling of the Actions, see profiling.py.
+
+  The queues are provided by a transport, RabbitMQ unless told otherwise.
+  Stages sharing a process are given the parsed arguments as well since
+  there is only one command line to go around.
   """
 
-  def __init__(self, logic):
+  def __init__(self, logic, transport=None, args=None):
     self.name = logic.__class__.__name__
     self.logic = logic
     self.listen_to = set()
     self.to_purge = set()
-    self.task_channel = None
-    self.result_channel = None
-    self.connection = None
-    self.args = None
+    self.transport = transport or _pika_transport()
+    self.args = args
     self.started = False
-    self._setup()
+    self.pool = None
+    self.completed = queue.Queue()
+    if self.args is None:
+      self._setup()
 
   def _setup(self):
-    root = logging.getLogger()
-    root.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    fh = logging.FileHandler('/var/log/snmpcollector.log')
-    fh.setFormatter(formatter)
-    fh.setLevel(logging.INFO)
-    root.addHandler(fh)
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        '-d', '--debug', dest='debug', action='store_const', const=True,
-        default=False, help='do not fork, print output to console')
-    parser.add_argument(
-        '-i', '--instance', dest='instance', default='default',
-        help='specifiy instance id, used to run multiple instances')
-    parser.add_argument('--pid', dest='pidfile', default=None,
-        help='pidfile to write')
-    self.args = parser.parse_args()
-
-    if self.args.debug:
-      root.setLevel(logging.DEBUG)
-      ch = logging.StreamHandler(sys.stdout)
-      ch.setLevel(logging.DEBUG)
-      logging.getLogger('pika').setLevel(logging.ERROR)
-
-      formatter = logging.Formatter( '%(asctime)s - %(name)s - '
-          '%(levelname)s - %(message)s' )
-      ch.setFormatter(formatter)
-      root.addHandler(ch)
+    self.args = argument_parser().parse_args()
+    setup_logging(self.args.debug)
 
   def startup(self):
     assert not self.started
-    mq = config.get('mq')
-    credentials = pika.PlainCredentials(mq['username'], mq['password'])
-    self.connection = pika.BlockingConnection(
-        pika.ConnectionParameters(mq['host'], credentials=credentials))
-    self.result_channel = self.connection.channel()
+    self.transport.connect()
     logging.info('Started %s', self.name)
     self.started = True
 
   def shutdown(self):
     logging.info('Terminating %s', self.name)
-    # This closes channels as well
-    self.connection.close()
+    self.transport.close()
 
   def push(self, action, run, expire=None):
-    properties = pika.BasicProperties(
-        expiration=str(expire) if expire else None)
-    self.result_channel.basic_publish(
-        exchange='', routing_key=action.get_queue(self.args.instance),
-        #body=pickle.dumps((action, run), protocol=pickle.HIGHEST_PROTOCOL),
-        body=pickle.dumps((action, run), protocol=2),
-        properties=properties)
+    self._publish(self._message(action, run, expire))
+
+  def _message(self, action, run, expire=None):
+    task_queue = action.get_queue(self.args.instance)
+    if self.transport.in_process:
+      # Only the trace is updated as the run moves through the pipeline,
+      # give every message its own copy of it.
+      run = actions.RunInformation(run.tag, run.debug, dict(run.trace))
+      return task_queue, (action, run), None
+
+    content_type, body = codec.encode(action, run, config.get('mq', 'codec'))
+    raw_size = len(body)
+    content_encoding = None
+    threshold = config.get('mq', 'compress_threshold')
+    if threshold and raw_size >= threshold:
+      body = zlib.compress(body, COMPRESSION_LEVEL)
+      content_encoding = 'deflate'
+      COMPRESSED_MESSAGES.labels(self.name).inc()
+    RAW_BYTES.labels(self.name).inc(raw_size)
+    WIRE_BYTES.labels(self.name).inc(len(body))
+    properties = transport.Properties(
+        content_type, content_encoding, str(expire) if expire else None)
+    return task_queue, body, properties
+
+  def _publish(self, message):
+    self.transport.publish(*message)
 
   def listen(self, action_cls):
     self.listen_to.add(action_cls)
 
-  def _task_wrapper_callback(self, channel, method, properties, body):
+  def _task_wrapper_callback(self, delivery_tag, properties, body):
+    if self.pool is not None:
+      self.pool.apply_async(
+          self._threaded_task, (delivery_tag, properties, body))
+      return
     try:
-      self._task_callback(channel, method, properties, body)
+      self._task_callback(properties, body)
     except Exception as e:
       logging.exception('Unhandled exception in task loop:')
     finally:
       # Ack now, if we die during sending we will hopefully not crash loop
-      channel.basic_ack(delivery_tag=method.delivery_tag)
+      self.transport.ack(delivery_tag)
 
-  def _task_callback(self, channel, method, properties, body):
-    start = time.time()
-    action, run = pickle.loads(body)
-    if not isinstance(action, actions.Action):
+  def _threaded_task(self, delivery_tag, properties, body):
+    # Runs in the thread pool, the channel must not be touched from here
+    try:
+      for action, run in self._execute(properties, body):
+        self.completed.put((None, self._message(action, run)))
+    except Exception as e:
+      logging.exception('Unhandled exception in task loop:')
+    finally:
+      self.completed.put((delivery_tag, None))
+
+  def _drain_completed(self):
+    while True:
+      try:
+        delivery_tag, message = self.completed.get_nowait()
+      except queue.Empty:
+        return
+      if message is not None:
+        self._publish(message)
+      else:
+        self.transport.ack(delivery_tag)
+
+  def _task_callback(self, properties, body):
+    for action, run in self._execute(properties, body):
+      self.push(action, run)
+
+  def _receive(self, properties, body):
+    """Returns the (action, run) in a message, or (None, None)."""
+    if self.transport.in_process:
+      action, run = body
+    else:
+      action, run = self._decode(properties, body)
+    if action is not None and not isinstance(action, actions.Action):
       logging.error('Got non-action in task queue: %s', repr(body))
-      return
+      return None, None
+    return action, run
 
-    generator = action.do(self.logic, run)
-    if not generator:
+  def _execute(self, properties, body):
+    start = time.time()
+    action, run = self._receive(properties, body)
+    if action is None:
       return
 
-    # Mark the time we spent in this pipeline
-    end = time.time()
-    run.trace[self.name] = (start, end)
+    profile = None
+    if profiling.PROFILER.active:
+      profile = profiling.PROFILER.enter(self.name, action)
+    try:
+      generator = action.do(self.logic, run)
+      if not generator:
+        return
+
+      for action in generator:
+        # Mark the time we spent in this pipeline
+        run.trace[self.name] = (start, time.time())
+        yield action, run
+    finally:
+      if profile is not None:
+        profiling.PROFILER.leave(profile)
 
-    for action in generator:
-      self.push(action, run)
+  def _decode(self, properties, body):
+    if properties.content_encoding == 'deflate':
+      body = zlib.decompress(body)
+    elif properties.content_encoding:
+      logging.error('Unknown content encoding %s, dropping message',
+          properties.content_encoding)
+      return None, None
+    return codec.decode(properties.content_type, body)
 
   def purge(self, action_cls):
     self.to_purge.add(action_cls)
@@ -132,34 +212,38 @@ class Stage(object):
     # Needs to set up after daemonization
     self.startup()
 
-    try:
-      import procname
-      procname.setprocname(self.name)
-    except ImportError:
-      pass
+    if self.args.metrics_port:
+      metrics.start_http_server(self.args.metrics_port)
+
+    self._install_profiler()
+
+    # Do not rename the process if it is shared with other stages
+    if not self.transport.in_process:
+      try:
+        import procname
+        procname.setprocname(self.name)
+      except ImportError:
+        pass
 
     if self.args.pidfile:
       with open(self.args.pidfile, 'w') as f:
         f.write(str(os.getpid()))
 
-    self.task_channel = self.connection.channel()
-    self.task_channel.basic_qos(prefetch_count=1)
+    self.transport.set_prefetch(self.args.concurrency)
+    self._start_executor()
 
     for action_cls in self.to_purge:
       task_queue = action_cls.get_queue(self.args.instance)
-      self.task_channel.queue_declare(queue=task_queue)
-      self.task_channel.queue_purge(queue=task_queue)
+      self.transport.purge(task_queue)
       logging.debug('Purged queue %s', task_queue)
 
     for action_cls in self.listen_to:
       task_queue = action_cls.get_queue(self.args.instance)
-      self.task_channel.queue_declare(queue=task_queue)
-      self.task_channel.basic_consume(
-          self._task_wrapper_callback, queue=task_queue)
+      self.transport.consume(task_queue, self._task_wrapper_callback)
       logging.debug('Listening to queue %s', task_queue)
 
     try:
-      self.task_channel.start_consuming()
+      self._consume()
     except KeyboardInterrupt:
       logging.error('Keyboard interrupt, shutting down..')
     except Exception as e:
@@ -169,3 +253,68 @@ class Stage(object):
       self.shutdown()
     except Exception as e:
       logging.exception('Exception in shutdown')
+
+  def _install_profiler(self):
+    if self.args.profile_dir and not self.transport.in_process:
+      profiling.PROFILER.install(self.args.profile_dir)
+
+  def _start_executor(self):
+    if self.args.concurrency > 1:
+      self.pool = ThreadPool(processes=self.args.concurrency)
+      logging.info('Running %d tasks in parallel', self.args.concurrency)
+
+  def _consume(self):
+    if self.pool is None:
+      self.transport.start_consuming()
+      return
+    while True:
+      self.transport.process_events(COMPLETION_POLL_INTERVAL)
+      self._drain_completed()
+
+
+def _pika_transport():
+  return transport.PikaTransport()
+
+
+def argument_parser():
+  """Returns the command line parser shared by all stages."""
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '-d', '--debug', dest='debug', action='store_const', const=True,
+      default=False, help='do not fork, print output to console')
+  parser.add_argument(
+      '-i', '--instance', dest='instance', default='default',
+      help='specifiy instance id, used to run multiple instances')
+  parser.add_argument('--pid', dest='pidfile', default=None,
+      help='pidfile to write')
+  parser.add_argument(
+      '--concurrency', dest='concurrency', type=int, default=1,
+      help='number of messages to process in parallel')
+  parser.add_argument(
+      '--metrics-port', dest='metrics_port', type=int, default=None,
+      help='serve Prometheus metrics about this stage on this port')
+  parser.add_argument(
+      '--profile-dir', dest='profile_dir', default='',
+      help='where to write profiles, toggled by SIGUSR1 (disabled if unset)')
+  return parser
+
+
+def setup_logging(debug):
+  root = logging.getLogger()
+  root.setLevel(logging.INFO)
+  formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  fh = logging.FileHandler('/var/log/snmpcollector.log')
+  fh.setFormatter(formatter)
+  fh.setLevel(logging.INFO)
+  root.addHandler(fh)
+
+  if debug:
+    root.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler(sys.stdout)
+    ch.setLevel(logging.DEBUG)
+    logging.getLogger('pika').setLevel(logging.ERROR)
+
+    formatter = logging.Formatter( '%(asctime)s - %(name)s - '
+        '%(levelname)s - %(message)s' )
+    ch.setFormatter(formatter)
+    root.addHandler(ch)
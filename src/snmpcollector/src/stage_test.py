@@ -0,0 +1,170 @@
+import argparse
+import mock
+import pickle
+import unittest
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import actions
+import codec
+import config
+import stage
+import transport
+
+
+class FakeLogic(object):
+
+  def do_trigger(self, run):
+    yield actions.Summary(1234, 1)
+    yield actions.Summary(1234, 2)
+
+
+class TestStage(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch('config.Config.load')
+    self.addCleanup(patcher.stop)
+    self.mock_config = patcher.start()
+    self.mock_config.return_value = {}
+    config.refresh()
+    self.transport = mock.Mock(in_process=False)
+    self.stage = stage.Stage(FakeLogic(), transport=self.transport,
+        args=argparse.Namespace(instance='test', concurrency=1))
+
+  def trigger(self, delivery_tag=1, content_type=None):
+    properties = transport.Properties(content_type, None, None)
+    if content_type is None:
+      body = pickle.dumps((actions.Trigger(), actions.RunInformation()))
+    else:
+      _, body = codec.encode(
+          actions.Trigger(), actions.RunInformation(), 'compact')
+    self.stage._task_wrapper_callback(delivery_tag, properties, body)
+
+  def published(self):
+    output = []
+    for call in self.transport.publish.call_args_list:
+      queue, body, properties = call[0]
+      if properties.content_encoding == 'deflate':
+        body = zlib.decompress(body)
+      action, run = codec.decode(properties.content_type, body)
+      output.append((queue, action))
+    return output
+
+  def testSerial(self):
+    self.trigger()
+    self.assertEqual(self.published(), [
+      ('dhmon:snmp:test:Summary', actions.Summary(1234, 1)),
+      ('dhmon:snmp:test:Summary', actions.Summary(1234, 2))])
+    self.transport.ack.assert_called_once_with(1)
+
+  def testCodec(self):
+    self.mock_config.return_value = {'mq': {'codec': 'compact'}}
+    config.refresh()
+    self.trigger(content_type=codec.CompactCodec.content_type)
+    for call in self.transport.publish.call_args_list:
+      self.assertEqual(call[0][2].content_type,
+          codec.CompactCodec.content_type)
+    self.assertEqual(self.published(), [
+      ('dhmon:snmp:test:Summary', actions.Summary(1234, 1)),
+      ('dhmon:snmp:test:Summary', actions.Summary(1234, 2))])
+
+  def testCompression(self):
+    self.mock_config.return_value = {'mq': {'compress_threshold': 10}}
+    config.refresh()
+    self.trigger()
+    for call in self.transport.publish.call_args_list:
+      self.assertEqual(call[0][2].content_encoding, 'deflate')
+    self.assertEqual(self.published(), [
+      ('dhmon:snmp:test:Summary', actions.Summary(1234, 1)),
+      ('dhmon:snmp:test:Summary', actions.Summary(1234, 2))])
+
+    # Compressed messages are decompressed when received
+    self.transport.reset_mock()
+    properties = transport.Properties(None, 'deflate', None)
+    body = zlib.compress(
+        pickle.dumps((actions.Trigger(), actions.RunInformation())))
+    self.stage._task_wrapper_callback(2, properties, body)
+    self.assertEqual(len(self.published()), 2)
+
+  def testConcurrent(self):
+    self.stage.pool = ThreadPool(processes=2)
+    self.trigger(delivery_tag=1)
+    self.trigger(delivery_tag=2)
+    self.stage.pool.close()
+    self.stage.pool.join()
+
+    # Nothing may touch the channels before the connection thread drains
+    self.assertFalse(self.transport.publish.called)
+    self.assertFalse(self.transport.ack.called)
+
+    self.stage._drain_completed()
+    self.assertEqual(len(self.published()), 4)
+    self.transport.ack.assert_has_calls(
+        [mock.call(1), mock.call(2)], any_order=True)
+
+  def testConcurrentException(self):
+    self.stage.pool = ThreadPool(processes=2)
+    properties = transport.Properties(None, None, None)
+    self.stage._task_wrapper_callback(3, properties, b'garbage')
+    self.stage.pool.close()
+    self.stage.pool.join()
+
+    self.stage._drain_completed()
+    self.assertFalse(self.transport.publish.called)
+    self.transport.ack.assert_called_once_with(3)
+
+
+class Collector(object):
+
+  def __init__(self):
+    self.summaries = []
+
+  def do_summary(self, run, timestamp, targets):
+    self.summaries.append((timestamp, targets, sorted(run.trace)))
+
+
+class TestMemoryTransport(unittest.TestCase):
+
+  def testPipeline(self):
+    broker = transport.MemoryBroker()
+    args = argparse.Namespace(instance='test', concurrency=1)
+    source = stage.Stage(FakeLogic(), transport.MemoryTransport(broker), args)
+    source.listen(actions.Trigger)
+    sink_logic = Collector()
+    sink = stage.Stage(sink_logic, transport.MemoryTransport(broker), args)
+    sink.listen(actions.Summary)
+    for s in (source, sink):
+      s.transport.consume(
+          s.listen_to.pop().get_queue('test'), s._task_wrapper_callback)
+
+    source.push(actions.Trigger(), actions.RunInformation(trace={'A': (1, 1)}))
+    self.assertEqual(broker.depth('dhmon:snmp:test:Trigger'), 1)
+    source.transport.process_events(0)
+    self.assertEqual(broker.depth('dhmon:snmp:test:Trigger'), 0)
+    self.assertEqual(broker.depth('dhmon:snmp:test:Summary'), 2)
+    sink.transport.process_events(0)
+    self.assertEqual(sink_logic.summaries, [
+      (1234, 1, ['A', 'FakeLogic']), (1234, 2, ['A', 'FakeLogic'])])
+
+  def testPrefetch(self):
+    broker = transport.MemoryBroker()
+    mq = transport.MemoryTransport(broker)
+    delivered = []
+    mq.consume('queue', lambda *args: delivered.append(args))
+    mq.set_prefetch(2)
+    for i in range(3):
+      mq.publish('queue', i, None)
+    mq.process_events(0)
+    self.assertEqual([x[2] for x in delivered], [0, 1])
+    mq.ack(delivered[0][0])
+    mq.process_events(0)
+    self.assertEqual([x[2] for x in delivered], [0, 1, 2])
+    self.assertEqual(broker.depth('queue'), 0)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import collections
 import logging
 import sqlite3
 import time
@@ -42,11 +43,25 @@ class Supervisor(object):
 
   def do_trigger(self, run):
     timestamp = time.time()
+    # Devices of the same layer share credentials and are likely to be
+    # the same kind of device, so they are batched together.
+    batch_size = config.get('worker', 'batch') or 0
+    batches = collections.defaultdict(list)
 
     targets = 0
     for host, target in self.construct_targets(timestamp):
       targets += 1
-      yield actions.SnmpWalk(target)
+      if batch_size <= 1:
+        yield actions.SnmpWalk(target)
+        continue
+      batch = batches[target.layer]
+      batch.append(target)
+      if len(batch) >= batch_size:
+        yield actions.SnmpWalkBatch(batch)
+        batches[target.layer] = []
+    for layer, batch in sorted(batches.items()):
+      if batch:
+        yield actions.SnmpWalkBatch(batch)
 
     # Record how many targets there are in this round to make it
     # possible to record pipeline latency
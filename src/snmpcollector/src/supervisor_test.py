@@ -26,6 +26,7 @@ class TestSuportvisor(unittest.TestCase):
     self.addCleanup(patcher.stop)
     self.mock_time = patcher.start()
     self.mock_time.return_value = 1234
+    config.refresh()
 
   @mock.patch('supervisor.Supervisor.fetch_nodes')
   @mock.patch('config.Config.load')
@@ -55,6 +56,30 @@ class TestSuportvisor(unittest.TestCase):
     for expected, real in zip(expected_output, output):
       self.assertEqual(real, expected)
 
+  @mock.patch('supervisor.Supervisor.fetch_nodes')
+  @mock.patch('config.Config.load')
+  def testBatch(self, mock_config, mock_fetch_nodes):
+    logic = supervisor.Supervisor()
+    mock_config.return_value = yaml.load(CONFIG + """
+  dist:
+    version: 2
+    community: REMOVED
+    port: 161
+worker:
+  batch: 2
+""")
+    mock_fetch_nodes.return_value = [
+        ('test1', '1.2.3.4', 'access', 'EVENT@TESTNET1'),
+        ('test2', '1.2.3.5', 'access', 'EVENT@TESTNET1'),
+        ('test3', '1.2.3.6', 'dist', 'EVENT@TESTNET1'),
+        ('test4', '1.2.3.7', 'access', 'EVENT@TESTNET1')]
+
+    output = list(actions.Trigger().do(logic, run=actions.RunInformation()))
+
+    self.assertEqual([[y.host for y in x.targets] for x in output[:-1]],
+        [['test1', 'test2'], ['test4'], ['test3']])
+    self.assertEqual(output[-1], actions.Summary(1234, 4))
+
 
 def main():
   unittest.main()
@@ -0,0 +1,179 @@
+"""Message transports connecting the pipeline stages.
+
+PikaTransport talks to RabbitMQ and is used when the stages run as separate
+processes. MemoryTransport moves the actions through in-process queues
+without serializing them, which allows running the whole pipeline in one
+process (see pipeline.py).
+"""
+import collections
+import itertools
+import threading
+import time
+
+import config
+
+
+Properties = collections.namedtuple('Properties',
+    ('content_type', 'content_encoding', 'expiration'))
+
+
+class PikaTransport(object):
+  """RabbitMQ transport based on a pika BlockingConnection."""
+
+  in_process = False
+
+  def __init__(self):
+    self.connection = None
+    self.result_channel = None
+    self.task_channel = None
+
+  def connect(self):
+    # Imported here to not require pika for in-process pipelines
+    import pika
+    self._pika = pika
+    mq = config.get('mq')
+    credentials = pika.PlainCredentials(mq['username'], mq['password'])
+    self.connection = pika.BlockingConnection(
+        pika.ConnectionParameters(mq['host'], credentials=credentials))
+    self.result_channel = self.connection.channel()
+    self.task_channel = self.connection.channel()
+
+  def close(self):
+    # This closes channels as well
+    self.connection.close()
+
+  def publish(self, queue, body, properties):
+    properties = self._pika.BasicProperties(
+        content_type=properties.content_type,
+        content_encoding=properties.content_encoding,
+        expiration=properties.expiration)
+    self.result_channel.basic_publish(
+        exchange='', routing_key=queue, body=body, properties=properties)
+
+  def set_prefetch(self, count):
+    self.task_channel.basic_qos(prefetch_count=count)
+
+  def purge(self, queue):
+    self.task_channel.queue_declare(queue=queue)
+    self.task_channel.queue_purge(queue=queue)
+
+  def depth(self, queue):
+    """Returns the number of messages waiting in queue."""
+    return self.task_channel.queue_declare(queue=queue).method.message_count
+
+  def consume(self, queue, callback):
+    """Call callback(delivery_tag, properties, body) for every message."""
+    def _callback(channel, method, properties, body):
+      callback(method.delivery_tag, properties, body)
+    self.task_channel.queue_declare(queue=queue)
+    self.task_channel.basic_consume(_callback, queue=queue)
+
+  def ack(self, delivery_tag):
+    self.task_channel.basic_ack(delivery_tag=delivery_tag)
+
+  def start_consuming(self):
+    self.task_channel.start_consuming()
+
+  def process_events(self, time_limit):
+    self.connection.process_data_events(time_limit=time_limit)
+
+
+class MemoryBroker(object):
+  """In-process replacement for RabbitMQ, a set of named FIFO queues."""
+
+  def __init__(self):
+    self.condition = threading.Condition()
+    self.queues = collections.defaultdict(collections.deque)
+
+  def put(self, queue, message):
+    with self.condition:
+      self.queues[queue].append(message)
+      self.condition.notify_all()
+
+  def purge(self, queue):
+    with self.condition:
+      self.queues[queue].clear()
+
+  def depth(self, queue):
+    with self.condition:
+      return len(self.queues[queue])
+
+
+class MemoryTransport(object):
+  """Transport passing actions through a MemoryBroker.
+
+  Messages are delivered to the consuming stage as objects, nothing is
+  serialized. Every stage needs its own transport but they all share the
+  same broker.
+  """
+
+  in_process = True
+
+  def __init__(self, broker):
+    self.broker = broker
+    self.consumers = collections.OrderedDict()
+    self.prefetch = 1
+    self.unacked = 0
+    self.delivery_tags = itertools.count(1)
+    self.closed = False
+
+  def connect(self):
+    self.closed = False
+
+  def close(self):
+    with self.broker.condition:
+      self.closed = True
+      self.broker.condition.notify_all()
+
+  def publish(self, queue, body, properties):
+    self.broker.put(queue, (properties, body))
+
+  def set_prefetch(self, count):
+    self.prefetch = count
+
+  def purge(self, queue):
+    self.broker.purge(queue)
+
+  def depth(self, queue):
+    return self.broker.depth(queue)
+
+  def consume(self, queue, callback):
+    self.consumers[queue] = callback
+
+  def ack(self, delivery_tag):
+    with self.broker.condition:
+      self.unacked -= 1
+      self.broker.condition.notify_all()
+
+  def start_consuming(self):
+    while not self.closed:
+      self.process_events(None)
+
+  def _pending(self):
+    if self.unacked >= self.prefetch:
+      return None
+    for queue, callback in self.consumers.items():
+      if self.broker.queues[queue]:
+        self.unacked += 1
+        return callback, self.broker.queues[queue].popleft()
+    return None
+
+  def process_events(self, time_limit):
+    """Deliver all messages allowed by the prefetch limit.
+
+    Waits up to time_limit seconds (forever if None) for the first message.
+    """
+    deadline = None if time_limit is None else time.time() + time_limit
+    with self.broker.condition:
+      delivery = self._pending()
+      while delivery is None and not self.closed:
+        timeout = None if deadline is None else deadline - time.time()
+        if timeout is not None and timeout <= 0:
+          return
+        self.broker.condition.wait(timeout)
+        delivery = self._pending()
+    while delivery is not None:
+      callback, (properties, body) = delivery
+      callback(next(self.delivery_tags), properties, body)
+      with self.broker.condition:
+        delivery = self._pending()
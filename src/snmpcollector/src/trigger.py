@@ -9,11 +9,12 @@ import actions
 
 class Trigger(object):
 
-  def trigger(self, tag):
+  def trigger(self, tag, trigger=None):
     # We do not support any arguments for this helper
     #sys.argv = (sys.argv[0],)
-    trigger = stage.Stage(self)
-    trigger.startup()
+    if trigger is None:
+      trigger = stage.Stage(self)
+      trigger.startup()
     run = actions.RunInformation(
             tag, debug={}, trace={'Trigger': (time.time(), time.time())})
     trigger.push(actions.Trigger(), run, expire=5000)
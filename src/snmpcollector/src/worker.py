@@ -1,19 +1,31 @@
 #!/usr/bin/env python3
 import collections
 import logging
-import re
 
 import actions
+import columnar
 import config
+import metrics
 import multiprocessing
+import oidplan
 import snmp
 import stage
 import time
-import itertools
 import sys
 
-# How many sub-workers to spawn to enumerate VLAN OIDs
-VLAN_MAP_POOL = 2
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+# How many SNMP contexts (global and VLANs) to poll in parallel in a worker
+# process, and per device, unless configured in worker.contexts
+CONTEXTS_POOL = 8
+CONTEXTS_PER_DEVICE = 2
+
+BUDGET_OVERRUNS = metrics.counter(
+    'snmp_budget_overruns', 'Number of polls that ran out of time budget',
+    ('layer', ))
 
 
 def _poll(data):
@@ -26,8 +38,27 @@ def _poll(data):
   target, vlan, oids = data
   errors = 0
   timeouts = 0
-  results = {}
+  results = columnar.Results()
+
+
+  if target._check_deadline(oids):
+    # Out of time already, the worker will mark the results as partial
+    logging.debug('Not polling %s @ %s, out of time', target.host, vlan)
+    return results, errors, timeouts
 
+  scalars = [x for x in oids if oidplan.is_scalar(x)]
+  oids = [x for x in oids if not oidplan.is_scalar(x)]
+  if scalars:
+    try:
+      for k, v in target.get_many(scalars, vlan).items():
+        if v.type not in ('NOSUCHOBJECT', 'NOSUCHINSTANCE'):
+          results[(k, vlan)] = v
+    except snmp.TimeoutError as e:
+      timeouts += 1
+      logging.debug('Timeout getting %s @ %s: %s', scalars, vlan, e)
+    except snmp.Error as e:
+      errors += 1
+      logging.warning('SNMP error for OIDs %s@%s: %s', scalars, vlan, str(e))
 
   if sys.version_info[0] == 3:
     t_oids = []
@@ -37,32 +68,34 @@ def _poll(data):
         continue
       t_oids.append(oid[1:])
     logging.warning('Collecting %s on %s @ %s - fastsnmp', t_oids, target.host, vlan)
-    for k, v in target.walk_fastsnmp(t_oids, vlan).items():
-      results[(k,vlan)]=v
-    return results, errors, timeouts
-
-  for oid in oids:
-    logging.warning('Collecting %s on %s @ %s', oid, target.host, vlan)
-    if not oid.startswith('.1'):
-      logging.warning(
-          'OID %s does not start with .1, please verify configuration', oid)
-      continue
-    try:
-      #results.update({(k, vlan): v for k, v in target.walk(oid, vlan).iteritems()})
-      if sys.version_info[0] == 3:
-        for k, v in target.walk(oid, vlan).items():
-            results[(k,vlan)]=v
-      else:
-        for k, v in target.walk(oid, vlan).iteritems():
-            results[(k,vlan)]=v
-    except snmp.TimeoutError as e:
+    walked, failed = {}, {}
+    if t_oids:
+      walked, failed = target.walk_fastsnmp(t_oids, vlan)
+    columns = ['.' + x for x in t_oids]
+  else:
+    columns = []
+    for oid in oids:
+      if not oid.startswith('.1'):
+        logging.warning(
+            'OID %s does not start with .1, please verify configuration', oid)
+        continue
+      columns.append(oid)
+    logging.warning('Collecting %s on %s @ %s', columns, target.host, vlan)
+    # All the OIDs are walked together to save round-trips
+    walked, failed = target.walk_table(columns, vlan)
+  # What timed out is not in walked, only counted below
+  results.add_all(walked, vlan, columns)
+  for oid, e in failed.items():
+    if isinstance(e, snmp.BudgetExceeded):
+      logging.debug('Stopped walking %s@%s: %s', oid, vlan, e)
+    elif isinstance(e, snmp.TimeoutError):
       timeouts += 1
       if vlan:
         logging.debug(
             'Timeout, is switch configured for VLAN SNMP context? %s', e)
       else:
         logging.debug('Timeout, slow switch? %s', e)
-    except snmp.Error as e:
+    else:
       errors += 1
       logging.warning('SNMP error for OID %s@%s: %s', oid, vlan, str(e))
 
@@ -73,49 +106,132 @@ def _poll(data):
   return results, errors, timeouts
 
 
+def _poll_context(data):
+  """Like _poll but returns (vlan, (results, errors, timeouts), seconds).
+
+  Never raises, as that would leave the scheduler waiting for it forever.
+  """
+  target, vlan, oids = data
+  start = time.time()
+  try:
+    output = _poll(data)
+  except Exception as e:
+    logging.exception('Unexpected error polling %s @ %s:', target.host, vlan)
+    output = columnar.Results(), 1, 0
+  return vlan, output, time.time() - start
+
+
 class Worker(object):
 
   def __init__(self):
     super(Worker, self).__init__()
-    self.model_oid_cache = {}
-    self.model_oid_cache_incarnation = 0
-    self.pool = multiprocessing.Pool(processes=VLAN_MAP_POOL)
+    self.compiler = None
+    self.compiler_incarnation = 0
+    self.reference_oid_cache = None
+    # (host, vlan, oid) -> (timestamp, results) for OIDs with an interval
+    self.last_values = {}
+    # Before the pool is created so the sizes are inherited by its processes
+    snmp.BULK_SIZES.load(config.get('worker', 'bulk_sizes'))
+    snmp.MODEL_CACHE.load(config.get('worker', 'model_cache', 'filename'),
+        config.get('worker', 'model_cache', 'ttl'))
+    self.pool = self._create_pool()
 
-  def gather_oids(self, target, model):
-    if config.incarnation() != self.model_oid_cache_incarnation:
-      self.model_oid_cache_incarnation = config.incarnation()
-      self.model_oid_cache = {}
+  def _create_pool(self):
+    return multiprocessing.Pool(
+        processes=config.get('worker', 'contexts', 'concurrency')
+        or CONTEXTS_POOL)
 
-    cache_key = (target.layer, model)
-    if cache_key in self.model_oid_cache:
-      return self.model_oid_cache[cache_key]
+  def _check_incarnation(self):
+    if (self.compiler is None or
+        config.incarnation() != self.compiler_incarnation):
+      self.compiler = oidplan.Compiler(config.get('collection'))
+      self.compiler_incarnation = config.incarnation()
+      self.reference_oid_cache = None
+      self.last_values = {}
 
-    oids = set()
-    vlan_aware_oids = set()
+  def annotation_references(self):
+    """Returns [(annotated OIDs, OIDs they are joined with)]."""
+    self._check_incarnation()
+    if self.reference_oid_cache is not None:
+      return self.reference_oid_cache
 
-    if sys.version_info[0] == 3:
-      iter_temp = config.get('collection').items()
-    else:
-      iter_temp = config.get('collection').iteritems()
-    #for collection_name, collection in config.get('collection').iteritems():
-    for collection_name, collection in iter_temp:
-      for regexp in collection['models']:
-        layers = collection.get('layers', None)
-        if layers and target.layer not in layers:
-          continue
-        if 'oids' in collection and re.search(regexp, model, re.MULTILINE):
-          logging.debug(
-              'Model %s matches collection %s', model, collection_name)
-          # VLAN aware collections are run against every VLAN.
-          # We don't want to run all the other OIDs (there can be a *lot* of
-          # VLANs).
-          vlan_aware = collection.get('vlan_aware', False)
-          if vlan_aware:
-            vlan_aware_oids.update(set(collection['oids']))
-          else:
-            oids.update(set(collection['oids']))
-    self.model_oid_cache[cache_key] = (list(oids), list(vlan_aware_oids))
-    return self.model_oid_cache[cache_key]
+    annotations = []
+    for annotation in config.get('annotator', 'annotations') or []:
+      references = set()
+      for annotation_path in annotation['with'].values():
+        for key in annotation_path.split('>'):
+          references.add(key.strip().lstrip('$'))
+      annotations.append((annotation['annotate'], references))
+    self.reference_oid_cache = annotations
+    return annotations
+
+  def reference_oids(self):
+    """Returns the OIDs the annotator joins with, i.e. the annotation paths."""
+    references = set()
+    for _, oids in self.annotation_references():
+      references.update(oids)
+    return references
+
+  def needed_references(self, results):
+    """Returns the reference OIDs the annotator joins results with."""
+    needed = set()
+    for annotate, references in self.annotation_references():
+      prefixes = tuple(x + '.' for x in annotate)
+      if any(key[0].startswith(prefixes) for key in results):
+        needed.update(references)
+    return needed
+
+  def oid_intervals(self, layer, model):
+    """Returns {oid: seconds} for the OIDs not to walk on every poll."""
+    self._check_incarnation()
+    return self.compiler.intervals(layer, model)
+
+  def _due(self, target, to_poll):
+    """Leave out the OIDs walked less than their interval ago.
+
+    Returns:
+      (to_poll, cached) where cached are the last results of the OIDs that
+      were left out, so the Result is as complete as if they were walked.
+    """
+    intervals = target.intervals
+    if not intervals or not to_poll:
+      return to_poll, columnar.Results()
+    due = []
+    cached = columnar.Results()
+    for _, vlan, oids in to_poll:
+      walk = []
+      for oid in oids:
+        last = self.last_values.get((target.host, vlan, oid), None)
+        # Rounds are triggered at a fixed rate, so compare their timestamps
+        if last and target.timestamp - last[0] < intervals.get(oid, 0):
+          cached.update(last[1])
+        else:
+          walk.append(oid)
+      if walk:
+        due.append((target, vlan, walk))
+    return due, cached
+
+  def _remember(self, target, vlan, oids, results):
+    """Keep the results of the walked OIDs that have an interval."""
+    if self._out_of_time(target):
+      # The walk may have been cut short
+      return
+    intervals = target.intervals
+    for oid in oids:
+      if oid not in intervals:
+        continue
+      self.last_values[(target.host, vlan, oid)] = (
+          target.timestamp, results.subtree(oid, vlan))
+
+  def plan(self, target, model):
+    """Returns the oidplan.Plan for the device."""
+    self._check_incarnation()
+    return self.compiler.plan(target.layer, model)
+
+  def gather_oids(self, target, model):
+    plan = self.plan(target, model)
+    target.intervals = self.oid_intervals(target.layer, model)
+    return plan.oids, plan.vlan_oids
 
   def process_overrides(self, results):
     overrides = config.get('worker', 'override')
@@ -134,15 +250,136 @@ class Worker(object):
         overriden_results[oid] = snmp.ResultTuple( result.value, overrides[root])
     return overriden_results
 
+  def budget(self, target):
+    """Returns the seconds the device may be polled for, or None.
+
+    Taken from worker.budget.devices.<host>, worker.budget.layers.<layer>
+    or worker.budget.default, the first one that is set.
+    """
+    budget = config.get('worker', 'budget') or {}
+    for seconds in (
+        (budget.get('devices') or {}).get(target.host, None),
+        (budget.get('layers') or {}).get(target.layer, None),
+        budget.get('default', None)):
+      if seconds:
+        return seconds
+    return None
+
+  def _start_budget(self, target):
+    budget = self.budget(target)
+    target.deadline = None if budget is None else time.time() + budget
+
+  def _out_of_time(self, target):
+    """Returns True if the poll has used up its budget.
+
+    No new requests are sent after that, so the results may be incomplete.
+    """
+    return target.deadline is not None and time.time() >= target.deadline
+
+  def _check_overrun(self, target):
+    partial = self._out_of_time(target)
+    if partial:
+      BUDGET_OVERRUNS.labels(target.layer).inc()
+      logging.warning('Poll of %s ran out of its %s s budget',
+          target.host, self.budget(target))
+    return partial
+
   def do_snmp_walk(self, run, target):
     starttime = time.time()
-    results, errors, timeouts = self._walk(target)
-    results = results if results else {}
+    self._start_budget(target)
+    if config.get('worker', 'streaming'):
+      for chunk in self._stream(target):
+        yield chunk
+      self._check_overrun(target)
+      logging.info('Done streamed SNMP poll (%d chunks) for "%s" lat:%s',
+          chunk.sequence + 1, target.host, (time.time() - starttime))
+      return
+
+    results, errors, timeouts, contexts = self._walk(target)
+    results = results if results else columnar.Results()
     logging.info('Done SNMP poll (%d objects) for "%s" lat:%s',
         len(results.keys()), target.host, (time.time() - starttime) )
-    yield actions.Result(target, results, actions.Statistics(timeouts, errors))
+    yield actions.Result(target, results, actions.Statistics(
+      timeouts, errors, contexts, self._check_overrun(target)))
 
-  def _walk(self, target):
+  def do_snmp_walk_batch(self, run, targets):
+    """Poll several devices, yielding one Result per device.
+
+    With fastsnmp the subtrees of the global context are walked on all the
+    devices sharing community and OIDs with a single poller call. The rest
+    is polled like for one device, with the contexts of all the devices
+    sharing the process pool and worker.contexts.per_device applying to
+    each device.
+    """
+    starttime = time.time()
+    # host -> [results, errors, timeouts, contexts]
+    polls = collections.OrderedDict()
+    units = []
+    groups = collections.defaultdict(list)
+    for target in targets:
+      self._start_budget(target)
+      to_poll, errors, timeouts = self._plan(target)
+      results = None
+      if to_poll is not None:
+        to_poll, results = self._due(target, to_poll)
+      polls[target.host] = [results, errors, timeouts, {}]
+      for _, vlan, oids in to_poll or []:
+        subtrees = [x for x in oids
+                    if x.startswith('.1') and not oidplan.is_scalar(x)]
+        if sys.version_info[0] != 3 or vlan is not None or not subtrees:
+          units.append((target, vlan, oids))
+          continue
+        groups[(target._community(), tuple(subtrees))].append(target)
+        scalars = [x for x in oids if oidplan.is_scalar(x)]
+        if scalars:
+          units.append((target, vlan, scalars))
+
+    for (community, subtrees), group in groups.items():
+      start = time.time()
+      walked, timed_out = snmp.walk_hosts(group, subtrees, community)
+      seconds = time.time() - start
+      for target in group:
+        results = columnar.Results()
+        results.add_all(walked.get(target.ip, {}), None, subtrees)
+        timeouts = 1 if target.ip in timed_out else 0
+        if timeouts:
+          logging.debug('Timeout walking %s on "%s"',
+              ', '.join(subtrees), target.host)
+        self._add_poll(polls[target.host], target, None, subtrees,
+            (results, 0, timeouts), seconds)
+
+    for (target, vlan, oids), (_, output, seconds) in self._poll_units(units):
+      self._add_poll(polls[target.host], target, vlan, oids, output, seconds)
+
+    for target in targets:
+      results, errors, timeouts, contexts = polls[target.host]
+      yield actions.Result(
+          target, results or columnar.Results(), actions.Statistics(
+              timeouts, errors, contexts, self._check_overrun(target)))
+    logging.info('Done batched SNMP poll (%d devices) lat:%s',
+        len(targets), (time.time() - starttime))
+
+  def _add_poll(self, poll, target, vlan, oids, output, seconds):
+    """Add the output of a _poll to the [results, errors, timeouts,
+    contexts] of a device."""
+    part_results, part_errors, part_timeouts = output
+    part_results = self.process_overrides(part_results)
+    if not part_errors and not part_timeouts:
+      self._remember(target, vlan, oids, part_results)
+    if poll[0] is not None:
+      poll[0].update(part_results)
+    poll[1] += part_errors
+    poll[2] += part_timeouts
+    # The same context can be polled in parts
+    poll[3][vlan] = max(poll[3].get(vlan, 0), seconds)
+
+  def _plan(self, target):
+    """Figure out what to poll on the device.
+
+    Returns:
+      (to_poll, errors, timeouts) where to_poll is a list of
+      (target, vlan, oids) tuples, or None if the model is unknown.
+    """
     try:
       model = target.model()
     except snmp.TimeoutError as e:
@@ -169,22 +406,160 @@ class Worker(object):
     except snmp.Error as e:
       errors += 1
       logging.warning('Could not list VLANs: %s', str(e))
+    return self._to_poll(target, vlans, global_oids, vlan_oids), errors, timeouts
 
+  def _to_poll(self, target, vlans, global_oids, vlan_oids):
+    # The global context goes first, it has most of the OIDs
     to_poll = []
-    for vlan in list(vlans):
+    for vlan in sorted(vlans, key=lambda x: (x is not None, x)):
       oids = vlan_oids if vlan else global_oids
+      if not oids:
+        continue
       to_poll.append((target, vlan, oids))
-      logging.info('to_poll.append %s %s', target.host, oids)
+      logging.debug('to_poll.append %s %s %s', target.host, vlan, oids)
+    return to_poll
+
+  def _poll_contexts(self, to_poll, limit=None):
+    """Poll (target, vlan, oids) in parallel, yielding the _poll_context
+    output in the order the polls complete.
+
+    The polls are started in the given order, with at most limit, by
+    default worker.contexts.per_device, of them running at the same time on
+    each device. The process pool limits how many polls run in total in
+    this worker.
+    """
+    for _, output in self._poll_units(to_poll, limit):
+      yield output
+
+  def _poll_units(self, to_poll, limit=None):
+    """Like _poll_contexts but yields ((target, vlan, oids), output)."""
+    limit = limit or (config.get('worker', 'contexts', 'per_device')
+                      or CONTEXTS_PER_DEVICE)
+    pending = list(to_poll)
+    completed = queue.Queue()
+    # host -> polls running on it
+    running = collections.Counter()
+    total = 0
+    while pending or total:
+      waiting = []
+      for unit in pending:
+        if running[unit[0].host] >= limit:
+          waiting.append(unit)
+          continue
+        self.pool.apply_async(_poll_context, (unit, ),
+            callback=lambda output, unit=unit: completed.put((unit, output)))
+        running[unit[0].host] += 1
+        total += 1
+      pending = waiting
+      unit, output = completed.get()
+      running[unit[0].host] -= 1
+      total -= 1
+      yield unit, output
+
+  def _walk(self, target):
+    to_poll, errors, timeouts = self._plan(target)
+    if to_poll is None:
+      return None, errors, timeouts, {}
+    to_poll, results = self._due(target, to_poll)
+    oids = dict((vlan, x) for _, vlan, x in to_poll)
 
-    results = {}
-    for part_results, part_errors, part_timeouts in self.pool.imap( _poll, itertools.islice(to_poll, 1) ):
-      results.update(self.process_overrides(part_results))
+    contexts = {}
+    for vlan, output, seconds in self._poll_contexts(to_poll):
+      part_results, part_errors, part_timeouts = output
+      part_results = self.process_overrides(part_results)
+      # Partial results would be used for the whole interval
+      if not part_errors and not part_timeouts:
+        self._remember(target, vlan, oids[vlan], part_results)
+      results.update(part_results)
       errors += part_errors
       timeouts += part_timeouts
-    return results, errors, timeouts
+      contexts[vlan] = seconds
+      logging.debug('Polled %s @ %s in %.3f s', target.host, vlan, seconds)
+    return results, errors, timeouts, contexts
+
+  def _stream(self, target):
+    """Poll the device one OID subtree at a time, yielding ResultChunks.
+
+    Subtrees the annotator joins with are walked first and passed along
+    as references with the later chunks, which makes every chunk possible
+    to annotate on its own. A chunk only carries the references of the
+    annotations of its OIDs.
+    """
+    to_poll, errors, timeouts = self._plan(target)
+    to_poll, cached = self._due(target, to_poll)
+    references = self.reference_oids()
+
+    def is_reference(oid):
+      return any(oid == x or oid.startswith(x + '.') or x.startswith(oid + '.')
+                 for x in references)
+
+    units = []
+    for _, vlan, oids in to_poll or []:
+      for oid in oids:
+        units.append((target, vlan, [oid]))
+
+    collected = {}
+    sequence = 0
+    # What was not due is sent first, it is also used as references
+    if cached or not units:
+      yield actions.ResultChunk(target, cached, actions.Statistics(
+        timeouts, errors, partial=self._out_of_time(target)), 0, not units)
+      sequence += 1
+      errors = timeouts = 0
+      for key, value in cached.items():
+        if any(key[0].startswith(x + '.') for x in references):
+          collected[key] = value
+    if not units:
+      return
+
+    # The references have to be complete before the rest is started
+    phases = (
+        [x for x in units if is_reference(x[2][0])],
+        [x for x in units if not is_reference(x[2][0])])
+    total = sequence + len(units)
+    for phase in phases:
+      for vlan, output, seconds in self._poll_contexts(phase):
+        part_results, part_errors, part_timeouts = output
+        part_results = self.process_overrides(part_results)
+        if not part_errors and not part_timeouts:
+          self._remember(target, vlan, [
+            x[2][0] for x in phase if x[1] == vlan and any(
+              k[0].startswith(x[2][0] + '.') for k in part_results)],
+            part_results)
+        # Problems found while planning are accounted to the first chunk
+        if sequence == 0:
+          part_errors += errors
+          part_timeouts += timeouts
+        needed = tuple(x + '.' for x in self.needed_references(part_results))
+        chunk_references = dict(
+            (k, v) for k, v in collected.items()
+            if k[1] in (None, vlan) and k[0].startswith(needed))
+        yield actions.ResultChunk(
+            target, part_results,
+            actions.Statistics(part_timeouts, part_errors, {vlan: seconds},
+                               self._out_of_time(target)),
+            sequence, sequence == total - 1, chunk_references)
+        sequence += 1
+
+        for key, value in part_results.items():
+          if any(key[0].startswith(x + '.') for x in references):
+            collected[key] = value
 
 
 if __name__ == '__main__':
-  worker = stage.Stage(Worker())
+  parser = stage.argument_parser()
+  parser.add_argument(
+      '--asyncio', dest='asyncio', action='store_true', default=False,
+      help='poll --concurrency devices at once from one event loop')
+  args = parser.parse_args()
+  stage.setup_logging(args.debug)
+
+  if args.asyncio:
+    import aioworker
+    import aiostage
+    worker = aiostage.AsyncStage(aioworker.AsyncWorker(), args=args)
+  else:
+    worker = stage.Stage(Worker(), args=args)
   worker.listen(actions.SnmpWalk)
+  worker.listen(actions.SnmpWalkBatch)
   worker.run()
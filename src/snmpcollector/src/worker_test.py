@@ -0,0 +1,319 @@
+import collections
+import mock
+import threading
+import time
+import unittest
+import yaml
+
+import actions
+import columnar
+import config
+import snmp
+import worker
+
+
+CONFIG = """
+worker:
+  contexts:
+    concurrency: 4
+    per_device: 2
+"""
+
+BUDGET_CONFIG = CONFIG + """
+  budget:
+    default: 300
+    layers:
+      access: 60
+    devices:
+      test2: 10
+"""
+
+INTERVAL_CONFIG = CONFIG + """
+collection:
+  Counters:
+    models:
+      - .*
+    oids:
+      - .1.2
+  Inventory:
+    models:
+      - ^WS-C
+    interval: 300
+    oids:
+      - .1.3
+"""
+
+STREAM_CONFIG = CONFIG + """
+  streaming: true
+annotator:
+  annotations:
+    - annotate:
+        - .1.3.6.1.2.1.2.2.1
+      with:
+        interface: .1.3.6.1.2.1.2.2.1.2
+    - annotate:
+        - .1.3.6.1.2.1.17.4.3.1.2
+      with:
+        interface: .1.3.6.1.2.1.17.1.4.1.2 > .1.3.6.1.2.1.2.2.1.2
+"""
+
+
+class FakePool(object):
+  """Runs the polls on threads, one at a time in the order they finish."""
+
+  def __init__(self):
+    self.started = []
+    self.running = 0
+    self.max_running = 0
+    # host -> polls running, most polls running
+    self.host_running = collections.Counter()
+    self.host_max_running = collections.Counter()
+    self.lock = threading.Lock()
+
+  def apply_async(self, func, args, callback):
+    host = args[0][0].host
+    with self.lock:
+      self.started.append(args[0][1])
+      self.running += 1
+      self.max_running = max(self.max_running, self.running)
+      self.host_running[host] += 1
+      self.host_max_running[host] = max(
+          self.host_max_running[host], self.host_running[host])
+
+    def run():
+      output = func(*args)
+      with self.lock:
+        self.running -= 1
+        self.host_running[host] -= 1
+      callback(output)
+    threading.Thread(target=run).start()
+
+
+class TestWorker(unittest.TestCase):
+
+  @mock.patch('multiprocessing.Pool')
+  @mock.patch('config.Config.load')
+  def setUp(self, mock_config, mock_pool):
+    mock_config.return_value = yaml.load(CONFIG)
+    self.logic = worker.Worker()
+    self.logic.pool = FakePool()
+    self.target = snmp.SnmpTarget(
+        'test1', '1.2.3.4', 1234, 'access',
+        version=2, community='REMOVED', port=161)
+    mock_pool.assert_called_with(processes=4)
+
+  @mock.patch('worker._poll')
+  def testWalkAllContexts(self, mock_poll):
+    def poll(data):
+      target, vlan, oids = data
+      return {('.1.2.3', vlan): snmp.ResultTuple('1', 'INTEGER')}, 0, 0
+    mock_poll.side_effect = poll
+    to_poll = [(self.target, vlan, ['.1.2']) for vlan in (None, 10, 20, 30)]
+
+    with mock.patch.object(self.logic, '_plan') as mock_plan:
+      mock_plan.return_value = (to_poll, 1, 0)
+      results, errors, timeouts, contexts = self.logic._walk(self.target)
+
+    self.assertEqual(set(results), set(
+        [('.1.2.3', None), ('.1.2.3', 10), ('.1.2.3', 20), ('.1.2.3', 30)]))
+    self.assertEqual((errors, timeouts), (1, 0))
+    self.assertEqual(set(contexts), set([None, 10, 20, 30]))
+    self.assertEqual(self.logic.pool.started[0], None)
+    self.assertTrue(self.logic.pool.max_running <= 2)
+
+  @mock.patch('worker._poll')
+  def testPollFailure(self, mock_poll):
+    mock_poll.side_effect = ValueError('Broken poll')
+    output = list(self.logic._poll_contexts([(self.target, 10, ['.1.2'])]))
+    self.assertEqual(len(output), 1)
+    vlan, (results, errors, timeouts), seconds = output[0]
+    self.assertEqual((vlan, results, errors, timeouts), (10, {}, 1, 0))
+
+  @mock.patch.object(worker.sys, 'version_info', (3, 6))
+  def testPollTimeout(self):
+    with mock.patch.object(self.target, 'walk_fastsnmp') as mock_walk, \
+        mock.patch.object(self.logic, '_remember') as mock_remember:
+      mock_walk.return_value = (
+          {'.1.2.1': snmp.ResultTuple('1', 'INTEGER')},
+          {'.1.3': snmp.TimeoutError('Timeout walking .1.3')})
+      output = worker._poll((self.target, None, ['.1.2', '.1.3']))
+      mock_walk.assert_called_once_with(['1.2', '1.3'], None)
+      results, errors, timeouts = output
+      self.assertEqual(set(results), set([('.1.2.1', None)]))
+      self.assertEqual((errors, timeouts), (0, 1))
+
+      # What timed out is not remembered as the OIDs of the device
+      poll = [columnar.Results(), 0, 0, {}]
+      self.logic._add_poll(poll, self.target, None, ['.1.2', '.1.3'],
+                           output, 1)
+      self.assertFalse(mock_remember.called)
+      self.assertEqual(poll[2], 1)
+
+  @mock.patch('snmp.walk_hosts')
+  @mock.patch('worker._poll')
+  def testBatch(self, mock_poll, mock_walk_hosts):
+    targets = [snmp.SnmpTarget(
+        'test%d' % i, '1.2.3.%d' % i, 1234, 'access',
+        version=2, community='REMOVED', port=161) for i in range(3)]
+    def plan(target):
+      if target.host == 'test2':
+        return None, 0, 1
+      return [(target, None, ['.1.2', '.1.3.0']), (target, 10, ['.1.4'])], 0, 0
+    def poll(data):
+      target, vlan, oids = data
+      return dict(((oid + '.1', vlan), snmp.ResultTuple('1', 'INTEGER'))
+                  for oid in oids), 0, 0
+    mock_poll.side_effect = poll
+    mock_walk_hosts.return_value = ({
+        '1.2.3.0': {'.1.2.1': snmp.ResultTuple('0', 'INTEGER')},
+        '1.2.3.1': {'.1.2.1': snmp.ResultTuple('1', 'INTEGER')}},
+        set(['1.2.3.0']))
+
+    with mock.patch.object(self.logic, '_plan') as mock_plan, \
+        mock.patch.object(self.logic, '_remember') as mock_remember:
+      mock_plan.side_effect = plan
+      output = list(actions.SnmpWalkBatch(targets).do(
+          self.logic, actions.RunInformation()))
+
+    self.assertEqual([x.target.host for x in output], ['test0', 'test1', 'test2'])
+    if worker.sys.version_info[0] == 3:
+      # One poller call for the subtrees of all the devices
+      mock_walk_hosts.assert_called_once_with(
+          targets[:2], ('.1.2', ), 'REMOVED')
+    self.assertEqual(output[1].results[('.1.2.1', None)].value, '1')
+    self.assertEqual(set(output[1].results), set(
+        [('.1.2.1', None), ('.1.3.0.1', None), ('.1.4.1', 10)]))
+    self.assertEqual(set(output[0].stats.contexts), set([None, 10]))
+    self.assertEqual(output[2].results, {})
+    self.assertEqual(output[2].stats.timeouts, 1)
+    if worker.sys.version_info[0] == 3:
+      # test0 timed out walking the subtrees, what it returned is not kept
+      self.assertEqual(output[0].stats.timeouts, 1)
+      self.assertEqual(output[0].results[('.1.2.1', None)].value, '0')
+      self.assertEqual(output[1].stats.timeouts, 0)
+      remembered = [x[0][:3] for x in mock_remember.call_args_list]
+      self.assertNotIn((targets[0], None, ('.1.2', )), remembered)
+      self.assertIn((targets[1], None, ('.1.2', )), remembered)
+
+  @mock.patch('worker._poll')
+  def testBatchContexts(self, mock_poll):
+    targets = [snmp.SnmpTarget(
+        'test%d' % i, '1.2.3.%d' % i, 1234, 'access',
+        version=2, community='REMOVED', port=161) for i in range(3)]
+    def poll(data):
+      target, vlan, oids = data
+      time.sleep(0.01)
+      return {}, 0, 0
+    mock_poll.side_effect = poll
+
+    with mock.patch.object(self.logic, '_plan') as mock_plan:
+      mock_plan.side_effect = lambda target: ([
+          (target, vlan, ['.1.2.0']) for vlan in (None, 10, 20, 30)], 0, 0)
+      output = list(actions.SnmpWalkBatch(targets).do(
+          self.logic, actions.RunInformation()))
+
+    self.assertEqual(len(output), 3)
+    self.assertEqual(len(self.logic.pool.started), 12)
+    # The devices are polled together, but no more than per_device contexts
+    # of each of them
+    self.assertEqual(self.logic.pool.max_running, 6)
+    self.assertEqual(set(self.logic.pool.host_max_running.values()),
+                     set([2]))
+
+  @mock.patch('worker.time')
+  @mock.patch('config.Config.load')
+  def testBudget(self, mock_config, mock_time):
+    mock_config.return_value = yaml.load(BUDGET_CONFIG)
+    config.refresh()
+    dist = snmp.SnmpTarget('test3', '1.2.3.6', 1234, 'dist', version=2)
+    self.assertEqual(self.logic.budget(self.target), 60)
+    self.assertEqual(self.logic.budget(
+        snmp.SnmpTarget('test2', '1.2.3.5', 1234, 'access', version=2)), 10)
+    self.assertEqual(self.logic.budget(dist), 300)
+
+    def walk(target):
+      # The last context was still being walked when the budget ran out
+      mock_time.time.return_value = 1061
+      return {('.1.2.1', None): snmp.ResultTuple('1', 'INTEGER')}, 0, 0, {}
+    mock_time.time.return_value = 1000
+    with mock.patch.object(self.logic, '_walk') as mock_walk:
+      mock_walk.side_effect = walk
+      output = list(actions.SnmpWalk(self.target).do(
+          self.logic, actions.RunInformation()))
+      self.assertEqual(self.target.deadline, 1060)
+      self.assertEqual(len(output[0].results), 1)
+      self.assertTrue(output[0].stats.partial)
+
+      mock_walk.side_effect = lambda target: ({}, 0, 0, {})
+      output = list(actions.SnmpWalk(dist).do(
+          self.logic, actions.RunInformation()))
+      self.assertFalse(output[0].stats.partial)
+
+  @mock.patch('worker._poll')
+  @mock.patch('config.Config.load')
+  def testInterval(self, mock_config, mock_poll):
+    mock_config.return_value = yaml.load(INTERVAL_CONFIG)
+    config.refresh()
+    def poll(data):
+      target, vlan, oids = data
+      return columnar.Results(((oid + '.1', vlan), snmp.ResultTuple(
+        str(target.timestamp), 'INTEGER')) for oid in oids), 0, 0
+    mock_poll.side_effect = poll
+    to_poll = [(self.target, None, ['.1.2', '.1.3'])]
+    # The inventory of other models is walked on every poll
+    self.assertEqual(self.logic.oid_intervals('access', 'Linux'), {})
+    self.target.intervals = self.logic.oid_intervals('access', 'WS-C4500X')
+    self.assertEqual(self.target.intervals, {'.1.3': 300})
+
+    with mock.patch.object(self.logic, '_plan') as mock_plan:
+      for timestamp, walked, inventory in (
+          (0, ['.1.2', '.1.3'], '0'), (60, ['.1.2'], '0'),
+          (299, ['.1.2'], '0'), (300, ['.1.2', '.1.3'], '300')):
+        self.target.timestamp = timestamp
+        mock_plan.return_value = (to_poll, 0, 0)
+        mock_poll.reset_mock()
+        results, _, _, _ = self.logic._walk(self.target)
+        self.assertEqual(mock_poll.call_args[0][0][2], walked)
+        self.assertEqual(results[('.1.2.1', None)].value, str(timestamp))
+        self.assertEqual(results[('.1.3.1', None)].value, inventory)
+
+
+  @mock.patch('worker._poll')
+  @mock.patch('config.Config.load')
+  def testStreamReferences(self, mock_config, mock_poll):
+    mock_config.return_value = yaml.load(STREAM_CONFIG)
+    config.refresh()
+    def poll(data):
+      target, vlan, oids = data
+      return columnar.Results({
+          (oids[0] + '.1', vlan): snmp.ResultTuple('1', 'INTEGER')}), 0, 0
+    mock_poll.side_effect = poll
+    to_poll = [(self.target, None, [
+        '.1.3.6.1.2.1.2.2.1.2', '.1.3.6.1.2.1.17.1.4.1.2',
+        '.1.3.6.1.2.1.2.2.1.10', '.1.3.6.1.2.1.17.4.3.1.2',
+        '.1.3.6.1.2.1.47.1.1.1.1.2'])]
+
+    with mock.patch.object(self.logic, '_plan') as mock_plan:
+      mock_plan.return_value = (to_poll, 0, 0)
+      output = list(actions.SnmpWalk(self.target).do(
+          self.logic, actions.RunInformation()))
+
+    references = dict((list(x.results)[0][0], set(y[0] for y in x.references))
+                      for x in output)
+    # The references are walked first, without references
+    self.assertEqual(references['.1.3.6.1.2.1.2.2.1.2.1'], set())
+    self.assertEqual(references['.1.3.6.1.2.1.17.1.4.1.2.1'], set())
+    # Only the references of the annotations of the chunk are sent
+    self.assertEqual(references['.1.3.6.1.2.1.2.2.1.10.1'],
+                     set(['.1.3.6.1.2.1.2.2.1.2.1']))
+    self.assertEqual(references['.1.3.6.1.2.1.17.4.3.1.2.1'], set([
+        '.1.3.6.1.2.1.2.2.1.2.1', '.1.3.6.1.2.1.17.1.4.1.2.1']))
+    self.assertEqual(references['.1.3.6.1.2.1.47.1.1.1.1.2.1'], set())
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()